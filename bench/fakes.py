@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# fakes.py - deterministic stand ins for the network, shared by the fake
+# executables and the benchmark runner
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import zlib
+
+# the fake executables are configured through the environment, so every
+# process started by the code under test sees the same settings
+LATENCY_ENV = 'BENCH_LATENCY'
+ONLINE_ENV = 'BENCH_ONLINE'
+
+# seconds per host
+LATENCY = 0.001
+# share of addresses that are online
+ONLINE = 0.25
+
+OPEN_PORTS = (('22', 'ssh'), ('80', 'http'))
+
+
+def latency():
+    return float(os.environ.get(LATENCY_ENV, LATENCY))
+
+
+def online_ratio():
+    return float(os.environ.get(ONLINE_ENV, ONLINE))
+
+
+def is_online(ip, ratio=None):
+    '''stable pseudo random liveness of ip'''
+    ratio = online_ratio() if ratio is None else ratio
+    return zlib.crc32(ip.encode()) % 10000 < ratio * 10000
+
+
+def mac_of(ip):
+    crc = zlib.crc32(ip.encode())
+    return '02:00:%02x:%02x:%02x:%02x' % (
+        crc >> 24 & 0xff, crc >> 16 & 0xff, crc >> 8 & 0xff, crc & 0xff
+    )
+
+
+def hostname_of(ip):
+    return 'host-' + ip.replace('.', '-').replace(':', '-')
+
+
+def host_xml(ip, online):
+    '''<host> element in the layout of nmap -oX'''
+    if not online:
+        return (
+            '<host><status state="down" reason="no-response"/>'
+            '<address addr="%s" addrtype="ipv4"/></host>\n' % ip
+        )
+    ports = ''.join(
+        '<port protocol="tcp" portid="%s"><state state="open"/>'
+        '<service name="%s"/></port>' % (port, service)
+        for port, service in OPEN_PORTS
+    )
+    return (
+        '<host><status state="up" reason="arp-response"/>'
+        '<address addr="%s" addrtype="ipv4"/>'
+        '<address addr="%s" addrtype="mac" vendor="Bench"/>'
+        '<hostnames/><ports>%s</ports></host>\n' % (ip, mac_of(ip).upper(), ports)
+    )
+
+
+def nmap_xml(ips, ratio=None):
+    '''complete nmap -oX document for ips'''
+    yield '<?xml version="1.0"?>\n<nmaprun scanner="nmap" args="fake">\n'
+    for ip in ips:
+        yield host_xml(ip, is_online(ip, ratio))
+    yield '<runstats><finished/></runstats></nmaprun>\n'
+
+
+def make_lookup(delay=None, ratio=1.0):
+    '''blocking reverse lookup taking `delay` seconds, names `ratio` of all
+    addresses'''
+    delay = latency() if delay is None else delay
+
+    def lookup(ip):
+        if delay:
+            time.sleep(delay)
+        if is_online(ip, ratio):
+            return hostname_of(ip)
+        return None
+
+    return lookup
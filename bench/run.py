@@ -0,0 +1,526 @@
+# -*- coding: utf-8 -*-
+#
+# run.py - benchmark the scan code paths against fake nmap, arping and
+# dns backends, writing machine readable results
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Every scenario runs in a fresh interpreter, so startup time and peak RSS
+are its own. Startup covers what the daemon does before its loops run,
+importing whosonline and opening a result store. Usage:
+
+    python bench/run.py                         # all scenarios, 256 hosts
+    python bench/run.py --hosts 256 4096 65536 --scenario nmap_scan
+    python bench/run.py --compare old.json      # print change against old run
+'''
+
+import argparse
+import asyncio
+import contextlib
+import ipaddress
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import fakes  # noqa: E402
+
+FAKE_NMAP = os.path.join(BENCH_DIR, 'fake_nmap')
+FAKE_ARPING = os.path.join(BENCH_DIR, 'fake_arping')
+
+SCENARIOS = (
+    'parse', 'nmap_scan', 'nmap_scan_loop', 'cluster_scan_loop', 'netcheck_loop',
+    'get_hostnames', 'async_get_hostnames',
+)
+
+HOST_COUNTS = (256,)
+
+INTERFACE = 'bench0'
+
+# seconds between two loop lag samples
+LAG_INTERVAL = 0.01
+
+DEFAULT_OUTPUT = 'bench_results.json'
+
+
+def network_for(hosts):
+    '''smallest ipv4 network of 10.0.0.0 with room for `hosts` addresses'''
+    bits = max(2, math.ceil(math.log2(hosts)))
+    return ipaddress.ip_network('10.0.0.0/%s' % (32 - bits))
+
+
+def fake_on_path(name, path):
+    '''make fake `path` the first `name` found on PATH, for child processes'''
+    bin_dir = tempfile.mkdtemp(prefix='whosonline-bench-')
+    os.symlink(path, os.path.join(bin_dir, name))
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class LagMonitor:
+    '''samples how late the event loop wakes up a sleeping task'''
+
+    def __init__(self, interval=LAG_INTERVAL):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(loop.time() - expected, 0))
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+
+    def report(self):
+        if not self.samples:
+            return {'loop_lag_max': 0.0, 'loop_lag_mean': 0.0, 'loop_lag_p99': 0.0}
+        samples = sorted(self.samples)
+        return {
+            'loop_lag_max': samples[-1],
+            'loop_lag_mean': sum(samples) / len(samples),
+            'loop_lag_p99': samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+        }
+
+
+class Counter:
+    '''counts processed hosts and remembers when each cycle completed'''
+
+    def __init__(self, per_cycle, cycles):
+        self.per_cycle = per_cycle
+        self.cycles = cycles
+        self.count = 0
+        self.started = time.monotonic()
+        self.cycle_ends = []
+        self.done = asyncio.Event()
+
+    def tick(self, count=1):
+        self.count += count
+        while self.count >= self.per_cycle * (len(self.cycle_ends) + 1):
+            self.cycle_ends.append(time.monotonic())
+            if len(self.cycle_ends) >= self.cycles:
+                self.done.set()
+                break
+
+    def report(self):
+        times = []
+        previous = self.started
+        for end in self.cycle_ends:
+            times.append(end - previous)
+            previous = end
+        elapsed = (self.cycle_ends[-1] if self.cycle_ends else time.monotonic()) - self.started
+        return {
+            'hosts_processed': self.count,
+            'elapsed': elapsed,
+            'hosts_per_sec': self.count / elapsed if elapsed > 0 else 0.0,
+            'cycle_times': times,
+        }
+
+
+async def run_until(counter, coro, timeout):
+    '''run the endless loop coro until counter saw enough cycles'''
+    task = asyncio.ensure_future(coro)
+    waiter = asyncio.ensure_future(counter.done.wait())
+    try:
+        await asyncio.wait(
+            [task, waiter], timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        if task.done():
+            # surfaces exceptions of the loop under test
+            task.result()
+    finally:
+        for future in (task, waiter):
+            future.cancel()
+        await asyncio.gather(task, waiter, return_exceptions=True)
+    return counter.report()
+
+
+# scenarios, each returns a dict of measurements
+
+async def bench_parse(network, args):
+    import whosonline.nmapxml as nmapxml
+    ips = [str(ip) for ip in network.hosts()]
+    document = ''.join(fakes.nmap_xml(ips)).encode()
+    started = time.monotonic()
+    stream = nmapxml.NmapXMLStream()
+    count = 0
+    for offset in range(0, len(document), nmapxml.CHUNK_SIZE):
+        count += len(stream.feed(document[offset:offset + nmapxml.CHUNK_SIZE]))
+        await asyncio.sleep(0)
+    count += len(stream.close())
+    elapsed = time.monotonic() - started
+    return {
+        'hosts_processed': count,
+        'elapsed': elapsed,
+        'hosts_per_sec': count / elapsed if elapsed > 0 else 0.0,
+        'cycle_times': [elapsed],
+        'bytes': len(document),
+    }
+
+
+async def bench_nmap_scan(network, args):
+    import whosonline.nmapxml as nmapxml
+    nmapxml.NMAP = FAKE_NMAP
+    ips = [str(ip) for ip in network.hosts()]
+    counter = Counter(len(ips), args.cycles)
+    for cycle in range(args.cycles):
+        scan = nmapxml.scan_many(
+            ips, batch_size=args.batch_size, concurrency=args.concurrency
+        )
+        async for ip, result_d in scan:
+            counter.tick()
+    return counter.report()
+
+
+async def bench_nmap_scan_loop(network, args):
+    import whosonline.loops as loops
+    import whosonline.nmapxml as nmapxml
+    nmapxml.NMAP = FAKE_NMAP
+    counter = Counter(network.num_addresses - 2, args.cycles)
+    store_result = loops.store_result
+
+    def counting_store_result(kind, host, result_d=None, online=None):
+        counter.tick()
+        store_result(kind, host, result_d, online)
+
+    loops.store_result = counting_store_result
+    loop_coro = loops.nmap_scan_loop(
+        str(network), True, args.concurrency, 0, args.batch_size,
+        args.incremental
+    )
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return await run_until(counter, loop_coro, args.timeout)
+
+
+async def bench_cluster_scan_loop(network, args):
+    import whosonline.cluster as cluster
+    import whosonline.loops as loops
+    # workers are processes of their own, they find the fake on PATH
+    fake_on_path('nmap', FAKE_NMAP)
+    counter = Counter(network.num_addresses - 2, args.cycles)
+    store_result = loops.store_result
+
+    def counting_store_result(kind, host, result_d=None, online=None):
+        counter.tick()
+        store_result(kind, host, result_d, online)
+
+    loops.store_result = counting_store_result
+    coordinator, workers_task = await cluster.start(
+        str(network), '127.0.0.1:0', args.shards, args.workers,
+        args.batch_size, args.concurrency
+    )
+    loop_coro = loops.nmap_scan_loop(
+        str(network), True, args.concurrency, 0, args.batch_size,
+        args.incremental, coordinator=coordinator
+    )
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result = await run_until(counter, loop_coro, args.timeout)
+    finally:
+        workers_task.cancel()
+        await asyncio.gather(workers_task, return_exceptions=True)
+        coordinator.close()
+    result['workers'] = args.workers
+    return result
+
+
+async def bench_netcheck_loop(network, args):
+    import whosonline.arp as arp
+    import whosonline.hostindex as hostindex
+    import whosonline.loops as loops
+    import whosonline.netcheck as netcheck
+    import whosonline.routes as routes
+    netcheck.ROUTES = routes.RouteTable(
+        reader=lambda: [routes.Route(network, INTERFACE)]
+    )
+    if args.arp == 'engine':
+        online = {
+            str(ip): fakes.mac_of(str(ip)) for ip in network.hosts()
+            if fakes.is_online(str(ip))
+        }
+        arp.TRANSPORT_FACTORY = lambda interface: arp.FakeTransport(
+            online, latency=args.latency
+        )
+    else:
+        def unavailable(interface):
+            raise arp.ArpUnavailable('benchmarking the arping fallback')
+        arp.TRANSPORT_FACTORY = unavailable
+        fake_on_path('arping', FAKE_ARPING)
+    counter = Counter(network.num_addresses - 2, args.cycles)
+    store_result = loops.store_result
+
+    def counting_store_result(kind, host, result_d=None, online=None):
+        counter.tick()
+        store_result(kind, host, result_d, online)
+
+    loops.store_result = counting_store_result
+    # every address known by name, as after discovery
+    hosts_d = hostindex.HostIndex()
+    for ip in network.hosts():
+        hosts_d[str(ip)] = str(ip)
+    # no back off, every host is due again right after its check
+    loop_coro = loops.netcheck_loop(
+        hosts_d, INTERFACE, 'arp', min_interval=0, max_interval=3600
+    )
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return await run_until(counter, loop_coro, args.timeout)
+
+
+def _resolver(args):
+    import whosonline.resolver as resolver
+    return resolver.Resolver(
+        concurrency=args.resolver_concurrency,
+        lookup=fakes.make_lookup(args.resolver_latency)
+    )
+
+
+async def bench_get_hostnames(network, args):
+    import whosonline.netcheck as netcheck
+    res = _resolver(args)
+    counter = Counter(network.num_addresses - 2, args.cycles)
+    loop = asyncio.get_event_loop()
+
+    def walk():
+        # every address is looked up, named ones are yielded
+        for cycle in range(args.cycles):
+            for ip, hostname in netcheck.get_hostnames(str(network), resolver=res):
+                pass
+            counter.tick(counter.per_cycle)
+
+    # the blocking api runs beside the loop, so lag stays meaningful
+    await loop.run_in_executor(None, walk)
+    return counter.report()
+
+
+async def bench_async_get_hostnames(network, args):
+    import whosonline.netcheck as netcheck
+    res = _resolver(args)
+    counter = Counter(network.num_addresses - 2, args.cycles)
+    for cycle in range(args.cycles):
+        async for ip, hostname in netcheck.async_get_hostnames(str(network), resolver=res):
+            pass
+        counter.tick(counter.per_cycle)
+    return counter.report()
+
+
+async def run_scenario(name, network, args):
+    monitor = LagMonitor()
+    monitor.start()
+    try:
+        result = await globals()['bench_' + name](network, args)
+    finally:
+        await monitor.stop()
+    result.update(monitor.report())
+    return result
+
+
+def tool_startup(directory):
+    '''what the daemon does before its loops run: import the headless
+    stack and open the result store, returns the store'''
+    import whosonline.daemon  # noqa: F401
+    import whosonline.loops as loops
+    import whosonline.store as store
+    loops.result_store = store.ResultStore(os.path.join(directory, 'results.db'))
+    # the shell imports prompt_toolkit on top, if it is there
+    try:
+        import whosonline.asyncio_prompt  # noqa: F401
+    except ImportError:
+        pass
+    return loops.result_store
+
+
+def child(args):
+    '''run a single scenario, print its result as json'''
+    os.environ[fakes.LATENCY_ENV] = str(args.latency)
+    os.environ[fakes.ONLINE_ENV] = str(args.online)
+    network = network_for(args.hosts[0])
+    loop = asyncio.get_event_loop()
+    result = {
+        'scenario': args.scenario[0],
+        'hosts': network.num_addresses - 2,
+        'network': str(network),
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            result_store = tool_startup(directory)
+        except ImportError as e:
+            result['skipped'] = 'missing dependency: %s' % e
+            result_store = None
+        result['ready'] = time.time()
+        if result_store is not None:
+            try:
+                result.update(loop.run_until_complete(
+                    run_scenario(args.scenario[0], network, args)
+                ))
+            except ImportError as e:
+                result['skipped'] = 'missing dependency: %s' % e
+            finally:
+                result_store.close()
+    result['peak_rss_kb'] = peak_rss_kb()
+    print(json.dumps(result))
+
+
+def spawn(scenario, hosts, args):
+    command = [
+        sys.executable, os.path.abspath(__file__), '--child',
+        '--scenario', scenario, '--hosts', str(hosts),
+        '--cycles', str(args.cycles), '--latency', str(args.latency),
+        '--online', str(args.online), '--concurrency', str(args.concurrency),
+        '--batch-size', str(args.batch_size), '--arp', args.arp,
+        '--resolver-latency', str(args.resolver_latency),
+        '--resolver-concurrency', str(args.resolver_concurrency),
+        '--timeout', str(args.timeout),
+        '--workers', str(args.workers), '--shards', str(args.shards),
+    ]
+    if args.incremental:
+        command.append('--incremental')
+    started = time.time()
+    process = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+    lines = process.stdout.strip().splitlines()
+    if process.returncode != 0 or not lines:
+        return {'scenario': scenario, 'hosts': hosts, 'error': 'exit code %s' % process.returncode}
+    result = json.loads(lines[-1])
+    # interpreter start, imports and opening the store
+    result['startup'] = result.pop('ready') - started
+    return result
+
+
+def format_result(result):
+    if 'error' in result or 'skipped' in result:
+        return '%-20s %6s  %s' % (
+            result['scenario'], result['hosts'],
+            result.get('error') or result.get('skipped')
+        )
+    cycles = result['cycle_times']
+    return '%-20s %6s  %10.1f hosts/s  cycle %7.3fs  startup %5.3fs  rss %6.1f MB  lag max %6.1f ms' % (
+        result['scenario'], result['hosts'], result['hosts_per_sec'],
+        sum(cycles) / len(cycles) if cycles else 0.0, result['startup'],
+        result['peak_rss_kb'] / 1024.0, result['loop_lag_max'] * 1000
+    )
+
+
+def compare(results, path):
+    '''print the hosts/sec change against an earlier results file'''
+    with open(path) as f:
+        old = {
+            (result['scenario'], result['hosts']): result
+            for result in json.load(f)['results']
+        }
+    print()
+    print('CHANGE AGAINST %s:' % path)
+    for result in results:
+        before = old.get((result['scenario'], result['hosts']))
+        if not before or 'hosts_per_sec' not in before or 'hosts_per_sec' not in result:
+            continue
+        change = (result['hosts_per_sec'] / before['hosts_per_sec'] - 1) * 100 \
+            if before['hosts_per_sec'] else 0.0
+        print('%-20s %6s  %+7.1f%% hosts/s  rss %+8.1f MB' % (
+            result['scenario'], result['hosts'], change,
+            (result['peak_rss_kb'] - before['peak_rss_kb']) / 1024.0
+        ))
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+            stderr=subprocess.DEVNULL, universal_newlines=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark whosonline scan paths')
+    parser.add_argument('--scenario', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--hosts', nargs='+', type=int, default=list(HOST_COUNTS),
+                        help='Number of addresses, rounded up to a network size')
+    parser.add_argument('--cycles', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=fakes.LATENCY,
+                        help='Seconds the fake nmap/arping need per host')
+    parser.add_argument('--online', type=float, default=fakes.ONLINE,
+                        help='Share of hosts which are online')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--arp', choices=['engine', 'process'], default='engine',
+                        help='Probe through the arp engine or the arping fallback')
+    parser.add_argument('--resolver-latency', type=float, default=0.005)
+    parser.add_argument('--resolver-concurrency', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Local worker processes of cluster_scan_loop')
+    parser.add_argument('--shards', type=int, default=16)
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='Seconds after which a loop scenario is stopped')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--compare', help='Earlier results file to compare against')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    results = []
+    for hosts in args.hosts:
+        for scenario in args.scenario:
+            result = spawn(scenario, hosts, args)
+            print(format_result(result))
+            results.append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'revision': get_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time(),
+            'settings': {
+                key: value for key, value in vars(args).items()
+                if key not in ('output', 'compare', 'child')
+            },
+            'results': results,
+        }, f, indent=2)
+    print('Results written to %s' % args.output)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
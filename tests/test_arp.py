@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# test_arp.py - arp frames and the engine, over the in-memory transport
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import unittest
+
+import whosonline.arp as arp
+
+SRC_MAC = arp.mac_from_str('02:00:00:00:00:01')
+
+
+class FrameTest(unittest.TestCase):
+
+    def test_request_round_trip(self):
+        frame = arp.build_request(SRC_MAC, '10.0.0.1', '10.0.0.7')
+        self.assertEqual(frame[:6], arp.BROADCAST_MAC)
+        self.assertEqual(
+            arp.parse_frame(frame),
+            (arp.ARP_REQUEST, SRC_MAC, '10.0.0.1', '10.0.0.7')
+        )
+
+    def test_reply_goes_to_the_asker(self):
+        mac = arp.mac_from_str('02:00:00:00:00:07')
+        frame = arp.build_frame(arp.ARP_REPLY, mac, '10.0.0.7', SRC_MAC, '10.0.0.1')
+        self.assertEqual(frame[:6], SRC_MAC)
+        self.assertEqual(arp.parse_frame(frame)[:3], (arp.ARP_REPLY, mac, '10.0.0.7'))
+
+    def test_other_frames_are_ignored(self):
+        frame = arp.build_request(SRC_MAC, '10.0.0.1', '10.0.0.7')
+        self.assertIsNone(arp.parse_frame(frame[:20]))
+        ip_frame = frame[:12] + b'\x08\x00' + frame[14:]
+        self.assertIsNone(arp.parse_frame(ip_frame))
+
+    def test_ipv6_is_refused(self):
+        with self.assertRaises(OSError):
+            arp.build_request(SRC_MAC, '10.0.0.1', '2001:db8::5')
+
+
+class EngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = arp.TRANSPORT_FACTORY
+        self.retry = arp.RETRY_UNAVAILABLE
+
+    def tearDown(self):
+        arp.TRANSPORT_FACTORY = self.factory
+        arp.RETRY_UNAVAILABLE = self.retry
+        arp.reset_engines()
+
+    def test_sweep_finds_answering_hosts(self):
+        hosts = {'10.0.0.2': '02:00:00:00:00:02', '10.0.0.3': '02:00:00:00:00:03'}
+        arp.TRANSPORT_FACTORY = lambda interface: arp.FakeTransport(hosts)
+
+        async def run():
+            found = await arp.sweep(
+                ['10.0.0.2', '10.0.0.3', '10.0.0.4'], 'eth0', timeout=0.05, retries=1
+            )
+            online = await arp.arping('10.0.0.4', 'eth0', timeout=0.1, frame_count=2)
+            return found, online
+
+        found, online = asyncio.run(run())
+        self.assertEqual(found, hosts)
+        self.assertFalse(online)
+
+    def test_unavailable_transport_is_tried_again(self):
+        attempts = []
+        failing = [True]
+
+        def factory(interface):
+            attempts.append(interface)
+            if failing[0]:
+                raise arp.ArpUnavailable('interface not up yet')
+            return arp.FakeTransport({'10.0.0.2': '02:00:00:00:00:02'})
+
+        arp.TRANSPORT_FACTORY = factory
+
+        async def run():
+            for _ in range(2):
+                with self.assertRaises(arp.ArpUnavailable):
+                    arp.get_engine('eth0')
+            # the failure is kept until the retry time
+            self.assertEqual(len(attempts), 1)
+            arp.reset_engines()
+            arp.RETRY_UNAVAILABLE = 0
+            with self.assertRaises(arp.ArpUnavailable):
+                arp.get_engine('eth0')
+            failing[0] = False
+            return await arp.arping('10.0.0.2', 'eth0', timeout=0.1, frame_count=1)
+
+        self.assertTrue(asyncio.run(run()))
+        self.assertEqual(len(attempts), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# test_hostindex.py - lazy address spaces and their shards
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import itertools
+import unittest
+
+import whosonline.hostindex as hostindex
+import whosonline.netcheck as netcheck
+
+NETWORKS = '10.0.0.0/29,10.0.1.0/30,192.168.5.7/32'
+
+
+class AddressSpaceTest(unittest.TestCase):
+
+    def test_usable_addresses_only(self):
+        space = hostindex.AddressSpace(NETWORKS)
+        ips = list(space)
+        self.assertEqual(len(space), 6 + 2 + 1)
+        self.assertEqual(len(ips), len(space))
+        self.assertEqual(ips[:2], ['10.0.0.1', '10.0.0.2'])
+        self.assertNotIn('10.0.0.0', ips)
+        self.assertNotIn('10.0.0.7', ips)
+        self.assertIn('192.168.5.7', space)
+        self.assertNotIn('10.0.0.7', space)
+        self.assertNotIn('no address', space)
+
+    def test_shards_split_the_space_once(self):
+        space = hostindex.AddressSpace(NETWORKS)
+        everything = list(space)
+        for shards in (1, 2, 3, 4, 9, 12):
+            parts = [list(space.ips(shard, shards)) for shard in range(shards)]
+            self.assertEqual(list(itertools.chain(*parts)), everything)
+            sizes = [len(part) for part in parts]
+            self.assertLessEqual(max(sizes) - min(sizes), 1)
+
+    def test_existing_space_is_kept(self):
+        space = hostindex.AddressSpace('10.0.0.0/16')
+        self.assertIs(hostindex.address_space(space), space)
+        self.assertEqual(hostindex.parse_networks(space), space.networks)
+        # not re-parsed address by address, which would start at 10.0.0.0
+        self.assertEqual(next(iter(netcheck.get_ips(space))), '10.0.0.1')
+        self.assertEqual(
+            list(netcheck.get_ips(space, 1, 2))[0], '10.0.128.0'
+        )
+
+
+class HostIndexTest(unittest.TestCase):
+
+    def test_space_addresses_are_not_stored(self):
+        hosts = hostindex.HostIndex(space=hostindex.AddressSpace('10.0.0.0/24'))
+        self.assertEqual(hosts.stored_count, 0)
+        self.assertEqual(hosts['10.0.0.5'], '10.0.0.5')
+        hosts['10.0.0.5'] = 'printer'
+        self.assertTrue(hosts.is_stored('10.0.0.5'))
+        self.assertEqual(hosts['10.0.0.5'], 'printer')
+        self.assertEqual(hosts.stored_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# test_neighbours.py - which kernel neighbours become hosts
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import unittest
+
+import whosonline.arp as arp
+import whosonline.loops as loops
+import whosonline.neighbours as neighbours
+
+
+def neighbour(ip, state=neighbours.NUD_STALE):
+    return neighbours.Neighbour(ip, '02:00:00:00:00:05', 'eth0', state)
+
+
+class InScopeTest(unittest.TestCase):
+
+    def test_only_the_scanned_family(self):
+        self.assertTrue(neighbours.in_scope(neighbour('10.0.0.5'), '10.0.0.0/24'))
+        self.assertFalse(neighbours.in_scope(neighbour('10.0.1.5'), '10.0.0.0/24'))
+        self.assertFalse(neighbours.in_scope(neighbour('2001:db8::5'), '10.0.0.0/24'))
+        self.assertTrue(neighbours.in_scope(neighbour('2001:db8::5'), '2001:db8::/64'))
+
+    def test_in_network(self):
+        table = neighbours.NeighbourTable()
+        for ip in ('10.0.0.5', '2001:db8::5', 'fe80::5'):
+            table.entries[ip] = neighbour(ip)
+        self.assertEqual(
+            [entry.ip for entry in table.in_network('10.0.0.0/24')], ['10.0.0.5']
+        )
+
+
+class CheckHostTest(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = arp.TRANSPORT_FACTORY
+        self.table = loops.neighbour_table
+        arp.TRANSPORT_FACTORY = lambda interface: arp.FakeTransport(
+            {'10.0.0.5': '02:00:00:00:00:05'}
+        )
+        loops.neighbour_table = None
+
+    def tearDown(self):
+        arp.TRANSPORT_FACTORY = self.factory
+        loops.neighbour_table = self.table
+        arp.reset_engines()
+
+    def test_ipv6_is_not_handed_to_arp(self):
+        async def run():
+            return await loops.check_host('2001:db8::5', 'eth0')
+
+        self.assertEqual(asyncio.run(run()), (False, None))
+
+    def test_reachable_neighbours_are_not_probed(self):
+        loops.neighbour_table = neighbours.NeighbourTable()
+        loops.neighbour_table.entries['2001:db8::5'] = neighbour(
+            '2001:db8::5', neighbours.NUD_REACHABLE
+        )
+
+        async def run():
+            return await loops.check_host('2001:db8::5', 'eth0')
+
+        self.assertEqual(asyncio.run(run()), (True, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# test_nmapxml.py - the single-flight scan cache
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import unittest
+
+import whosonline.nmapxml as nmapxml
+import whosonline.results as results
+
+
+class FakeScan:
+    '''scan_func for ScanCache, fails the first `failures` calls'''
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = []
+
+    async def __call__(self, target, mode, check=False, **kwargs):
+        self.calls.append((target, mode, check))
+        await asyncio.sleep(0.01)
+        if len(self.calls) <= self.failures:
+            raise nmapxml.ScanFailed('nmap exited with 1')
+        return results.Host(online=True)
+
+
+class ScanCacheTest(unittest.TestCase):
+
+    def test_concurrent_scans_share_one_run(self):
+        scan = FakeScan()
+        cache = nmapxml.ScanCache(ttl=60, scan=scan)
+
+        async def run():
+            return await asyncio.gather(*[
+                cache.scan('10.0.0.2', '-O') for _ in range(3)
+            ])
+
+        answers = asyncio.run(run())
+        self.assertEqual(scan.calls, [('10.0.0.2', '-O', True)])
+        self.assertEqual([age for result, age in answers], [None, 0, 0])
+        self.assertTrue(all(result is answers[0][0] for result, age in answers))
+
+    def test_results_are_cached_until_ttl(self):
+        scan = FakeScan()
+        cache = nmapxml.ScanCache(ttl=60, scan=scan)
+
+        async def run():
+            first, _ = await cache.scan('10.0.0.2', '-O')
+            second, age = await cache.scan('10.0.0.2', '-O')
+            forced, forced_age = await cache.scan('10.0.0.2', '-O', force=True)
+            return first, second, age, forced_age
+
+        first, second, age, forced_age = asyncio.run(run())
+        self.assertIs(first, second)
+        self.assertIsNotNone(age)
+        self.assertIsNone(forced_age)
+        self.assertEqual(len(scan.calls), 2)
+
+    def test_failures_reach_every_waiter_and_are_not_cached(self):
+        scan = FakeScan(failures=1)
+        cache = nmapxml.ScanCache(ttl=60, scan=scan)
+
+        async def run():
+            failed = await asyncio.gather(
+                cache.scan('10.0.0.2', '-O'), cache.scan('10.0.0.2', '-O'),
+                return_exceptions=True
+            )
+            self.assertEqual(cache.cached('10.0.0.2', '-O'), (None, None))
+            self.assertFalse(cache.running('10.0.0.2', '-O'))
+            return failed, await cache.scan('10.0.0.2', '-O')
+
+        failed, (result, age) = asyncio.run(run())
+        self.assertTrue(all(isinstance(e, nmapxml.ScanFailed) for e in failed))
+        self.assertTrue(result.online)
+        self.assertIsNone(age)
+        self.assertEqual(len(scan.calls), 2)
+
+    def test_a_waiter_giving_up_keeps_the_scan(self):
+        scan = FakeScan()
+        cache = nmapxml.ScanCache(ttl=60, scan=scan)
+
+        async def run():
+            waiter = asyncio.ensure_future(cache.scan('10.0.0.2', '-O'))
+            await asyncio.sleep(0)
+            waiter.cancel()
+            result, age = await cache.scan('10.0.0.2', '-O')
+            return age
+
+        self.assertEqual(asyncio.run(run()), 0)
+        self.assertEqual(len(scan.calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
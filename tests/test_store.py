@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# test_store.py - the sqlite result store
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+import whosonline.store as store
+
+
+def fast_result(*ports):
+    return {
+        'online': True, 'MAC': '02:00:00:00:00:02',
+        'ports': [{'port': port, 'state': 'open', 'service': 'x'} for port in ports],
+    }
+
+
+class ResultStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'results.db')
+        # close() would wait for a full batch interval every time
+        self.flush_interval = store.FLUSH_INTERVAL
+        store.FLUSH_INTERVAL = 0.01
+
+    def tearDown(self):
+        store.FLUSH_INTERVAL = self.flush_interval
+        shutil.rmtree(self.directory)
+
+    def test_unusable_path_fails_instead_of_hanging(self):
+        outcome = []
+
+        def open_store():
+            try:
+                store.ResultStore(os.path.join(self.directory, 'missing', 'x.db'))
+            except sqlite3.Error as e:
+                outcome.append(e)
+
+        thread = threading.Thread(target=open_store, daemon=True)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), 'ResultStore() hangs')
+        self.assertEqual(len(outcome), 1)
+
+    def test_only_changes_are_written(self):
+        result_store = store.ResultStore(self.path)
+        result_store.record('fast', '10.0.0.2', fast_result('22/tcp'))
+        result_store.record('fast', '10.0.0.2', fast_result('22/tcp'))
+        result_store.record('fast', '10.0.0.2', fast_result('22/tcp', '80/tcp'))
+        result_store.record('os', '10.0.0.2', fast_result('22/tcp'))
+        result_store.record('os', '10.0.0.2', fast_result('22/tcp'))
+        result_store.close()
+        rows = result_store.history_sync('10.0.0.2')
+        self.assertEqual(sorted(row[1] for row in rows), ['fast', 'fast', 'os', 'os'])
+        latest = result_store.latest_sync('fast')
+        self.assertEqual(len(latest['10.0.0.2']['ports']), 2)
+
+    def test_last_state_survives_a_restart(self):
+        result_store = store.ResultStore(self.path)
+        result_store.record('arping', '10.0.0.2', online=True)
+        result_store.close()
+        result_store = store.ResultStore(self.path)
+        result_store.record('arping', '10.0.0.2', online=True)
+        result_store.record('arping', '10.0.0.2', online=False)
+        result_store.close()
+        rows = result_store.history_sync('10.0.0.2')
+        self.assertEqual([row[2] for row in rows], [0, 1])
+
+    def test_changes_lists_the_newest(self):
+        result_store = store.ResultStore(self.path)
+        for number in range(10):
+            result_store.record('arping', '10.0.0.%s' % number, online=True)
+        result_store.close()
+        rows = result_store.changes_since_sync(0, limit=3)
+        self.assertEqual([row[1] for row in rows], ['10.0.0.7', '10.0.0.8', '10.0.0.9'])
+
+    def test_prune_keeps_the_last_result(self):
+        result_store = store.ResultStore(self.path, retention_days=1)
+        result_store.record('arping', '10.0.0.2', online=True)
+        result_store.record('arping', '10.0.0.2', online=False)
+        result_store.close()
+        connection = sqlite3.connect(self.path)
+        with connection:
+            connection.execute('UPDATE results SET ts = ?', (time.time() - 3 * 86400,))
+        result_store._prune(connection)
+        connection.close()
+        rows = result_store.history_sync('10.0.0.2')
+        self.assertEqual([row[2] for row in rows], [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+#
+# arp.py - in-process arp sweeps over a single raw socket
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import socket
+import struct
+import time
+
+ETH_P_ARP = 0x0806
+ETH_P_IP = 0x0800
+SIOCGIFADDR = 0x8915
+
+BROADCAST_MAC = b'\xff' * 6
+ZERO_MAC = b'\x00' * 6
+
+ARP_REQUEST = 1
+ARP_REPLY = 2
+
+# ethernet header + arp payload for ipv4 over ethernet
+ETHER_HEADER = struct.Struct('!6s6sH')
+ARP_PAYLOAD = struct.Struct('!HHBBH6s4s6s4s')
+
+# frames sent in one go before yielding to the event loop
+SEND_BURST = 256
+# seconds before opening a transport is tried again after it failed, e.g.
+# because the interface was not up yet
+RETRY_UNAVAILABLE = 60
+
+
+class ArpUnavailable(Exception):
+    '''raised if no arp transport can be opened, callers fall back to the
+    arping shell command'''
+
+
+def mac_to_str(mac):
+    return ':'.join('%02x' % byte for byte in mac)
+
+
+def mac_from_str(mac):
+    return bytes(int(part, 16) for part in mac.split(':'))
+
+
+def build_frame(op, src_mac, src_ip, dst_mac, dst_ip, eth_dst=None):
+    '''build ethernet frame carrying an arp packet, ips given as strings'''
+    if eth_dst is None:
+        eth_dst = BROADCAST_MAC if op == ARP_REQUEST else dst_mac
+    return ETHER_HEADER.pack(eth_dst, src_mac, ETH_P_ARP) + ARP_PAYLOAD.pack(
+        1, ETH_P_IP, 6, 4, op,
+        src_mac, socket.inet_aton(src_ip),
+        dst_mac, socket.inet_aton(dst_ip)
+    )
+
+
+def build_request(src_mac, src_ip, dst_ip):
+    return build_frame(ARP_REQUEST, src_mac, src_ip, ZERO_MAC, dst_ip)
+
+
+def parse_frame(frame):
+    '''returns (op, sender_mac, sender_ip, target_ip) or None for frames
+    which are no ipv4 arp packets'''
+    if len(frame) < ETHER_HEADER.size + ARP_PAYLOAD.size:
+        return None
+    _, _, ethertype = ETHER_HEADER.unpack_from(frame)
+    if ethertype != ETH_P_ARP:
+        return None
+    htype, ptype, hlen, plen, op, sha, spa, tha, tpa = ARP_PAYLOAD.unpack_from(
+        frame, ETHER_HEADER.size
+    )
+    if ptype != ETH_P_IP or hlen != 6 or plen != 4:
+        return None
+    return op, sha, socket.inet_ntoa(spa), socket.inet_ntoa(tpa)
+
+
+class RawSocketTransport:
+    '''AF_PACKET socket bound to an interface, needs CAP_NET_RAW'''
+
+    def __init__(self, interface):
+        self.interface = interface
+        self.sock = None
+        self.mac = None
+        self.ip = '0.0.0.0'
+        self._loop = None
+
+    def open(self, on_frame):
+        try:
+            sock = socket.socket(
+                socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ARP)
+            )
+        except (AttributeError, OSError) as e:
+            raise ArpUnavailable('Unable to open raw socket: %s' % e)
+        try:
+            sock.bind((self.interface, ETH_P_ARP))
+        except OSError as e:
+            sock.close()
+            raise ArpUnavailable(
+                'Unable to bind to interface %s: %s' % (self.interface, e)
+            )
+        sock.setblocking(False)
+        self.sock = sock
+        self.mac = sock.getsockname()[4]
+        self.ip = self._interface_ip() or '0.0.0.0'
+
+        def on_readable():
+            while True:
+                try:
+                    frame = sock.recv(2048)
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError:
+                    return
+                on_frame(frame)
+
+        self._loop = asyncio.get_event_loop()
+        self._loop.add_reader(sock.fileno(), on_readable)
+
+    def _interface_ip(self):
+        import fcntl
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as inet_sock:
+            try:
+                result = fcntl.ioctl(
+                    inet_sock.fileno(), SIOCGIFADDR,
+                    struct.pack('256s', self.interface[:15].encode())
+                )
+            except OSError:
+                return None
+        return socket.inet_ntoa(result[20:24])
+
+    def send(self, frame):
+        '''returns False if the socket buffer is full'''
+        try:
+            self.sock.send(frame)
+        except (BlockingIOError, InterruptedError):
+            return False
+        return True
+
+    def close(self):
+        if self.sock is None:
+            return
+        self._loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+
+
+class FakeTransport:
+    '''In-memory stand in for a LAN. `hosts` maps ip to mac string, those
+    hosts answer requests after `latency` seconds. Used to exercise the
+    engine without privileges.'''
+
+    def __init__(self, hosts, mac='02:00:00:00:00:01', ip='10.0.0.1',
+                 latency=0.001):
+        self.hosts = hosts
+        self.mac = mac_from_str(mac)
+        self.ip = ip
+        self.latency = latency
+        self.sent = 0
+        self._on_frame = None
+
+    def open(self, on_frame):
+        self._on_frame = on_frame
+        self._loop = asyncio.get_event_loop()
+
+    def send(self, frame):
+        self.sent += 1
+        parsed = parse_frame(frame)
+        if parsed is None or parsed[0] != ARP_REQUEST:
+            return True
+        _, src_mac, src_ip, target_ip = parsed
+        if target_ip in self.hosts:
+            reply = build_frame(
+                ARP_REPLY, mac_from_str(self.hosts[target_ip]), target_ip,
+                src_mac, src_ip
+            )
+            self._loop.call_later(self.latency, self._deliver, reply)
+        return True
+
+    def _deliver(self, frame):
+        if self._on_frame is not None:
+            self._on_frame(frame)
+
+    def close(self):
+        self._on_frame = None
+
+
+class _Sweep:
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.found = {}
+        self.complete = asyncio.Event()
+
+
+class ArpEngine:
+    '''Sends arp requests for many hosts over one transport and matches
+    replies to all sweeps currently waiting for them.'''
+
+    def __init__(self, transport):
+        self.transport = transport
+        # ip -> set of sweeps interested in replies from ip
+        self._interest = {}
+        self.transport.open(self._on_frame)
+
+    def _on_frame(self, frame):
+        parsed = parse_frame(frame)
+        if parsed is None or parsed[0] != ARP_REPLY:
+            return
+        _, mac, ip, _ = parsed
+        mac = mac_to_str(mac)
+        for sweep in self._interest.get(ip, ()):
+            if ip not in sweep.found:
+                sweep.found[ip] = mac
+                if len(sweep.found) == len(sweep.targets):
+                    sweep.complete.set()
+
+    async def _send(self, ips):
+        src_mac = self.transport.mac
+        src_ip = self.transport.ip
+        for count, ip in enumerate(ips, 1):
+            frame = build_request(src_mac, src_ip, ip)
+            while not self.transport.send(frame):
+                await asyncio.sleep(0.001)
+            if count % SEND_BURST == 0:
+                await asyncio.sleep(0)
+
+    async def sweep(self, ips, timeout=1.0, retries=2):
+        '''ask for all ips, returns dict ip -> mac of hosts which replied.
+        Hosts not answering within `timeout` are asked again `retries`
+        times.'''
+        sweep = _Sweep(set(ips))
+        if not sweep.targets:
+            return {}
+        for ip in sweep.targets:
+            self._interest.setdefault(ip, set()).add(sweep)
+        try:
+            for attempt in range(retries + 1):
+                missing = [ip for ip in sweep.targets if ip not in sweep.found]
+                if not missing:
+                    break
+                await self._send(missing)
+                try:
+                    await asyncio.wait_for(sweep.complete.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for ip in sweep.targets:
+                interested = self._interest.get(ip)
+                interested.discard(sweep)
+                if not interested:
+                    del self._interest[ip]
+        return sweep.found
+
+    async def probe(self, ip, timeout=1.0, retries=2):
+        return ip in await self.sweep([ip], timeout, retries)
+
+    def close(self):
+        self.transport.close()
+
+
+# transport used for new engines, replace for testing, e.g.
+# arp.TRANSPORT_FACTORY = lambda interface: arp.FakeTransport(hosts)
+TRANSPORT_FACTORY = RawSocketTransport
+
+# (interface, loop) -> engine, or (ArpUnavailable raised when opening it,
+# monotonic time to try again)
+_engines = {}
+
+
+def get_engine(interface):
+    '''shared engine for interface on the running event loop'''
+    key = (interface, asyncio.get_event_loop())
+    engine = _engines.get(key)
+    if isinstance(engine, tuple) and time.monotonic() >= engine[1]:
+        engine = None
+    if engine is None:
+        try:
+            engine = ArpEngine(TRANSPORT_FACTORY(interface))
+        except ArpUnavailable as e:
+            engine = (e, time.monotonic() + RETRY_UNAVAILABLE)
+        _engines[key] = engine
+    if isinstance(engine, tuple):
+        raise engine[0]
+    return engine
+
+
+def reset_engines():
+    for engine in _engines.values():
+        if isinstance(engine, ArpEngine):
+            engine.close()
+    _engines.clear()
+
+
+async def arping(ip, interface, timeout=3, frame_count=3):
+    '''True if ip answers within timeout seconds, `frame_count` requests
+    are spread over that time. Raises ArpUnavailable without raw sockets.'''
+    engine = get_engine(interface)
+    frame_count = max(frame_count, 1)
+    return await engine.probe(
+        ip, timeout=timeout / frame_count, retries=frame_count - 1
+    )
+
+
+async def sweep(ips, interface, timeout=1.0, retries=2):
+    '''dict ip -> mac of all ips answering on interface'''
+    return await get_engine(interface).sweep(ips, timeout, retries)
+
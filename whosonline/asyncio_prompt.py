@@ -21,26 +21,45 @@ from prompt_toolkit.patch_stdout import patch_stdout
 from prompt_toolkit.formatted_text import FormattedText
 from prompt_toolkit import print_formatted_text
 from prompt_toolkit.completion.word_completer import WordCompleter
+from prompt_toolkit.styles import Style
 
 import asyncio
-import pprint
-import random
 import time
-import requests
-import webcolors
 
+import whosonline.cluster as cluster
+import whosonline.dashboard as dashboard
+import whosonline.hostindex as hostindex
+import whosonline.loops as loops
+import whosonline.metrics as metrics
 import whosonline.netcheck as netcheck
+import whosonline.nmapxml as nmapxml
+import whosonline.notifications as notifications
+import whosonline.process as process
+import whosonline.scheduler as scheduler
+import whosonline.store as store
 
 whosonline_completer = WordCompleter(
     words=[
         'exit', 'hosts', 'nmap', 'stop', 'annoy_calendar', 'os',
         'services', 'all', 'fast_nmap_loop', 'spawn_kevin',
-        'netcheck', 'probe'
+        'netcheck', 'probe', 'history', 'changes', 'since', 'processes',
+        'stats', 'dashboard', 'workers', 'refresh'
     ],
     ignore_case=True
 )
 
 NETWORK = '192.168.88.0/24'
+# stored changes the changes command shows at most, the newest
+CHANGES_LIMIT = 200
+
+# live host table replacing per host output, None unless switched on
+dashboard_view = None
+
+# background host discovery, its progress is shown below the prompt
+discovery = None
+
+# words of whosonline_completer, to add hostnames without scanning the list
+completer_words = set(whosonline_completer.words)
 
 
 welcome = '''
@@ -75,158 +94,285 @@ WhosOnline -- interactive wrapper arround nmap and other fun stuff
 '''
 
 
-async def syscall(command, debug=False):
+async def syscall(command, debug=False, timeout=None,
+                  priority=process.BACKGROUND):
+    """
+    Run command, returns (returncode, output). The child is killed with
+    its process group on timeout or if the awaiting task is cancelled.
+    It waits for a slot of the global process budget first, priority
+    process.INTERACTIVE gets ahead of background loops.
+    Use process.Command directly to act on output while it streams.
+    """
+    command = process.Command(command, timeout=timeout, priority=priority)
+    returncode, result = await command.run()
 
-    if isinstance(command, str):
-        command = command.split()
+    if debug and returncode != 0:
+        print('Failed: (pid = ' + str(command.pid) + ')')
+
+    return returncode, result
+
+
+async def nmap_scan(ip, mode='-F', priority=process.INTERACTIVE):
+    """
+    Scan a single host, nmap output is parsed from its xml format
+    """
+    return await nmapxml.nmap_scan(ip, mode, priority=priority)
 
-    process = await asyncio.create_subprocess_exec(
-        *command,
-        stdout=asyncio.subprocess.PIPE
-    )
 
-    # Wait for the subprocess to finish
-    stdout, stderr = await process.communicate()
-
-    if debug and process.returncode != 0:
-        print('Failed: (pid = ' + str(process.pid) + ')')
-
-    result = stdout.decode().strip()
-
-    return process.returncode, result
-
-
-async def nmap_scan(ip, mode='-F'):
-
-    result_d = {'ports': []}
-    cmd = ['nmap', ip, mode]
-    retcode, result = await syscall(cmd)
-    result = result.split('\n')
-
-    # parse nmap result
-    for line in result:
-        if 'Host is up' in line:
-            result_d['online'] = True
-            continue
-        elif 'Host seems down' in line:
-            result_d['online'] = False
-            break
-        if line and line[0].isdigit() and mode != '-sV':
-            port, state, service = line.split()
-            port_d = {
-                'port': port,
-                'state': state,
-                'service': service
-            }
-            result_d['ports'].append(port_d)
-        if line and line[0].isdigit() and mode == '-sV':
-            port, state, service, *version = line.split()
-            port_d = {
-                'port': port,
-                'state': state,
-                'service': service,
-                'version': ' '.join(version)
-            }
-            result_d['ports'].append(port_d)
-        if line.startswith('Running:'):
-            result_d['OS'] = line.split(': ')[1]
-        if line.startswith('MAC Address:'):
-            result_d['MAC'] = line.split(': ')[1]
-
-    return result_d
-
-
-async def scan_host_os(hostname):
-    scan_result = await nmap_scan(ip=hostname, mode='-O')
+async def show_history(host, hosts_d, limit=20):
+    """
+    Print stored results of host, given by hostname or ip
+    """
+    names = [host] + [ip for ip in hosts_d.stored() if hosts_d[ip] == host]
+    rows = []
+    for name in names:
+        rows += await loops.result_store.history(name, limit)
+    rows.sort(key=lambda row: row[0], reverse=True)
     print()
-    print('OS SCAN')
-    print('HOST %s SCANNED, RESULT FOLLOWS:' % hostname)
-    print(pprint.pformat(scan_result))
+    print('HISTORY OF HOST %s (newest first):' % host)
+    for ts, kind, online, mac, changed, data in rows[:limit]:
+        print(('* ' if changed else '  ') + store.format_row(ts, kind, online, mac, data))
     print()
 
 
-async def scan_host_services(hostname):
-    scan_result = await nmap_scan(ip=hostname, mode='-sV')
+async def show_changes(since):
+    """
+    Print stored results which differ from the previous one of their host
+    """
+    rows = await loops.result_store.changes_since(since, CHANGES_LIMIT)
     print()
-    print('SERVICES SCAN')
-    print('HOST %s SCANNED, RESULT FOLLOWS:' % hostname)
-    print(pprint.pformat(scan_result))
+    if len(rows) == CHANGES_LIMIT:
+        print('ONLY THE NEWEST %s CHANGES FOLLOW, narrow the time:' % len(rows))
+    else:
+        print('%s CHANGES FOLLOW:' % len(rows))
+    for ts, host, kind, online, mac, data in rows:
+        print('%s %s' % (host, store.format_row(ts, kind, online, mac, data)))
     print()
 
 
-async def probe_host(hostname):
-    scan_result = await nmap_scan(ip=hostname, mode='-PN')
+def show_processes():
+    """
+    Print usage of the global process budget
+    """
+    print()
+    print(str(process.EXECUTOR))
+    print()
+
+
+def toolbar(prompt):
+    """
+    Text below the prompt, discovery progress and the dashboard
+    """
+    size = prompt.app.output.get_size()
+    lines = []
+    if discovery is not None and not discovery.done:
+        lines.append(str(discovery))
+    if dashboard_view is not None:
+        # room for the prompt and completions
+        lines += dashboard_view.lines(
+            max_rows=max(size.rows - 8 - len(lines), 1), width=size.columns - 1
+        )
+    return '\n'.join(lines)
+
+
+def update_toolbar(prompt):
+    """
+    Show the toolbar while there is something to show in it
+    """
+    if dashboard_view is None and (discovery is None or discovery.done):
+        prompt.bottom_toolbar = None
+    else:
+        prompt.bottom_toolbar = lambda: toolbar(prompt)
+    prompt.app.invalidate()
+
+
+async def watch_discovery(prompt, interval=0.5):
+    """
+    Redraw the discovery progress until it is done
+    """
+    update_toolbar(prompt)
+    while not discovery.done:
+        await asyncio.sleep(interval)
+        prompt.app.invalidate()
+    update_toolbar(prompt)
+    fancy_print(str(discovery))
+
+
+def toggle_dashboard(prompt, hosts_d):
+    """
+    Switch the live host table below the prompt on or off. While it is on
+    the loops update the table instead of printing every result.
+    """
+    global dashboard_view
+    if dashboard_view is not None:
+        dashboard_view.close()
+        dashboard_view = None
+        update_toolbar(prompt)
+        return False
+
+    view = dashboard.Dashboard(on_frame=prompt.app.invalidate)
+    for ip in hosts_d.stored():
+        state = hosts_d.state(ip)
+        online = None if state == hostindex.STATE_UNKNOWN else state == hostindex.STATE_ONLINE
+        view.update(ip, hosts_d[ip], online, seen=hosts_d.seen(ip))
+
+    dashboard_view = view
+    update_toolbar(prompt)
+    return True
+
+
+def show_workers(coordinator):
+    """
+    Print the workers of the cluster and how far the scan cycle got
+    """
     print()
-    print('PROBING HOST SCAN')
+    if coordinator is None:
+        print('Not a coordinator, start with --listen to hand out scans')
+    else:
+        print(str(coordinator))
+    print()
+
+
+def show_stats():
+    """
+    Print all runtime metrics, see metrics.REGISTRY
+    """
+    print()
+    print('STATS FOLLOW:')
+    for line in metrics.REGISTRY.summary():
+        print(line)
+    print()
+
+
+def print_scan_result(title, hostname, scan_result):
+    import pprint
+    print()
+    print(title)
     print('HOST %s SCANNED, RESULT FOLLOWS:' % hostname)
-    print(pprint.pformat(scan_result))
+    print(pprint.pformat(scan_result.as_dict()))
     print()
 
 
-async def nmap_scan_loop(network, no_dns):
+async def cached_scan(title, kind, hostname, mode, refresh=False):
     """
-    Coroutine calling fast nmap scan for all known hosts
+    Scan hostname unless it was scanned with mode lately or is being
+    scanned right now, see nmapxml.ScanCache. refresh rescans anyway.
     """
-    while True:
-        ip_hosts = await get_hosts(network, no_dns)
-        print('%s hosts in network %s' % (len(ip_hosts), network))
-        for ip, host_d in ip_hosts.items():
-            scan_result = await nmap_scan(ip)
-            print()
-            print('HOST %s SCANNED, RESULT FOLLOWS:' % host_d['hostname'])
-            print(pprint.pformat(scan_result))
-            print()
-            online = scan_result['online']
-            # print('%s online: %s' % (host_d['hostname'], online))
-            ports = scan_result['ports']
-            # for port_d in ports:
-            # print(port_d)
-            await asyncio.sleep(1)
-
-        await asyncio.sleep(3)
-
-
-async def arping(ip, interface, timeout=3, frame_count=3):
-
-    command = 'arping -f -c {frame_count} -w {timeout} -I {interface} {ip}'.format(
-        frame_count=frame_count,
-        timeout=timeout,
-        interface=interface,
-        ip=ip
-    )
+    try:
+        scan_result, age = await nmapxml.SCAN_CACHE.scan(
+            hostname, mode, refresh, priority=process.INTERACTIVE
+        )
+    except OSError as e:
+        fancy_print('%s of %s failed: %s' % (title, hostname, e), color='ansired')
+        return
+    if age is None:
+        loops.store_result(kind, hostname, scan_result)
+    elif age > 0:
+        title = '%s FROM %d SECONDS AGO, ADD "refresh" TO RESCAN' % (title, age)
+    print_scan_result(title, hostname, scan_result)
 
-    retcode, output = await syscall(command.split())
 
-    return retcode == 0
+async def scan_host_os(hostname, refresh=False):
+    await cached_scan('OS SCAN', 'os', hostname, '-O', refresh)
 
 
-async def netcheck_loop(hosts_d, interface):
-    while True:
-        for ip in hosts_d:
-            hostname = hosts_d[ip]
-            ping_result = await arping(ip, interface)  # or ping(hostname)
-            print()
-            print('Host %s online: %s' % (hostname, ping_result))
-            print()
-            await asyncio.sleep(1)
+async def scan_host_services(hostname, refresh=False):
+    await cached_scan('SERVICES SCAN', 'services', hostname, '-sV', refresh)
 
 
-async def get_hosts(network, no_dns):
-    hosts = dict(
-        (ip, {'hostname': hostname})
-        for ip, hostname in netcheck.get_hostnames(network, filter_hosts=not no_dns)
-    )
-    return hosts
+async def probe_host(hostname, refresh=False):
+    await cached_scan('PROBING HOST SCAN', 'probe', hostname, '-PN', refresh)
+
+
+def show_hosts(hosts_d):
+    """
+    Print stored hosts with state and last seen time
+    """
+    states = {
+        hostindex.STATE_UNKNOWN: 'unknown',
+        hostindex.STATE_OFFLINE: 'offline',
+        hostindex.STATE_ONLINE: 'online',
+    }
+    now = time.time()
+    print()
+    for ip in sorted(hosts_d.stored(), key=hostindex.to_key):
+        last_seen = hosts_d.seen(ip)
+        if last_seen:
+            seen = '%ds ago' % (now - last_seen)
+        else:
+            seen = 'never'
+        print('%-16s %-24s %-8s last seen %s' % (
+            ip, hosts_d[ip], states[hosts_d.state(ip)], seen
+        ))
+    print()
+
 
+class ShellReporter(loops.Reporter):
+    """
+    Prints loop results above the prompt, or updates the dashboard instead
+    while it is switched on
+    """
 
-async def interactive_shell(loop, network, hosts_d, interface, no_dns):
+    def scan_cycle_started(self, network, hosts, incremental):
+        if dashboard_view is None:
+            super().scan_cycle_started(network, hosts, incremental)
+
+    def scan_result(self, ip, hostname, result, changes):
+        if dashboard_view is None:
+            return super().scan_result(ip, hostname, result, changes)
+        dashboard_view.update(
+            ip, hostname, result.online, ports=result.open_ports
+        )
+
+    def scan_cycle_done(self, timer, incremental):
+        if dashboard_view is None:
+            super().scan_cycle_done(timer, incremental)
+
+    def host_state(self, ip, hostname, online, rtt, changed):
+        if dashboard_view is None:
+            return super().host_state(ip, hostname, online, rtt, changed)
+        dashboard_view.update(ip, hostname, online, rtt=rtt)
+
+    def version_result(self, ip, hostname, result):
+        if dashboard_view is None:
+            super().version_result(ip, hostname, result)
+
+    def host_added(self, ip, hostname):
+        if hostname not in completer_words:
+            completer_words.add(hostname)
+            whosonline_completer.words.append(hostname)
+        if dashboard_view is not None:
+            dashboard_view.update(ip, hostname)
+
+
+shell_reporter = ShellReporter()
+
+
+async def interactive_shell(loop, network, hosts_d, interface, no_dns,
+                            scan_concurrency=scheduler.SCAN_CONCURRENCY,
+                            scan_interval=scheduler.SCAN_INTERVAL,
+                            scan_batch_size=nmapxml.BATCH_SIZE,
+                            probe='arp',
+                            incremental=False,
+                            poll_min_interval=scheduler.POLL_MIN_INTERVAL,
+                            poll_max_interval=scheduler.POLL_MAX_INTERVAL,
+                            show_dashboard=False,
+                            coordinator=None,
+                            version_concurrency=0):
     """
     """
     # Create Prompt.
     prompt = PromptSession(
         [('ansicyan', '(WhosOnline)>>> ')],
-        completer=whosonline_completer
+        completer=whosonline_completer,
+        # the dashboard lives in the toolbar, keep it readable
+        style=Style.from_dict({'bottom-toolbar': 'noreverse'})
     )
+    if show_dashboard:
+        toggle_dashboard(prompt, hosts_d)
+    discovery_task = None
+    if discovery is not None:
+        discovery_task = asyncio.ensure_future(watch_discovery(prompt))
 
     done = False
     # Patch stdout in something that will always print *above* the prompt when
@@ -242,6 +388,8 @@ async def interactive_shell(loop, network, hosts_d, interface, no_dns):
     while not done:
         try:
             result = await prompt.prompt_async()
+            if result:
+                loops.LOGGER.info('shell command %s', result, extra={'command': result})
             if result == 'exit':
                 fancy_print('Exiting shell, aborting tasks...')
                 done = True
@@ -252,10 +400,30 @@ async def interactive_shell(loop, network, hosts_d, interface, no_dns):
                     return_exceptions=True
                 )
             elif result == 'netcheck':
+                if result in tasks:
+                    fancy_print('Task allready running', color='ansired')
+                    continue
                 fancy_print('Starting netcheck loop...')
                 tasks['netcheck'] = asyncio.gather(
-                    netcheck_loop(hosts_d, interface)
+                    loops.netcheck_loop(
+                        hosts_d, interface, probe,
+                        poll_min_interval, poll_max_interval,
+                        reporter=shell_reporter
+                    )
                 )
+            elif result == 'hosts':
+                show_hosts(hosts_d)
+            elif result == 'processes':
+                show_processes()
+            elif result == 'workers':
+                show_workers(coordinator)
+            elif result == 'stats':
+                show_stats()
+            elif result == 'dashboard':
+                if toggle_dashboard(prompt, hosts_d):
+                    fancy_print('Dashboard on, type "dashboard" again to switch it off')
+                else:
+                    fancy_print('Dashboard off')
             elif result.startswith('stop'):
                 command = result.split()
                 if len(command) != 2:
@@ -279,7 +447,12 @@ async def interactive_shell(loop, network, hosts_d, interface, no_dns):
                     continue
                 fancy_print('Sheduling fast_nmap_loop to check for hosts online/offline')
                 tasks['fast_nmap_loop'] = asyncio.gather(
-                    nmap_scan_loop(network, no_dns)
+                    loops.nmap_scan_loop(
+                        network, no_dns, scan_concurrency, scan_interval,
+                        scan_batch_size, incremental, reporter=shell_reporter,
+                        coordinator=coordinator,
+                        version_concurrency=version_concurrency
+                    )
                     # return_exceptions=True
                 )
             elif result == 'annoy_calendar':
@@ -290,37 +463,64 @@ async def interactive_shell(loop, network, hosts_d, interface, no_dns):
                 tasks['annoy_calendar'] = asyncio.gather(annoy_calendar())
             elif result.startswith('nmap os'):
                 command = result.split()
-                if len(command) != 3:
-                    fancy_print('Type "nmap os <HOSTNAME>"', color='ansired')
+                if len(command) not in (3, 4) or command[3:] not in ([], ['refresh']):
+                    fancy_print('Type "nmap os <HOSTNAME> [refresh]"', color='ansired')
                     continue
-                host = command[-1]
-                os_scan_task = asyncio.gather(scan_host_os(host))
+                host = command[2]
+                os_scan_task = asyncio.gather(scan_host_os(host, len(command) == 4))
                 fancy_print('OS scan on host %s sheduled, expect results...' % host)
             elif result.startswith('nmap services'):
                 command = result.split()
-                if len(command) != 3:
-                    fancy_print('Type "nmap services <HOSTNAME>"', color='ansired')
+                if len(command) not in (3, 4) or command[3:] not in ([], ['refresh']):
+                    fancy_print('Type "nmap services <HOSTNAME> [refresh]"', color='ansired')
                     continue
-                host = command[-1]
-                os_scan_task = asyncio.gather(scan_host_services(host))
+                host = command[2]
+                os_scan_task = asyncio.gather(scan_host_services(host, len(command) == 4))
                 fancy_print('Services scan on host %s sheduled, expect results...' % host)
             elif result.startswith('nmap probe'):
                 command = result.split()
-                if len(command) != 3:
-                    fancy_print('Type "nmap probe <HOSTNAME>"', color='ansired')
+                if len(command) not in (3, 4) or command[3:] not in ([], ['refresh']):
+                    fancy_print('Type "nmap probe <HOSTNAME> [refresh]"', color='ansired')
                     continue
-                host = command[-1]
-                os_scan_task = asyncio.gather(probe_host(host))
+                host = command[2]
+                os_scan_task = asyncio.gather(probe_host(host, len(command) == 4))
                 fancy_print('Probing scan on host %s sheduled, expect results...' % host)
+            elif result.startswith('history'):
+                command = result.split()
+                if len(command) != 2:
+                    fancy_print('Type "history <HOSTNAME>"', color='ansired')
+                    continue
+                if loops.result_store is None:
+                    fancy_print('No result store configured', color='ansired')
+                    continue
+                await show_history(command[1], hosts_d)
+            elif result.startswith('changes'):
+                command = result.split(maxsplit=2)
+                if len(command) != 3 or command[1] != 'since':
+                    fancy_print('Type "changes since <TIME>", e.g. 2h or 2018-01-31', color='ansired')
+                    continue
+                if loops.result_store is None:
+                    fancy_print('No result store configured', color='ansired')
+                    continue
+                try:
+                    since = store.parse_since(command[2])
+                except ValueError as e:
+                    fancy_print(str(e), color='ansired')
+                    continue
+                await show_changes(since)
 
 
         except (EOFError, KeyboardInterrupt):
             for task in tasks.values():
                 task.cancel()
+            if discovery_task is not None:
+                discovery_task.cancel()
             return
 
     for task in tasks.values():
         task.cancel()
+    if discovery_task is not None:
+        discovery_task.cancel()
 
     loop.stop()
 
@@ -329,15 +529,58 @@ def fancy_print(text, color='ansiyellow'):
     print_formatted_text(FormattedText([(color, '\n' + text)]))
 
 
-def main(network, no_dns, f_interface):
+def main(network, no_dns, f_interface,
+         scan_concurrency=scheduler.SCAN_CONCURRENCY,
+         scan_interval=scheduler.SCAN_INTERVAL,
+         scan_batch_size=nmapxml.BATCH_SIZE,
+         probe='arp',
+         passive=False,
+         incremental=False,
+         store_path=store.DEFAULT_PATH,
+         store_days=store.RETENTION_DAYS,
+         poll_min_interval=scheduler.POLL_MIN_INTERVAL,
+         poll_max_interval=scheduler.POLL_MAX_INTERVAL,
+         max_processes=process.MAX_PROCESSES,
+         metrics_file=None,
+         metrics_port=None,
+         show_dashboard=False,
+         listen=None,
+         shards=cluster.SHARDS,
+         local_workers=0,
+         notify=notifications.DEFAULT_SINKS,
+         version_concurrency=0,
+         scan_cache_ttl=nmapxml.SCAN_CACHE_TTL):
+    global discovery
+    coordinator = None
+    workers_task = None
+    bus = notifications.BUS
     # Tell prompt_toolkit to use the asyncio event loop.
     try:
         with patch_stdout():
 
             loop = asyncio.get_event_loop()
+            process.configure(max_processes)
+            nmapxml.SCAN_CACHE.ttl = scan_cache_ttl
 
-            interface = netcheck.get_netdevice(network.split('/')[0])  # cut off cidr netmask
-            if not interface:
+            networks = hostindex.parse_networks(network)
+            # route table and reverse dns are read off the loop thread
+            interface = loop.run_until_complete(
+                netcheck.async_get_netdevice(networks[0])
+            )
+            routes_task = asyncio.ensure_future(netcheck.ROUTES.watch())
+            lag_task = asyncio.ensure_future(metrics.watch_loop_lag())
+            bus = notifications.configure(notify)
+            bus.start()
+            if metrics_file:
+                export_task = asyncio.ensure_future(
+                    metrics.export_textfile(metrics_file)
+                )
+            if metrics_port:
+                loop.run_until_complete(metrics.serve(metrics_port))
+                print('metrics on http://%s:%s/metrics' % (
+                    metrics.METRICS_PORT_HOST, metrics_port
+                ))
+            if not interface and probe != 'icmp':
                 if f_interface:
                     interface = f_interface
                 else:
@@ -345,22 +588,58 @@ def main(network, no_dns, f_interface):
                         'Can not continue without interface. Try to specify using "-i" argument'
                     )
             print('interface is %s' % interface)
+            if listen:
+                coordinator, workers_task = loop.run_until_complete(cluster.start(
+                    network, listen, shards, local_workers, scan_batch_size,
+                    scan_concurrency, max_processes
+                ))
+                print('coordinator listening on %s:%s' % cluster.parse_address(listen))
+            if store_path:
+                loops.result_store = store.ResultStore(store_path, store_days)
             # SETUP SHELL
-            # add hostnames add completer
-            hosts_d = {
-                ip: hostname for ip, hostname in netcheck.get_hostnames(network, filter_hosts=not no_dns)
-            }
-            whosonline_completer.words += list(hosts_d.values())
+            # hosts are added to hosts_d and the completer as they resolve,
+            # the prompt does not wait for it
+            hosts_d = loops.new_hosts(network, no_dns)
+            discovery = loops.Discovery(
+                network, hosts_d, no_dns, shell_reporter
+            )
+            discovery_run = asyncio.ensure_future(discovery.run())
+            if passive:
+                passive_task = loops.start_passive_discovery(
+                    network, hosts_d, no_dns, shell_reporter
+                )
 
             # start shell
             shell_task = asyncio.ensure_future(
-                interactive_shell(loop, network, hosts_d, interface, no_dns)
+                interactive_shell(
+                    loop, network, hosts_d, interface, no_dns,
+                    scan_concurrency=scan_concurrency,
+                    scan_interval=scan_interval,
+                    scan_batch_size=scan_batch_size,
+                    probe=probe,
+                    incremental=incremental,
+                    poll_min_interval=poll_min_interval,
+                    poll_max_interval=poll_max_interval,
+                    show_dashboard=show_dashboard,
+                    coordinator=coordinator,
+                    version_concurrency=version_concurrency
+                )
             )
             loop.run_until_complete(shell_task)
 
     except Exception as e:
         print(e)
         # pass  # stfu
+    finally:
+        asyncio.get_event_loop().run_until_complete(bus.stop())
+        if workers_task is not None:
+            # terminates the local worker processes
+            workers_task.cancel()
+            loop.run_until_complete(asyncio.gather(workers_task, return_exceptions=True))
+        if coordinator is not None:
+            coordinator.close()
+        if loops.result_store is not None:
+            loops.result_store.close()
 
 
 if __name__ == '__main__':
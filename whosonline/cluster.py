@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+#
+# cluster.py - fast nmap scans spread over worker processes, on this
+# machine or on other nodes. The coordinator splits the address space into
+# shards, workers pull shards and stream back their results.
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+The protocol is one json object per line over tcp:
+
+    worker      -> coordinator  {"type": "hello", "name": ..., "concurrency": ...}
+    coordinator -> worker       {"type": "shard", "cycle": 1, "shard": 3,
+                                 "ranges": [[first, last], ...],
+                                 "mode": "-F", "batch_size": 16}
+    worker      -> coordinator  {"type": "result", "cycle": 1, "shard": 3,
+                                 "ip": ..., "result": {...}}
+    worker      -> coordinator  {"type": "done", "cycle": 1, "shard": 3}
+
+ranges are integer keys as in hostindex, result is a results.Host as dict.
+Workers take one shard at a time, so faster workers get more of them. If
+a worker goes away or stays silent for SHARD_TIMEOUT seconds, its shard
+is handed to the next free worker, hosts already reported are not
+reported twice. There is no authentication, only listen on trusted
+networks.
+'''
+
+import asyncio
+import json
+import os
+import socket
+import sys
+
+import whosonline.hostindex as hostindex
+import whosonline.metrics as metrics
+import whosonline.nmapxml as nmapxml
+import whosonline.process as process
+import whosonline.results as results
+import whosonline.scheduler as scheduler
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 7461
+
+# shards per cycle, more shards than workers keep the load even
+SHARDS = 16
+
+# seconds a worker may stay silent while it has a shard
+SHARD_TIMEOUT = 300
+
+# seconds before a worker reconnects, and before a local worker restarts
+RETRY_INTERVAL = 5
+
+# longest message line accepted
+MESSAGE_LIMIT = 1 << 20
+
+SHARDS_REQUEUED = metrics.Counter(
+    'whosonline_cluster_shards_requeued_total',
+    'Shards handed to another worker after theirs went away'
+)
+
+
+def log(text):
+    '''stdout may carry daemon events, diagnostics go to stderr'''
+    print(text, file=sys.stderr, flush=True)
+
+
+def parse_address(address, default_host=DEFAULT_HOST):
+    '''(host, port) from "host:port" or "port"'''
+    host, _, port = str(address).rpartition(':')
+    return host.strip('[]') or default_host, int(port)
+
+
+def send(writer, message):
+    writer.write(json.dumps(message).encode() + b'\n')
+
+
+async def receive(reader, timeout=None):
+    '''next message, None if the peer closed the connection'''
+    line = await asyncio.wait_for(reader.readline(), timeout)
+    if not line:
+        return None
+    return json.loads(line.decode())
+
+
+class WorkerInfo:
+
+    __slots__ = ('name', 'concurrency', 'shard', 'shards_done', 'results')
+
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self.shard = None
+        self.shards_done = 0
+        self.results = 0
+
+    def __str__(self):
+        return '%s: %s shards, %s hosts, %s' % (
+            self.name, self.shards_done, self.results,
+            'idle' if self.shard is None else 'scanning shard %s' % self.shard
+        )
+
+
+class Coordinator:
+    '''Hands out the shards of network to connected workers. scan() runs
+    one cycle over the whole address space and merges what the workers
+    report into one stream.'''
+
+    def __init__(self, network, shards=SHARDS, mode='-F',
+                 batch_size=nmapxml.BATCH_SIZE, shard_timeout=SHARD_TIMEOUT):
+        self.space = hostindex.address_space(network)
+        self.shards = max(1, min(shards, len(self.space)))
+        self.mode = mode
+        self.batch_size = batch_size
+        self.shard_timeout = shard_timeout
+        self.workers = {}
+        self.cycle = 0
+        self.server = None
+        # (cycle, shard) waiting for a worker
+        self._pending = asyncio.Queue()
+        self._results = None
+        self._left = set()
+        # shard -> keys already reported this cycle
+        self._delivered = {}
+
+    def __str__(self):
+        lines = ['%s workers, cycle %s: %s/%s shards done, %s requeued' % (
+            len(self.workers), self.cycle, self.shards - len(self._left),
+            self.shards, SHARDS_REQUEUED.get()
+        )]
+        lines += ['  %s' % worker for worker in self.workers.values()]
+        return '\n'.join(lines)
+
+    async def listen(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.server = await asyncio.start_server(
+            self._handle, host, port, limit=MESSAGE_LIMIT
+        )
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    async def scan(self):
+        '''async generator yielding (ip, results.Host) for every address of
+        the space, in order of completion'''
+        while not self._pending.empty():
+            # left over from a cancelled cycle
+            self._pending.get_nowait()
+        self.cycle += 1
+        self._results = asyncio.Queue()
+        self._left = set(range(self.shards))
+        self._delivered = {}
+        for shard in range(self.shards):
+            self._pending.put_nowait((self.cycle, shard))
+        while True:
+            item = await self._results.get()
+            if item is None:
+                return
+            yield item
+
+    def _requeue(self, cycle, shard):
+        if cycle == self.cycle and shard in self._left:
+            SHARDS_REQUEUED.inc()
+            self._pending.put_nowait((cycle, shard))
+
+    def _result(self, cycle, shard, ip, result_d):
+        if cycle != self.cycle or shard not in self._left:
+            return False
+        delivered = self._delivered.setdefault(shard, set())
+        key = hostindex.to_key(ip)
+        if key in delivered:
+            return False
+        delivered.add(key)
+        self._results.put_nowait((ip, results.Host.from_dict(result_d)))
+        return True
+
+    async def _next_shard(self, reader):
+        '''(cycle, shard) for the worker on reader, None if it went away
+        while waiting. Idle workers send nothing, anything read is eof.'''
+        while True:
+            get = asyncio.ensure_future(self._pending.get())
+            eof = asyncio.ensure_future(reader.readline())
+            done, _ = await asyncio.wait(
+                (get, eof), return_when=asyncio.FIRST_COMPLETED
+            )
+            if eof in done:
+                # a connection reset counts as eof as well
+                eof.exception()
+                if get in done:
+                    self._pending.put_nowait(get.result())
+                else:
+                    get.cancel()
+                return None
+            eof.cancel()
+            cycle, shard = get.result()
+            if cycle == self.cycle and shard in self._left:
+                return cycle, shard
+
+    def _done(self, cycle, shard):
+        if cycle != self.cycle or shard not in self._left:
+            return
+        self._left.discard(shard)
+        self._delivered.pop(shard, None)
+        if not self._left:
+            self._results.put_nowait(None)
+
+    async def _handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        worker = None
+        current = None
+        try:
+            hello = await receive(reader, self.shard_timeout)
+            if not hello or hello.get('type') != 'hello':
+                return
+            name = '%s (%s)' % (hello.get('name'), peer[0] if peer else '?')
+            worker = self.workers[name] = WorkerInfo(name, hello.get('concurrency'))
+            while True:
+                current = await self._next_shard(reader)
+                if current is None:
+                    return
+                cycle, shard = current
+                worker.shard = shard
+                send(writer, {
+                    'type': 'shard', 'cycle': cycle, 'shard': shard,
+                    'ranges': self.space.shard_ranges(shard, self.shards),
+                    'mode': self.mode, 'batch_size': self.batch_size,
+                })
+                await writer.drain()
+                while True:
+                    message = await receive(reader, self.shard_timeout)
+                    if message is None:
+                        return
+                    if message.get('type') == 'result':
+                        if self._result(cycle, shard, message['ip'], message['result']):
+                            worker.results += 1
+                    elif message.get('type') == 'done':
+                        self._done(cycle, shard)
+                        break
+                current = None
+                worker.shard = None
+                worker.shards_done += 1
+        except (asyncio.TimeoutError, ConnectionError, ValueError, KeyError) as e:
+            log('Worker %s dropped: %s' % (worker.name if worker else peer, e))
+        finally:
+            if current is not None:
+                self._requeue(*current)
+            if worker is not None:
+                self.workers.pop(worker.name, None)
+            writer.close()
+
+
+async def work(host, port, name=None, concurrency=scheduler.SCAN_CONCURRENCY,
+               retry=RETRY_INTERVAL, reconnect=True):
+    '''Worker: scan the shards handed out by the coordinator at host:port,
+    reconnecting whenever the connection is lost, until cancelled. Without
+    reconnect it returns once the coordinator is gone.'''
+    name = name or '%s:%s' % (socket.gethostname(), os.getpid())
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(
+                host, port, limit=MESSAGE_LIMIT
+            )
+        except OSError as e:
+            log('Unable to reach coordinator %s:%s: %s' % (host, port, e))
+            if not reconnect:
+                return
+            await asyncio.sleep(retry)
+            continue
+        try:
+            send(writer, {'type': 'hello', 'name': name, 'concurrency': concurrency})
+            while True:
+                message = await receive(reader)
+                if message is None:
+                    break
+                if message.get('type') != 'shard':
+                    continue
+                await _scan_shard(writer, message, concurrency)
+        except (ConnectionError, ValueError) as e:
+            log('Lost coordinator %s:%s: %s' % (host, port, e))
+        finally:
+            writer.close()
+        if not reconnect:
+            return
+        await asyncio.sleep(retry)
+
+
+async def _scan_shard(writer, message, concurrency):
+    ips = (
+        hostindex.from_key(key)
+        for first, last in message['ranges']
+        for key in range(first, last + 1)
+    )
+    reply = {'type': 'result', 'cycle': message['cycle'], 'shard': message['shard']}
+    scan = nmapxml.scan_many(
+        ips, message['mode'], message['batch_size'], concurrency
+    )
+    async for ip, result in scan:
+        reply['ip'] = ip
+        reply['result'] = result.as_dict()
+        send(writer, reply)
+        await writer.drain()
+    send(writer, {'type': 'done', 'cycle': message['cycle'], 'shard': message['shard']})
+    await writer.drain()
+
+
+def worker_main(address, scan_concurrency=scheduler.SCAN_CONCURRENCY,
+                max_processes=process.MAX_PROCESSES, name=None, reconnect=True):
+    host, port = parse_address(address)
+    process.configure(max_processes)
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(work(
+            host, port, name, scan_concurrency, reconnect=reconnect
+        ))
+    except KeyboardInterrupt:
+        pass
+
+
+class LocalWorkers:
+    '''Worker processes on this machine, restarted if they die. They do
+    not reconnect on their own, so none is left behind with the
+    coordinator gone.'''
+
+    def __init__(self, count, address, scan_concurrency=scheduler.SCAN_CONCURRENCY,
+                 max_processes=process.MAX_PROCESSES):
+        self.count = count
+        self.address = address
+        self.scan_concurrency = scan_concurrency
+        self.max_processes = max_processes
+        self.processes = []
+
+    async def _supervise(self, number):
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            path for path in (package_dir, env.get('PYTHONPATH')) if path
+        )
+        while True:
+            child = await asyncio.create_subprocess_exec(
+                sys.executable, '-m', 'whosonline.cluster', '%s:%s' % self.address,
+                '--scan-concurrency', str(self.scan_concurrency),
+                '--max-processes', str(self.max_processes),
+                '--name', '%s/local-%s' % (socket.gethostname(), number),
+                '--no-reconnect', env=env, stdout=sys.stderr
+            )
+            self.processes.append(child)
+            try:
+                returncode = await child.wait()
+            finally:
+                self.processes.remove(child)
+                if child.returncode is None:
+                    child.terminate()
+            log('Local worker %s exited with %s, restarting' % (number, returncode))
+            await asyncio.sleep(RETRY_INTERVAL)
+
+    async def run(self):
+        await asyncio.gather(*[
+            self._supervise(number) for number in range(self.count)
+        ])
+
+
+async def start(network, listen, shards=SHARDS, local_workers=0,
+                batch_size=nmapxml.BATCH_SIZE,
+                scan_concurrency=scheduler.SCAN_CONCURRENCY,
+                max_processes=process.MAX_PROCESSES):
+    '''Coordinator listening on listen ("host:port" or "port", port 0 picks
+    a free one), returns (coordinator, task running the local workers or
+    None)'''
+    coordinator = Coordinator(network, shards, batch_size=batch_size)
+    server = await coordinator.listen(*parse_address(listen))
+    # the port actually bound, listen may have asked for any free one
+    address = server.sockets[0].getsockname()[:2]
+    workers_task = None
+    if local_workers:
+        workers = LocalWorkers(local_workers, address, scan_concurrency, max_processes)
+        workers_task = asyncio.ensure_future(workers.run())
+    return coordinator, workers_task
+
+
+if __name__ == '__main__':
+    # local worker started by LocalWorkers
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('address')
+    parser.add_argument('--scan-concurrency', type=int, default=scheduler.SCAN_CONCURRENCY)
+    parser.add_argument('--max-processes', type=int, default=process.MAX_PROCESSES)
+    parser.add_argument('--name')
+    parser.add_argument('--no-reconnect', action='store_true')
+    args = parser.parse_args()
+    worker_main(
+        args.address, args.scan_concurrency, args.max_processes, args.name,
+        not args.no_reconnect
+    )
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+#
+# daemon.py - headless mode, runs the scan loops and writes one json object
+# per event. Does not import the interactive stack.
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+import whosonline.cluster as cluster
+import whosonline.hostindex as hostindex
+import whosonline.loops as loops
+import whosonline.metrics as metrics
+import whosonline.netcheck as netcheck
+import whosonline.nmapxml as nmapxml
+import whosonline.notifications as notifications
+import whosonline.process as process
+import whosonline.scheduler as scheduler
+import whosonline.store as store
+
+# seconds events are collected before they are written
+FLUSH_INTERVAL = 1.0
+# events written at once at most, more wake the writer early
+BATCH_SIZE = 1000
+
+
+def log(text):
+    '''diagnostics go to stderr, stdout belongs to the events'''
+    print(text, file=sys.stderr, flush=True)
+
+
+class JsonLinesWriter:
+    '''Collects events and writes them as json lines in batches, from a
+    worker thread so a slow reader never blocks the event loop. `path` is
+    a file name, or '-' for stdout.'''
+
+    def __init__(self, path='-', flush_interval=FLUSH_INTERVAL,
+                 batch_size=BATCH_SIZE):
+        if path == '-':
+            self.file = sys.stdout
+        else:
+            self.file = open(os.path.expanduser(path), 'a')
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.written = 0
+        self._buffer = []
+        self._wakeup = asyncio.Event()
+        self._lock = threading.Lock()
+
+    def emit(self, event):
+        event.setdefault('ts', round(time.time(), 3))
+        self._buffer.append(json.dumps(event))
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def _write(self, lines):
+        with self._lock:
+            self.file.write('\n'.join(lines) + '\n')
+            self.file.flush()
+            self.written += len(lines)
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._write, lines)
+
+    async def run(self):
+        '''write batches until cancelled'''
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def close(self):
+        '''write what is left, blocking'''
+        lines, self._buffer = self._buffer, []
+        if lines:
+            self._write(lines)
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class JsonReporter(loops.Reporter):
+    '''Turns loop results into events. Like the shell, incremental scans
+    and netcheck only report changes.'''
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def scan_cycle_started(self, network, hosts, incremental):
+        self.writer.emit({
+            'event': 'cycle_start', 'loop': 'fast_nmap_loop',
+            'network': str(network), 'hosts': len(hosts),
+        })
+
+    def scan_result(self, ip, hostname, result, changes):
+        if changes is not None and not changes:
+            return
+        event = {'event': 'scan', 'ip': ip, 'host': hostname}
+        event.update(result.as_dict())
+        if changes is not None:
+            event['changes'] = changes
+        self.writer.emit(event)
+
+    def scan_cycle_done(self, timer, incremental):
+        self.writer.emit({
+            'event': 'cycle', 'loop': 'fast_nmap_loop',
+            'hosts': timer.count, 'seconds': round(timer.elapsed, 3),
+        })
+
+    def host_state(self, ip, hostname, online, rtt, changed):
+        if not changed:
+            return
+        self.writer.emit({
+            'event': 'state', 'ip': ip, 'host': hostname, 'online': online,
+            'rtt': None if rtt is None else round(rtt, 6),
+        })
+
+    def host_added(self, ip, hostname):
+        self.writer.emit({'event': 'discovered', 'ip': ip, 'host': hostname})
+
+    def version_result(self, ip, hostname, result):
+        event = {'event': 'services', 'ip': ip, 'host': hostname}
+        event.update(result.as_dict())
+        self.writer.emit(event)
+
+
+async def run(network, no_dns, interface, writer, run_loops=loops.LOOPS,
+              scan_concurrency=scheduler.SCAN_CONCURRENCY,
+              scan_interval=scheduler.SCAN_INTERVAL,
+              scan_batch_size=nmapxml.BATCH_SIZE,
+              probe='arp',
+              passive=False,
+              incremental=False,
+              poll_min_interval=scheduler.POLL_MIN_INTERVAL,
+              poll_max_interval=scheduler.POLL_MAX_INTERVAL,
+              coordinator=None,
+              version_concurrency=0):
+    '''run the chosen loops until cancelled'''
+    reporter = JsonReporter(writer)
+    hosts_d = await loops.get_hosts(network, no_dns)
+    tasks = [writer.run()]
+    if passive:
+        tasks.append(loops.start_passive_discovery(
+            network, hosts_d, no_dns, reporter
+        ))
+    if 'fast_nmap_loop' in run_loops:
+        tasks.append(loops.nmap_scan_loop(
+            network, no_dns, scan_concurrency, scan_interval,
+            scan_batch_size, incremental, reporter=reporter,
+            coordinator=coordinator, version_concurrency=version_concurrency
+        ))
+    if 'netcheck' in run_loops:
+        tasks.append(loops.netcheck_loop(
+            hosts_d, interface, probe, poll_min_interval, poll_max_interval,
+            reporter=reporter
+        ))
+    writer.emit({
+        'event': 'started', 'network': str(network), 'loops': list(run_loops),
+        'hosts': hosts_d.stored_count,
+    })
+    await asyncio.gather(*tasks)
+
+
+def main(network, no_dns, f_interface,
+         run_loops=loops.LOOPS,
+         output='-',
+         scan_concurrency=scheduler.SCAN_CONCURRENCY,
+         scan_interval=scheduler.SCAN_INTERVAL,
+         scan_batch_size=nmapxml.BATCH_SIZE,
+         probe='arp',
+         passive=False,
+         incremental=False,
+         store_path=store.DEFAULT_PATH,
+         store_days=store.RETENTION_DAYS,
+         poll_min_interval=scheduler.POLL_MIN_INTERVAL,
+         poll_max_interval=scheduler.POLL_MAX_INTERVAL,
+         max_processes=process.MAX_PROCESSES,
+         metrics_file=None,
+         metrics_port=None,
+         listen=None,
+         shards=cluster.SHARDS,
+         local_workers=0,
+         notify=notifications.DEFAULT_SINKS,
+         version_concurrency=0):
+    loop = asyncio.get_event_loop()
+    process.configure(max_processes)
+    background = [
+        asyncio.ensure_future(netcheck.ROUTES.watch()),
+        asyncio.ensure_future(metrics.watch_loop_lag()),
+    ]
+    if metrics_file:
+        background.append(asyncio.ensure_future(metrics.export_textfile(metrics_file)))
+    writer = JsonLinesWriter(output)
+    coordinator = None
+    bus = notifications.BUS
+    try:
+        bus = notifications.configure(notify)
+        bus.start()
+        if metrics_port:
+            loop.run_until_complete(metrics.serve(metrics_port))
+        networks = hostindex.parse_networks(network)
+        interface = loop.run_until_complete(
+            netcheck.async_get_netdevice(networks[0])
+        ) or f_interface
+        if not interface and probe != 'icmp' and 'netcheck' in run_loops:
+            raise RuntimeError(
+                'Can not continue without interface. Try to specify using "-i" argument'
+            )
+        log('whosonline daemon: network %s, interface %s, loops %s' % (
+            network, interface, ', '.join(run_loops)
+        ))
+        if listen:
+            coordinator, workers_task = loop.run_until_complete(cluster.start(
+                network, listen, shards, local_workers, scan_batch_size,
+                scan_concurrency, max_processes
+            ))
+            if workers_task is not None:
+                background.append(workers_task)
+            log('whosonline daemon: coordinator listening on %s:%s' % (
+                cluster.parse_address(listen)
+            ))
+        if store_path:
+            loops.result_store = store.ResultStore(store_path, store_days)
+
+        task = asyncio.ensure_future(run(
+            network, no_dns, interface, writer, run_loops,
+            scan_concurrency, scan_interval, scan_batch_size, probe,
+            passive, incremental, poll_min_interval, poll_max_interval,
+            coordinator, version_concurrency
+        ))
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, task.cancel)
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            log('whosonline daemon: stopping')
+    except Exception as e:
+        log('whosonline daemon: %s' % e)
+        return 1
+    finally:
+        for future in background:
+            future.cancel()
+        loop.run_until_complete(asyncio.gather(*background, return_exceptions=True))
+        loop.run_until_complete(bus.stop())
+        if coordinator is not None:
+            coordinator.close()
+        writer.close()
+        if loops.result_store is not None:
+            loops.result_store.close()
+    return 0
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+# dashboard.py - table of hosts kept up to date from scan results, redrawn
+# at a capped frame rate instead of printing every result
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import time
+
+# redraws per second at most
+MAX_FPS = 2
+
+# table rows shown if the caller does not know the terminal size
+MAX_ROWS = 20
+
+HEADER = '%-16s %-20s %-7s %-10s %-8s %s' % (
+    'IP', 'HOST', 'STATE', 'SEEN', 'RTT', 'OPEN PORTS'
+)
+
+_UNCHANGED = object()
+
+
+class Row:
+
+    __slots__ = ('ip', 'hostname', 'online', 'last_seen', 'ports', 'rtt', 'text')
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.hostname = ip
+        self.online = None
+        self.last_seen = 0.0
+        self.ports = ()
+        self.rtt = None
+        # rendered line without the seen column, None if outdated
+        self.text = None
+
+
+def _ago(seconds):
+    if seconds < 60:
+        return '%ds ago' % seconds
+    if seconds < 3600:
+        return '%dm ago' % (seconds // 60)
+    if seconds < 86400:
+        return '%dh ago' % (seconds // 3600)
+    return '%dd ago' % (seconds // 86400)
+
+
+class Dashboard:
+    '''Host table fed by update(). Only changed fields mark a row dirty,
+    only dirty rows are rendered again, and many updates between two
+    frames end up in one redraw, so drawing cost depends on the rows shown
+    rather than the number of results.
+
+    `on_frame` is called at most `max_fps` times per second while updates
+    come in, the caller then asks for lines() and draws them.'''
+
+    def __init__(self, max_fps=MAX_FPS, on_frame=None):
+        self.frame_interval = 1.0 / max_fps
+        self.on_frame = on_frame
+        # ip -> row, most recently changed last
+        self.rows = collections.OrderedDict()
+        self.online = 0
+        self.updates = 0
+        self.frames = 0
+        self._last_frame = 0.0
+        self._scheduled = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def update(self, ip, hostname=None, online=None, ports=_UNCHANGED,
+               rtt=_UNCHANGED, seen=None):
+        '''apply a result, fields left out stay as they are. seen is the
+        unix time an online host was seen, now if not given. Returns True
+        if anything changed.'''
+        row = self.rows.get(ip)
+        changed = row is None
+        if row is None:
+            row = self.rows[ip] = Row(ip)
+        if hostname is not None and hostname != row.hostname:
+            row.hostname = hostname
+            changed = True
+        if online is not None:
+            if online:
+                # the seen column is computed when drawing, no need to redraw
+                row.last_seen = seen or time.time()
+            if online != row.online:
+                if row.online:
+                    self.online -= 1
+                if online:
+                    self.online += 1
+                row.online = online
+                changed = True
+        if ports is not _UNCHANGED:
+            ports = tuple(sorted(ports))
+            if ports != row.ports:
+                row.ports = ports
+                changed = True
+        if rtt is not _UNCHANGED and rtt != row.rtt:
+            # only a noticeable change is worth a redraw
+            if row.rtt is None or rtt is None or abs(rtt - row.rtt) > 0.2 * row.rtt:
+                changed = True
+            row.rtt = rtt
+        self.updates += 1
+        if changed:
+            row.text = None
+            self.rows.move_to_end(ip)
+            self._schedule()
+        return changed
+
+    def remove(self, ip):
+        row = self.rows.pop(ip, None)
+        if row is not None and row.online:
+            self.online -= 1
+        self._schedule()
+
+    def _schedule(self):
+        if self._scheduled is not None or self.on_frame is None:
+            return
+        loop = asyncio.get_event_loop()
+        delay = max(self._last_frame + self.frame_interval - time.monotonic(), 0)
+        self._scheduled = loop.call_later(delay, self._frame)
+
+    def _frame(self):
+        self._scheduled = None
+        self._last_frame = time.monotonic()
+        self.frames += 1
+        self.on_frame()
+
+    def close(self):
+        if self._scheduled is not None:
+            self._scheduled.cancel()
+            self._scheduled = None
+
+    def _render(self, row):
+        if row.text is None:
+            state = {None: 'unknown', True: 'online', False: 'offline'}[row.online]
+            rtt = '-' if row.rtt is None else '%.1fms' % (row.rtt * 1000)
+            row.text = (
+                '%-16s %-20.20s %-7s ' % (row.ip, row.hostname, state),
+                ' %-8s %s' % (rtt, ', '.join(row.ports))
+            )
+        return row.text
+
+    def lines(self, max_rows=MAX_ROWS, width=None):
+        '''header, the most recently changed rows and a footer'''
+        now = time.time()
+        lines = [HEADER]
+        shown = 0
+        for ip in reversed(self.rows):
+            if shown >= max_rows:
+                break
+            row = self.rows[ip]
+            head, tail = self._render(row)
+            seen = _ago(now - row.last_seen) if row.last_seen else 'never'
+            lines.append('%s%-10s%s' % (head, seen, tail))
+            shown += 1
+        footer = '%s hosts, %s online' % (len(self.rows), self.online)
+        if len(self.rows) > shown:
+            footer += ', %s changed longer ago not shown' % (len(self.rows) - shown)
+        lines.append(footer)
+        if width:
+            lines = [line[:width] for line in lines]
+        return lines
+
+    def text(self, max_rows=MAX_ROWS, width=None):
+        return '\n'.join(self.lines(max_rows, width))
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+#
+# hostindex.py - address ranges and a compact index of known hosts
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import ipaddress
+import time
+
+# ipv6 keys get this bit set, so ::1.2.3.4 and 1.2.3.4 stay apart
+V6_FLAG = 1 << 128
+
+STATE_UNKNOWN = 0
+STATE_OFFLINE = 1
+STATE_ONLINE = 2
+
+
+def parse_networks(spec):
+    '''List of network objects from a network, a comma separated string of
+    networks or an iterable of both'''
+    if isinstance(spec, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+        return [spec]
+    if isinstance(spec, AddressSpace):
+        # iterating it would yield every single address
+        return list(spec.networks)
+    if isinstance(spec, str):
+        spec = spec.split(',')
+    networks = []
+    for network in spec:
+        if isinstance(network, str):
+            network = network.strip()
+            if not network:
+                continue
+            network = ipaddress.ip_network(network, strict=True)
+        networks.append(network)
+    return networks
+
+
+def to_key(ip):
+    '''integer key for an ip string or address object'''
+    address = ipaddress.ip_address(ip)
+    if address.version == 6:
+        return int(address) | V6_FLAG
+    return int(address)
+
+
+def from_key(key):
+    if key & V6_FLAG:
+        return str(ipaddress.IPv6Address(key & ~V6_FLAG))
+    return str(ipaddress.IPv4Address(key))
+
+
+def network_range(network):
+    '''(first, last) key of usable host addresses, network and broadcast
+    address are skipped like get_ips always did'''
+    first = int(network.network_address)
+    last = int(network.broadcast_address)
+    if network.version == 4 and network.prefixlen < 31:
+        first += 1
+        last -= 1
+    if network.version == 6:
+        first |= V6_FLAG
+        last |= V6_FLAG
+        if network.prefixlen < 127:
+            first += 1
+    return first, last
+
+
+class AddressSpace:
+    '''All usable addresses of one or more networks, never materialised.
+    Iteration is lazy and may be split into contiguous shards.'''
+
+    def __init__(self, networks):
+        self.networks = parse_networks(networks)
+        self.ranges = [network_range(network) for network in self.networks]
+
+    def __len__(self):
+        return sum(last - first + 1 for first, last in self.ranges)
+
+    def __contains__(self, ip):
+        try:
+            key = to_key(ip)
+        except ValueError:
+            return False
+        return any(first <= key <= last for first, last in self.ranges)
+
+    def __str__(self):
+        return ','.join(str(network) for network in self.networks)
+
+    def shard_ranges(self, shard=0, shards=1):
+        '''the ranges making up shard number `shard` of `shards` equally
+        sized, contiguous parts'''
+        total = len(self)
+        start = total * shard // shards
+        stop = total * (shard + 1) // shards
+        ranges = []
+        offset = 0
+        for first, last in self.ranges:
+            size = last - first + 1
+            low = max(start, offset)
+            high = min(stop, offset + size)
+            if low < high:
+                ranges.append((first + low - offset, first + high - offset - 1))
+            offset += size
+        return ranges
+
+    def keys(self, shard=0, shards=1):
+        for first, last in self.shard_ranges(shard, shards):
+            for key in range(first, last + 1):
+                yield key
+
+    def __iter__(self):
+        for key in self.keys():
+            yield from_key(key)
+
+    def ips(self, shard=0, shards=1):
+        for key in self.keys(shard, shards):
+            yield from_key(key)
+
+
+def address_space(spec):
+    '''AddressSpace of spec, an existing one is returned as it is'''
+    if isinstance(spec, AddressSpace):
+        return spec
+    return AddressSpace(spec)
+
+
+class HostIndex:
+    '''Mapping of ip string to hostname, stored compactly by integer
+    address with per host state and last seen time in parallel arrays.
+
+    If an AddressSpace is given, its addresses are part of the mapping
+    (hostname is the ip) without being stored, so memory only grows with
+    hosts actually added.'''
+
+    def __init__(self, space=None):
+        self.space = space
+        # key -> slot in the arrays below
+        self._slots = {}
+        self._free = []
+        self.hostnames = []
+        self.states = bytearray()
+        self.last_seen = array.array('d')
+
+    def _slot(self, ip):
+        return self._slots.get(to_key(ip))
+
+    def __setitem__(self, ip, hostname):
+        key = to_key(ip)
+        slot = self._slots.get(key)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+                self.hostnames[slot] = hostname
+                self.states[slot] = STATE_UNKNOWN
+                self.last_seen[slot] = 0.0
+            else:
+                slot = len(self.hostnames)
+                self.hostnames.append(hostname)
+                self.states.append(STATE_UNKNOWN)
+                self.last_seen.append(0.0)
+            self._slots[key] = slot
+        else:
+            self.hostnames[slot] = hostname
+
+    def __getitem__(self, ip):
+        slot = self._slot(ip)
+        if slot is not None:
+            return self.hostnames[slot]
+        if self.space is not None and ip in self.space:
+            return str(ip)
+        raise KeyError(ip)
+
+    def get(self, ip, default=None):
+        try:
+            return self[ip]
+        except (KeyError, ValueError):
+            return default
+
+    def __delitem__(self, ip):
+        slot = self._slots.pop(to_key(ip))
+        self.hostnames[slot] = None
+        self._free.append(slot)
+
+    def pop(self, ip, default=None):
+        try:
+            hostname = self[ip]
+            del self[ip]
+        except (KeyError, ValueError):
+            return default
+        return hostname
+
+    def __contains__(self, ip):
+        try:
+            if self._slot(ip) is not None:
+                return True
+        except ValueError:
+            return False
+        return self.space is not None and ip in self.space
+
+    @property
+    def stored_count(self):
+        return len(self._slots)
+
+    def is_stored(self, ip):
+        return self._slot(ip) is not None
+
+    def stored(self):
+        '''ips explicitly added, a snapshot safe against modification'''
+        return [from_key(key) for key in list(self._slots)]
+
+    def __iter__(self):
+        stored = set(self._slots)
+        for key in stored:
+            yield from_key(key)
+        if self.space is not None:
+            for key in self.space.keys():
+                if key not in stored:
+                    yield from_key(key)
+
+    def __len__(self):
+        if self.space is None:
+            return len(self._slots)
+        outside = sum(
+            1 for key in self._slots
+            if not any(first <= key <= last for first, last in self.space.ranges)
+        )
+        return len(self.space) + outside
+
+    def items(self):
+        for ip in self:
+            yield ip, self[ip]
+
+    def hostnames_stored(self):
+        return [self.hostnames[slot] for slot in self._slots.values()]
+
+    def set_state(self, ip, online):
+        '''record probe result, returns the previous state'''
+        slot = self._slot(ip)
+        if slot is None:
+            if not online:
+                # offline addresses of the space are not worth a slot
+                return STATE_UNKNOWN
+            self[ip] = self[ip]
+            slot = self._slot(ip)
+        previous = self.states[slot]
+        self.states[slot] = STATE_ONLINE if online else STATE_OFFLINE
+        if online:
+            self.last_seen[slot] = time.time()
+        return previous
+
+    def seen(self, ip):
+        '''unix time ip was last seen online, 0.0 if never'''
+        slot = self._slot(ip)
+        return 0.0 if slot is None else self.last_seen[slot]
+
+    def state(self, ip):
+        slot = self._slot(ip)
+        return STATE_UNKNOWN if slot is None else self.states[slot]
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+#
+# icmp.py - asyncio icmp echo (ping) for many hosts over a single socket
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import ipaddress
+import os
+import random
+import socket
+import struct
+import time
+
+import whosonline.scheduler as scheduler
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+ICMP_HEADER = struct.Struct('!BBHHH')
+
+PAYLOAD = b'whosonline-ping!'
+
+# hosts pinged at once by ping_many
+PING_CONCURRENCY = 1024
+
+
+class IcmpUnavailable(Exception):
+    '''raised if neither a datagram nor a raw icmp socket can be opened,
+    callers fall back to the ping shell command'''
+
+
+def checksum(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def build_echo_request(ident, seq, payload=PAYLOAD):
+    header = ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    csum = checksum(header + payload)
+    return ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, csum, ident, seq) + payload
+
+
+def parse_echo_reply(packet):
+    '''returns (ident, seq) of an echo reply or None'''
+    if len(packet) < ICMP_HEADER.size:
+        return None
+    icmp_type, code, csum, ident, seq = ICMP_HEADER.unpack_from(packet)
+    if icmp_type != ICMP_ECHO_REPLY:
+        return None
+    return ident, seq
+
+
+class SocketTransport:
+    '''Unprivileged datagram icmp socket (see net.ipv4.ping_group_range),
+    falling back to a raw socket if running with CAP_NET_RAW.'''
+
+    def __init__(self):
+        self.sock = None
+        self.raw = False
+        self.ident = os.getpid() & 0xffff
+        self._loop = None
+
+    def open(self, on_reply):
+        try:
+            sock = socket.socket(
+                socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP
+            )
+        except OSError:
+            try:
+                sock = socket.socket(
+                    socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP
+                )
+            except OSError as e:
+                raise IcmpUnavailable('Unable to open icmp socket: %s' % e)
+            self.raw = True
+        sock.setblocking(False)
+        self.sock = sock
+
+        def on_readable():
+            while True:
+                try:
+                    packet, address = sock.recvfrom(2048)
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError:
+                    return
+                if self.raw:
+                    # raw sockets hand out the ip header as well, and see
+                    # replies to every process on this host
+                    packet = packet[(packet[0] & 0x0f) * 4:]
+                parsed = parse_echo_reply(packet)
+                if parsed is None:
+                    continue
+                ident, seq = parsed
+                # the kernel owns the identifier of datagram sockets
+                if self.raw and ident != self.ident:
+                    continue
+                on_reply(address[0], seq)
+
+        self._loop = asyncio.get_event_loop()
+        self._loop.add_reader(sock.fileno(), on_readable)
+
+    def send(self, ip, seq):
+        '''returns False if the socket buffer is full'''
+        try:
+            self.sock.sendto(build_echo_request(self.ident, seq), (ip, 0))
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            # unreachable networks and the like, treated as lost packet
+            pass
+        return True
+
+    def close(self):
+        if self.sock is None:
+            return
+        self._loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+
+
+class FakeTransport:
+    '''In-memory stand in, `hosts` maps ip to round trip time in seconds.
+    Every reply is dropped with probability `loss`.'''
+
+    def __init__(self, hosts, loss=0.0):
+        self.hosts = hosts
+        self.loss = loss
+        self.sent = 0
+        self._on_reply = None
+
+    def open(self, on_reply):
+        self._on_reply = on_reply
+        self._loop = asyncio.get_event_loop()
+
+    def send(self, ip, seq):
+        self.sent += 1
+        if ip in self.hosts and random.random() >= self.loss:
+            self._loop.call_later(self.hosts[ip], self._deliver, ip, seq)
+        return True
+
+    def _deliver(self, ip, seq):
+        if self._on_reply is not None:
+            self._on_reply(ip, seq)
+
+    def close(self):
+        self._on_reply = None
+
+
+class PingResult:
+
+    def __init__(self, sent, rtts):
+        self.sent = sent
+        self.rtts = rtts
+
+    @property
+    def received(self):
+        return len(self.rtts)
+
+    @property
+    def alive(self):
+        return bool(self.rtts)
+
+    @property
+    def loss(self):
+        return 1 - self.received / self.sent if self.sent else 1.0
+
+    @property
+    def rtt(self):
+        '''average round trip time in seconds, None if nothing came back'''
+        return sum(self.rtts) / len(self.rtts) if self.rtts else None
+
+    def __bool__(self):
+        return self.alive
+
+    def __repr__(self):
+        rtt = '%.1fms' % (self.rtt * 1000) if self.alive else '-'
+        return '<PingResult %s/%s received, loss %.0f%%, rtt %s>' % (
+            self.received, self.sent, self.loss * 100, rtt
+        )
+
+
+class IcmpEngine:
+    '''Pings many hosts over one transport, replies are matched to waiting
+    probes by sequence number and source address.'''
+
+    def __init__(self, transport):
+        self.transport = transport
+        # seq -> (ip, sent timestamp, future)
+        self._pending = {}
+        self._seq = random.randrange(0x10000)
+        self.transport.open(self._on_reply)
+
+    def _on_reply(self, ip, seq):
+        entry = self._pending.get(seq)
+        if entry is None or entry[0] != ip:
+            return
+        target, sent, future = self._pending.pop(seq)
+        if not future.done():
+            future.set_result(time.monotonic() - sent)
+
+    def _next_seq(self):
+        for _ in range(0x10000):
+            self._seq = (self._seq + 1) & 0xffff
+            if self._seq not in self._pending:
+                return self._seq
+        raise RuntimeError('Too many icmp echo requests in flight')
+
+    async def _echo(self, ip, timeout):
+        '''send one echo request, returns rtt or None on timeout'''
+        seq = self._next_seq()
+        future = asyncio.get_event_loop().create_future()
+        self._pending[seq] = (ip, time.monotonic(), future)
+        try:
+            while not self.transport.send(ip, seq):
+                await asyncio.sleep(0.001)
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            entry = self._pending.get(seq)
+            if entry is not None and entry[2] is future:
+                del self._pending[seq]
+
+    async def ping(self, ip, count=3, interval=0.2, timeout=1.0):
+        '''send `count` echo requests `interval` seconds apart, each waiting
+        up to `timeout` seconds for its reply'''
+        echos = []
+        for number in range(count):
+            if number:
+                await asyncio.sleep(interval)
+            echos.append(asyncio.ensure_future(self._echo(ip, timeout)))
+        rtts = await asyncio.gather(*echos)
+        return PingResult(count, [rtt for rtt in rtts if rtt is not None])
+
+    async def ping_many(self, ips, count=3, interval=0.2, timeout=1.0,
+                        concurrency=PING_CONCURRENCY):
+        '''dict ip -> PingResult for all ips'''
+        async def ping(ip):
+            return await self.ping(ip, count, interval, timeout)
+        results = {}
+        async for ip, result in scheduler.bounded_map(ping, ips, concurrency):
+            results[ip] = result
+        return results
+
+    def close(self):
+        self.transport.close()
+
+
+# transport used for new engines, replace for testing, e.g.
+# icmp.TRANSPORT_FACTORY = lambda: icmp.FakeTransport(hosts)
+TRANSPORT_FACTORY = SocketTransport
+
+# loop -> engine, or the IcmpUnavailable raised when opening it
+_engines = {}
+
+
+def get_engine():
+    '''shared engine for the running event loop'''
+    loop = asyncio.get_event_loop()
+    engine = _engines.get(loop)
+    if engine is None:
+        try:
+            engine = IcmpEngine(TRANSPORT_FACTORY())
+        except IcmpUnavailable as e:
+            engine = e
+        _engines[loop] = engine
+    if isinstance(engine, IcmpUnavailable):
+        raise engine
+    return engine
+
+
+def reset_engines():
+    for engine in _engines.values():
+        if isinstance(engine, IcmpEngine):
+            engine.close()
+    _engines.clear()
+
+
+async def resolve(host):
+    '''ip for host without blocking the loop, None if unknown'''
+    try:
+        return str(ipaddress.IPv4Address(host))
+    except ValueError:
+        pass
+    loop = asyncio.get_event_loop()
+    try:
+        infos = await loop.getaddrinfo(host, None, family=socket.AF_INET)
+    except socket.gaierror:
+        return None
+    return infos[0][4][0] if infos else None
+
+
+async def ping(host, count=3, interval=0.2, timeout=1.0):
+    '''PingResult for host (ip or hostname). Raises IcmpUnavailable if no
+    icmp socket can be opened.'''
+    engine = get_engine()
+    ip = await resolve(host)
+    if ip is None:
+        return PingResult(0, [])
+    return await engine.ping(ip, count, interval, timeout)
+
+
+async def ping_many(ips, count=3, interval=0.2, timeout=1.0):
+    '''dict ip -> PingResult, all hosts share one socket'''
+    return await get_engine().ping_many(ips, count, interval, timeout)
@@ -18,9 +18,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
+import sys
 import warnings
 
+import whosonline.metrics as metrics
+
 # PIP
 # compatibility! python-systemd lib strongly depends on systemd
 '''
@@ -34,37 +41,136 @@ except ImportError:
 
 use_journal = False
 
+# records waiting for the writer thread, more are dropped instead of
+# blocking the caller
+QUEUE_SIZE = 10000
+# rotated files kept besides the current one
+BACKUP_COUNT = 5
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+LOG_RECORDS_DROPPED = metrics.Counter(
+    'whosonline_log_records_dropped_total',
+    'Log records dropped because the writer thread fell behind'
+)
+
+# attributes every LogRecord has, everything else came in by extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+# (queue handler, listener, settings) of the running setup
+_setup = None
+
+
+class JsonFormatter(logging.Formatter):
+    '''one json object per record, fields passed by extra= are kept, e.g.
+    LOGGER.info('host online', extra={'ip': ip, 'rtt': rtt})'''
+
+    def format(self, record):
+        record_d = {
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                record_d[key] = value
+        if record.exc_info:
+            record_d['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            record_d['exc'] = record.exc_text
+        return json.dumps(record_d, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''Hands records to the writer thread, never waits for it'''
 
-def build_logger(path=None):
+    def prepare(self, record):
+        # keep msg and args, the formatter of the writer thread builds the
+        # message. Arguments must not change after the call.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+def _file_handler(path, max_bytes, when, backup_count):
+    if max_bytes:
+        return logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count
+        )
+    if when:
+        return logging.handlers.TimedRotatingFileHandler(
+            path, when=when, backupCount=backup_count
+        )
+    return logging.FileHandler(path)
+
+
+def build_logger(path=None, json_format=False, max_bytes=0, when=None,
+                 backup_count=BACKUP_COUNT, level=logging.DEBUG, console=True):
+    '''Set up the WhosOnline logger and return it. Records are queued and
+    written by a background thread, so logging never waits for the disk.
+    The file at path is rotated at max_bytes, or at `when` (see
+    TimedRotatingFileHandler), if given. Calling it again with the same
+    arguments returns the same logger, other arguments replace the setup.'''
+    global _setup
     # one logger to rule em' all
     LOGGER = logging.getLogger('WhosOnline')
+    settings = (path, json_format, max_bytes, when, backup_count, level, console)
+    if _setup is not None:
+        if _setup[2] == settings:
+            return LOGGER
+        shutdown()
 
     # create formatter
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    if json_format:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT)
 
+    handlers = []
     # handler for logging to console
-    # default behaviour of the StreamHandler
-    console_loghandler = logging.StreamHandler()
-    console_loghandler.setLevel(logging.DEBUG)
-    console_loghandler.setFormatter(formatter)
-    LOGGER.addHandler(console_loghandler)
+    if console:
+        handlers.append(logging.StreamHandler(sys.stderr))
 
     # journal handler
     if use_journal is True:
-        journal_loghandler = systemd.journal.JournalHandler()
-        journal_loghandler.setLevel(logging.DEBUG)
-        journal_loghandler.setFormatter(formatter)
-        LOGGER.addHandler(journal_loghandler)
+        handlers.append(systemd.journal.JournalHandler())
 
     # handler for logging to file
     # make this optional - normally we log to journal
     if path is not None:
-        file_loghandler = logging.FileHandler(path)
-        file_loghandler.setLevel(logging.DEBUG)
-        file_loghandler.setFormatter(formatter)
-        LOGGER.addHandler(file_loghandler)
+        handlers.append(_file_handler(path, max_bytes, when, backup_count))
 
-    # loglevel for both handlers
-    LOGGER.setLevel(logging.DEBUG)
+    for handler in handlers:
+        handler.setFormatter(formatter)
 
+    queue_handler = DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers)
+    listener.start()
+    LOGGER.addHandler(queue_handler)
+    LOGGER.setLevel(level)
+    LOGGER.propagate = False
+    _setup = (queue_handler, listener, settings)
     return LOGGER
+
+
+def shutdown():
+    '''write the queued records and stop the writer thread'''
+    global _setup
+    if _setup is None:
+        return
+    queue_handler, listener, settings = _setup
+    _setup = None
+    logging.getLogger('WhosOnline').removeHandler(queue_handler)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+atexit.register(shutdown)
@@ -0,0 +1,510 @@
+# -*- coding: utf-8 -*-
+#
+# loops.py - the long running scan loops, shared by the interactive shell
+# and the headless daemon. Nothing in here needs a terminal.
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import ipaddress
+import logging
+import time
+
+import whosonline.hostindex as hostindex
+import whosonline.metrics as metrics
+import whosonline.neighbours as neighbours
+import whosonline.netcheck as netcheck
+import whosonline.nmapxml as nmapxml
+import whosonline.notifications as notifications
+import whosonline.results as results
+import whosonline.scheduler as scheduler
+import whosonline.tracker as tracker
+
+# names of the loops which can be started
+LOOPS = ('fast_nmap_loop', 'netcheck')
+
+# kernel neighbour table, only set up in passive mode
+neighbour_table = None
+
+# persistent result store, None if disabled
+result_store = None
+
+# every probe is logged at debug level, see logfacility.build_logger
+LOGGER = logging.getLogger('WhosOnline')
+
+# seconds a version scan of a few ports may take
+VERSION_TIMEOUT = 300
+
+VERSION_SCANS_QUEUED = metrics.Gauge(
+    'whosonline_version_scans_queued',
+    'Hosts waiting for a version scan of their newly opened ports'
+)
+
+
+class Reporter:
+    '''Receives what the loops find. This one prints like the shell always
+    did, the shell and the daemon override what they show differently.'''
+
+    def scan_cycle_started(self, network, hosts, incremental):
+        if not incremental:
+            print('%s hosts in network %s' % (len(hosts), network))
+
+    def scan_result(self, ip, hostname, result, changes):
+        '''result is the results.Host record of ip. changes is None unless
+        the loop runs incremental, then it lists the differences to the
+        last scan'''
+        if changes is None:
+            import pprint
+            print()
+            print('HOST %s SCANNED, RESULT FOLLOWS:' % hostname)
+            print(pprint.pformat(result.as_dict()))
+            print()
+        elif changes:
+            print('HOST %s: %s' % (hostname, '; '.join(changes)))
+
+    def scan_cycle_done(self, timer, incremental):
+        if not incremental:
+            print('Scan cycle done: %s' % timer)
+
+    def host_state(self, ip, hostname, online, rtt, changed):
+        '''result of a netcheck probe, changed if the state is new'''
+        if changed:
+            print('Host %s online: %s' % (hostname, online))
+
+    def version_result(self, ip, hostname, result):
+        '''result of a version scan of the ports which opened lately'''
+        print('HOST %s SERVICES: %s' % (hostname, ', '.join(
+            ' '.join(filter(None, (port.name, port.service, port.version)))
+            for port in result.ports if port.state == 'open'
+        )))
+
+    def host_added(self, ip, hostname):
+        '''a host found by passive discovery'''
+
+
+def store_result(kind, host, result=None, online=None):
+    if result_store is not None:
+        result_store.record(kind, host, result_d=result, online=online)
+
+
+async def arping(ip, interface, timeout=3, frame_count=3):
+    """
+    Arp ping using the in-process arp engine, the arping shell command is
+    used if no raw socket is available
+    """
+    return await netcheck.async_arping(ip, interface, timeout, frame_count)
+
+
+async def ping(ip, count=3, timeout=3):
+    """
+    ICMP echo using the shared icmp engine, the ping shell command is used
+    if no icmp socket is available
+    """
+    return await netcheck.async_ping(ip, count, timeout)
+
+
+async def check_host(ip, interface, probe='arp'):
+    """
+    Liveness of a single host as (online, rtt in seconds or None), using
+    the kernel neighbour table if possible
+    """
+    if neighbour_table is not None and neighbour_table.reachable(ip):
+        # recently confirmed by the kernel, no need to probe
+        return True, None
+    if ipaddress.ip_address(ip).version != 4:
+        # arp and the icmp engine only handle ipv4
+        return False, None
+    if probe == 'icmp':
+        return await netcheck.async_ping_rtt(ip, count=3, timeout=3)
+    interface = await netcheck.async_get_netdevice(ip) or interface
+    started = time.monotonic()
+    online = await arping(ip, interface)
+    # arping stops at the first reply, close enough to a round trip
+    return online, time.monotonic() - started if online else None
+
+
+async def neighbour_hosts(network, no_dns):
+    """
+    Hosts in network known from the kernel neighbour table, hostname is the
+    ip if no ptr record exists
+    """
+    if neighbour_table is None:
+        return
+    for neighbour in neighbour_table.in_network(network):
+        hostname = None
+        if not no_dns:
+            hostname = await netcheck.RESOLVER.resolve(neighbour.ip)
+        yield neighbour.ip, hostname or neighbour.ip
+
+
+def new_hosts(network, no_dns):
+    """
+    Empty HostIndex for network. Without dns every address of the networks
+    is part of it, generated lazily instead of being stored.
+    """
+    if no_dns:
+        return hostindex.HostIndex(space=hostindex.address_space(network))
+    return hostindex.HostIndex()
+
+
+def add_host(hosts_d, ip, hostname, reporter=None):
+    if hosts_d.is_stored(ip):
+        return
+    hosts_d[ip] = hostname
+    if reporter is not None:
+        reporter.host_added(ip, hostname)
+
+
+class Discovery:
+    """
+    Adds the hosts of network to hosts_d as their names resolve, counting
+    lookups so a status line can show how far it got. With prune, hosts_d
+    is brought up to date in place: renamed hosts get their new name and
+    hosts no longer found are removed.
+    """
+
+    def __init__(self, network, hosts_d, no_dns, reporter=None, prune=False):
+        self.network = network
+        self.hosts_d = hosts_d
+        self.no_dns = no_dns
+        self.reporter = reporter
+        self.prune = prune
+        self.total = 0 if no_dns else len(hostindex.address_space(network))
+        self.resolved = 0
+        self.done = False
+        self.started = None
+        self.elapsed = 0.0
+
+    def _progress(self, ip, hostname):
+        self.resolved += 1
+
+    def _found(self, ip, hostname, seen):
+        if seen is not None:
+            seen.add(hostindex.to_key(ip))
+            if self.hosts_d.is_stored(ip) and self.hosts_d[ip] != hostname:
+                self.hosts_d[ip] = hostname
+        add_host(self.hosts_d, ip, hostname, self.reporter)
+
+    async def run(self):
+        self.started = time.monotonic()
+        seen = set() if self.prune else None
+        try:
+            async for ip, hostname in neighbour_hosts(self.network, self.no_dns):
+                self._found(ip, hostname, seen)
+            if not self.no_dns:
+                hostnames = netcheck.async_get_hostnames(
+                    self.network, progress=self._progress
+                )
+                async for ip, hostname in hostnames:
+                    self._found(ip, hostname, seen)
+            if seen is not None:
+                for ip in self.hosts_d.stored():
+                    if hostindex.to_key(ip) not in seen:
+                        del self.hosts_d[ip]
+        finally:
+            self.elapsed = time.monotonic() - self.started
+            self.done = True
+
+    def __str__(self):
+        if self.done:
+            return 'Discovery done: %s hosts in %.1fs' % (
+                self.hosts_d.stored_count, self.elapsed
+            )
+        return 'Discovering hosts: %s/%s addresses looked up, %s found' % (
+            self.resolved, self.total, self.hosts_d.stored_count
+        )
+
+
+async def get_hosts(network, no_dns):
+    """
+    HostIndex of ip -> hostname, see new_hosts
+    """
+    hosts = new_hosts(network, no_dns)
+    await Discovery(network, hosts, no_dns).run()
+    return hosts
+
+
+def start_passive_discovery(network, hosts_d, no_dns, reporter=None):
+    """
+    Seed hosts_d from the kernel neighbour table and keep following it
+    """
+    global neighbour_table
+    neighbour_table = neighbours.NeighbourTable().dump()
+
+    async def add_neighbour(ip):
+        hostname = None if no_dns else await netcheck.RESOLVER.resolve(ip)
+        if not hosts_d.is_stored(ip):
+            notifications.publish(notifications.NEW, ip, hostname or ip)
+        add_host(hosts_d, ip, hostname or ip, reporter)
+
+    async def seed():
+        async for ip, hostname in neighbour_hosts(network, no_dns):
+            add_host(hosts_d, ip, hostname, reporter)
+
+    def on_change(ip, neighbour):
+        if neighbour is None:
+            return
+        if neighbours.in_scope(neighbour, network):
+            asyncio.ensure_future(add_neighbour(ip))
+
+    neighbour_table.listeners.append(on_change)
+    return asyncio.gather(seed(), neighbour_table.watch())
+
+
+class VersionScan:
+    '''Second stage of nmap_scan_loop: tcp ports the fast scan finds newly
+    open are scanned with -sV, only those ports of that host, by up to
+    `concurrency` nmap processes. Ports opening on a host which still waits
+    are added to its scan. Results go to the store as services scans.'''
+
+    def __init__(self, concurrency, reporter=None, hostnames=None,
+                 timeout=VERSION_TIMEOUT):
+        self.concurrency = concurrency
+        self.reporter = reporter or Reporter()
+        self.hostnames = hostnames if hostnames is not None else {}
+        self.timeout = timeout
+        # ip -> set of port numbers, oldest first
+        self._pending = collections.OrderedDict()
+        self._ready = asyncio.Event()
+        self._tasks = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, ip, ports):
+        '''queue a version scan of ports, given by name like 22/tcp'''
+        numbers = {
+            int(name.partition('/')[0]) for name in ports if name.endswith('/tcp')
+        }
+        if not numbers:
+            return
+        self._pending.setdefault(ip, set()).update(numbers)
+        VERSION_SCANS_QUEUED.set(len(self._pending))
+        self._ready.set()
+
+    async def _scan(self, ip, numbers):
+        try:
+            result = await nmapxml.nmap_scan(
+                ip, '-sV', timeout=self.timeout,
+                ports=','.join(str(number) for number in sorted(numbers)),
+                check=True
+            )
+        except OSError as e:
+            print('Version scan of %s failed: %s' % (ip, e))
+            return
+        if not result.online:
+            # gone, the fast scan will find the ports again
+            return
+        store_result('services', ip, result)
+        self.reporter.version_result(ip, self.hostnames.get(ip, ip), result)
+
+    async def _worker(self):
+        while True:
+            while not self._pending:
+                self._ready.clear()
+                await self._ready.wait()
+            ip, numbers = self._pending.popitem(last=False)
+            VERSION_SCANS_QUEUED.set(len(self._pending))
+            await self._scan(ip, numbers)
+
+    def start(self):
+        self._tasks = [
+            asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)
+        ]
+
+    def stop(self):
+        '''cancel the workers, running nmap processes are killed'''
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+
+async def nmap_scan_loop(network, no_dns,
+                         concurrency=scheduler.SCAN_CONCURRENCY,
+                         interval=scheduler.SCAN_INTERVAL,
+                         batch_size=nmapxml.BATCH_SIZE,
+                         incremental=False,
+                         reporter=None,
+                         coordinator=None,
+                         version_concurrency=0):
+    """
+    Coroutine calling fast nmap scan for all known hosts, running up to
+    `concurrency` nmap processes with `batch_size` hosts each and waiting
+    `interval` seconds between cycles.
+    In incremental mode only changes are reported, and hosts which did not
+    change for a while are scanned less often.
+    Host list and results are kept from cycle to cycle and updated in
+    place, memory stays the same however long the loop runs.
+    With a cluster.Coordinator the whole address space is scanned by its
+    workers instead of local nmap processes.
+    With `version_concurrency` ports found open on a host which was scanned
+    before, in this run or an earlier one in the store, are version
+    scanned, see VersionScan.
+    """
+    reporter = reporter or Reporter()
+    records = results.HostTable()
+    host_tracker = None
+    if incremental:
+        host_tracker = tracker.HostTracker(base_interval=interval)
+    if result_store is not None and (incremental or version_concurrency):
+        # warm start, hosts known from earlier runs count as stable and
+        # their ports as known
+        for ip, result_d in (await result_store.latest('fast')).items():
+            record, _ = records.update(ip, results.Host.from_dict(result_d))
+            if host_tracker is not None:
+                host_tracker.seed(ip, record)
+    ip_hosts = new_hosts(network, no_dns)
+    version_scan = None
+    if version_concurrency:
+        version_scan = VersionScan(version_concurrency, reporter, ip_hosts)
+        version_scan.start()
+    try:
+        while True:
+            timer = scheduler.CycleTimer()
+            await Discovery(network, ip_hosts, no_dns, prune=True).run()
+            targets = ip_hosts
+            if host_tracker is not None:
+                targets = host_tracker.due(ip_hosts)
+            reporter.scan_cycle_started(network, ip_hosts, incremental)
+            if coordinator is not None:
+                # shards cover every address, due hosts can not be picked
+                scan = coordinator.scan()
+            else:
+                scan = nmapxml.scan_many(
+                    targets, batch_size=batch_size, concurrency=concurrency
+                )
+            debug = LOGGER.isEnabledFor(logging.DEBUG)
+            async for ip, scan_result in scan:
+                timer.tick()
+                previous = records.get(ip)
+                old_ports = None if previous is None else previous.open_ports
+                record, changed = records.update(ip, scan_result)
+                # a host seen for the first time has no new ports, only
+                # ones we did not know about
+                if version_scan is not None and old_ports is not None \
+                        and record.open_ports is not old_ports:
+                    opened = set(record.open_ports).difference(old_ports)
+                    if opened:
+                        version_scan.submit(ip, opened)
+                store_result('fast', ip, record)
+                changes = None
+                if host_tracker is not None:
+                    changes = host_tracker.update(ip, record)
+                if debug:
+                    LOGGER.debug('scan %s online %s', ip, record.online, extra={
+                        'loop': 'fast_nmap_loop', 'ip': ip, 'online': record.online,
+                        'open_ports': record.open_ports, 'changed': changed,
+                    })
+                reporter.scan_result(ip, ip_hosts.get(ip, ip), record, changes)
+
+            metrics.CYCLE_DURATION.observe(timer.elapsed, loop='fast_nmap_loop')
+            LOGGER.info('fast_nmap_loop cycle: %s', timer, extra={
+                'loop': 'fast_nmap_loop', 'hosts': timer.count,
+                'seconds': round(timer.elapsed, 3),
+            })
+            reporter.scan_cycle_done(timer, incremental)
+            await asyncio.sleep(interval)
+    finally:
+        if version_scan is not None:
+            version_scan.stop()
+
+
+async def netcheck_loop(hosts_d, interface, probe='arp',
+                        min_interval=scheduler.POLL_MIN_INTERVAL,
+                        max_interval=scheduler.POLL_MAX_INTERVAL,
+                        concurrency=64,
+                        reporter=None):
+    """
+    Check hosts for being online, each host on its own deadline: hosts
+    which changed state are checked every `min_interval` seconds, stable
+    ones back off up to `max_interval`. Addresses not stored in hosts_d
+    (no dns mode) are swept once per `max_interval`.
+    """
+    reporter = reporter or Reporter()
+    poller = scheduler.PollScheduler(min_interval, max_interval)
+    known = -1
+    sweep = None
+    sweep_started = None
+
+    async def check(ip):
+        return await check_host(ip, interface, probe)
+
+    while True:
+        # pick up hosts added by discovery or found by the sweep
+        if hosts_d.stored_count != known:
+            for ip in hosts_d.stored():
+                poller.add(ip)
+            known = hosts_d.stored_count
+
+        due = poller.pop_due(limit=concurrency)
+        metrics.LOOP_BEHIND.set(poller.behind, loop='netcheck')
+        if hosts_d.space is not None and len(due) < concurrency:
+            now = time.monotonic()
+            if sweep is None and (sweep_started is None or now - sweep_started >= max_interval):
+                sweep = iter(hosts_d.space)
+                sweep_started = now
+            while sweep is not None and len(due) < concurrency:
+                ip = next(sweep, None)
+                if ip is None:
+                    sweep = None
+                elif not hosts_d.is_stored(ip):
+                    due.append(ip)
+
+        if not due:
+            next_deadline = poller.next_deadline()
+            delay = 1 if next_deadline is None else next_deadline - time.monotonic()
+            await asyncio.sleep(min(max(delay, 0.05), 1))
+            continue
+
+        # a cycle is one round of hosts checked together
+        timer = scheduler.CycleTimer()
+        debug = LOGGER.isEnabledFor(logging.DEBUG)
+        async for ip, (ping_result, rtt) in scheduler.bounded_map(check, due, concurrency):
+            previous = hosts_d.set_state(ip, ping_result)
+            store_result(probe, ip, online=ping_result)
+            if debug:
+                LOGGER.debug('%s %s online %s', probe, ip, ping_result, extra={
+                    'loop': 'netcheck', 'ip': ip, 'online': ping_result,
+                    'rtt': rtt,
+                })
+            if ip not in poller:
+                # offline address of the space, nothing to track
+                if ping_result:
+                    poller.add(ip, delay=min_interval)
+                    notifications.publish(notifications.NEW, ip, hosts_d[ip])
+                else:
+                    continue
+            else:
+                changed = previous != hostindex.STATE_UNKNOWN and \
+                    previous != hosts_d.state(ip)
+                poller.report(ip, changed)
+                if changed:
+                    LOGGER.info('host %s online %s', hosts_d[ip], ping_result, extra={
+                        'loop': 'netcheck', 'ip': ip, 'online': ping_result,
+                    })
+                    notifications.publish(
+                        notifications.ONLINE if ping_result else notifications.OFFLINE,
+                        ip, hosts_d[ip]
+                    )
+            reporter.host_state(
+                ip, hosts_d[ip], ping_result, rtt,
+                previous != hosts_d.state(ip)
+            )
+        metrics.CYCLE_DURATION.observe(timer.elapsed, loop='netcheck')
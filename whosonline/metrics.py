@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+#
+# metrics.py - runtime counters and latency histograms, rendered for the
+# shell or in the prometheus text format
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import bisect
+import os
+import time
+
+# upper bounds in seconds, from loop lag up to slow service scans
+BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60, 120, 300,
+)
+
+# seconds between two loop lag samples
+LAG_INTERVAL = 0.5
+
+# seconds between two writes of the metrics file
+EXPORT_INTERVAL = 15
+
+METRICS_PORT_HOST = '127.0.0.1'
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs
+    )
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    '''Base of all metrics. Values are kept per tuple of label values,
+    label names are fixed when the metric is created.'''
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def values(self):
+        '''dict of label values -> value'''
+        return self._values
+
+    def samples(self):
+        '''(name, label string, value) in the exposition format'''
+        for key, value in sorted(self.values().items()):
+            yield self.name, _format_labels(self.labels, key), value
+
+    def summary(self):
+        '''short lines for the stats shell command'''
+        for key, value in sorted(self.values().items()):
+            yield '%s%s %s' % (
+                self.name, _format_labels(self.labels, key), _format_value(value)
+            )
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    '''A value that goes up and down. If `function` is given it is called
+    on collection and returns a dict of label values -> value.'''
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), registry=None, function=None):
+        super().__init__(name, help, labels, registry)
+        self.function = function
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def get(self, **labels):
+        return self.values().get(self._key(labels), 0)
+
+    def values(self):
+        if self.function is not None:
+            return self.function()
+        return self._values
+
+
+class Histogram(Metric):
+    '''Observations counted in cumulative buckets, like prometheus does'''
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), registry=None, buckets=BUCKETS):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            # per bucket counts (not cumulative), one more for +Inf, sum, max
+            entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] = max(entry[2], value)
+
+    def count(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def quantile(self, q, **labels):
+        '''upper bound of the bucket holding quantile q'''
+        entry = self._values.get(self._key(labels))
+        if not entry:
+            return 0.0
+        return self._quantile(entry, q)
+
+    def _quantile(self, entry, q):
+        counts, _, maximum = entry
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, maximum)
+        return maximum
+
+    def samples(self):
+        for key, (counts, total, _) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield (
+                    self.name + '_bucket',
+                    _format_labels(self.labels, key, [('le', _format_value(float(bound)))]),
+                    cumulative
+                )
+            yield self.name + '_sum', _format_labels(self.labels, key), total
+            yield self.name + '_count', _format_labels(self.labels, key), cumulative
+
+    def summary(self):
+        for key, entry in sorted(self._values.items()):
+            counts, total, maximum = entry
+            count = sum(counts)
+            yield '%s%s count %s mean %.3fs p50 %.3fs p95 %.3fs max %.3fs' % (
+                self.name, _format_labels(self.labels, key), count,
+                total / count if count else 0.0,
+                self._quantile(entry, 0.5), self._quantile(entry, 0.95), maximum
+            )
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        '''all metrics in the prometheus text exposition format'''
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, labels, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.summary())
+        return lines
+
+
+REGISTRY = Registry()
+
+PROBE_LATENCY = Histogram(
+    'whosonline_probe_seconds',
+    'Duration of a single liveness probe or scan',
+    labels=('probe',)
+)
+CYCLE_DURATION = Histogram(
+    'whosonline_cycle_seconds',
+    'Duration of one cycle of a scan loop',
+    labels=('loop',)
+)
+LOOP_BEHIND = Gauge(
+    'whosonline_loop_behind_seconds',
+    'How long the most overdue host of a loop waited past its deadline',
+    labels=('loop',)
+)
+LOOP_LAG = Histogram(
+    'whosonline_event_loop_lag_seconds',
+    'Delay of the event loop waking up a sleeping task'
+)
+PROCESSES_STARTED = Counter(
+    'whosonline_processes_started_total',
+    'Child processes started',
+    labels=('priority',)
+)
+RESOLVER_LOOKUPS = Counter(
+    'whosonline_resolver_lookups_total',
+    'Reverse dns lookups by cache result',
+    labels=('result',)
+)
+
+
+def resolver_hit_rate():
+    hits = RESOLVER_LOOKUPS.get(result='hit')
+    total = hits + RESOLVER_LOOKUPS.get(result='miss')
+    return hits / total if total else 0.0
+
+
+RESOLVER_HIT_RATE = Gauge(
+    'whosonline_resolver_cache_hit_ratio',
+    'Share of reverse dns lookups answered from cache',
+    function=lambda: {(): resolver_hit_rate()}
+)
+
+
+class timed:
+    '''context manager observing its duration in histogram, blocks left
+    by an exception are not observed'''
+
+    def __init__(self, histogram, **labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.monotonic() - self.started
+        if exc_type is None:
+            self.histogram.observe(self.elapsed, **self.labels)
+
+
+async def watch_loop_lag(interval=LAG_INTERVAL):
+    '''observe how late the event loop wakes up, until cancelled'''
+    loop = asyncio.get_event_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(loop.time() - expected, 0))
+
+
+def write_textfile(path, registry=REGISTRY):
+    '''write metrics for the node exporter textfile collector, atomically'''
+    path = os.path.expanduser(path)
+    temp = '%s.%s.tmp' % (path, os.getpid())
+    with open(temp, 'w') as f:
+        f.write(registry.render())
+    os.replace(temp, path)
+
+
+async def export_textfile(path, interval=EXPORT_INTERVAL, registry=REGISTRY):
+    '''rewrite the metrics file every interval seconds until cancelled'''
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, write_textfile, path, registry)
+        except OSError as e:
+            print('Unable to write metrics to %s: %s' % (path, e))
+        await asyncio.sleep(interval)
+
+
+async def _handle_http(reader, writer, registry):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 10)
+        # skip headers
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 10)
+            if not line or line in (b'\r\n', b'\n'):
+                break
+        parts = request.decode(errors='replace').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1] in ('/', '/metrics'):
+            status, body = '200 OK', registry.render().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write((
+            'HTTP/1.0 %s\r\n'
+            'Content-Type: text/plain; version=0.0.4\r\n'
+            'Content-Length: %s\r\n'
+            'Connection: close\r\n\r\n' % (status, len(body))
+        ).encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(port, host=METRICS_PORT_HOST, registry=REGISTRY):
+    '''serve metrics on http://host:port/metrics, returns the server'''
+    return await asyncio.start_server(
+        lambda reader, writer: _handle_http(reader, writer, registry),
+        host, port
+    )
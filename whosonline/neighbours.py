@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+# neighbours.py - passive host discovery from the kernel neighbour table
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import ipaddress
+import socket
+import struct
+import time
+
+import whosonline.hostindex as hostindex
+import whosonline.netlink as netlink
+
+# neighbour states, see include/uapi/linux/neighbour.h
+NUD_INCOMPLETE = 0x01
+NUD_REACHABLE = 0x02
+NUD_STALE = 0x04
+NUD_DELAY = 0x08
+NUD_PROBE = 0x10
+NUD_FAILED = 0x20
+NUD_NOARP = 0x40
+NUD_PERMANENT = 0x80
+
+# states meaning the kernel has a usable link layer address
+NUD_VALID = NUD_REACHABLE | NUD_STALE | NUD_DELAY | NUD_PROBE | NUD_PERMANENT
+
+NDA_DST = 1
+NDA_LLADDR = 2
+
+NDMSG = struct.Struct('=BxxxiHBB')
+
+PROC_ARP = '/proc/net/arp'
+
+
+class Neighbour:
+
+    def __init__(self, ip, mac, interface, state):
+        self.ip = ip
+        self.mac = mac
+        self.interface = interface
+        self.state = state
+        self.updated = time.monotonic()
+
+    @property
+    def valid(self):
+        return bool(self.state & NUD_VALID)
+
+    @property
+    def reachable(self):
+        '''confirmed by the kernel within the last reachable_time'''
+        return bool(self.state & NUD_REACHABLE)
+
+    def __repr__(self):
+        return '<Neighbour %s %s on %s state 0x%02x>' % (
+            self.ip, self.mac, self.interface, self.state
+        )
+
+
+def _interface_name(ifindex):
+    try:
+        return socket.if_indextoname(ifindex)
+    except OSError:
+        return str(ifindex)
+
+
+def parse_neighbour(message_type, payload):
+    '''returns (deleted, Neighbour) for a RTM_*NEIGH message or None'''
+    if len(payload) < NDMSG.size:
+        return None
+    family, ifindex, state, flags, ntype = NDMSG.unpack_from(payload)
+    if family not in (socket.AF_INET, socket.AF_INET6):
+        return None
+    attrs = netlink.parse_attributes(payload, NDMSG.size)
+    if NDA_DST not in attrs:
+        return None
+    ip = socket.inet_ntop(family, attrs[NDA_DST])
+    mac = attrs.get(NDA_LLADDR)
+    mac = ':'.join('%02x' % byte for byte in mac) if mac else None
+    neighbour = Neighbour(ip, mac, _interface_name(ifindex), state)
+    return message_type == netlink.RTM_DELNEIGH, neighbour
+
+
+def read_proc_arp(path=PROC_ARP):
+    '''fallback for systems without rtnetlink, ipv4 only'''
+    neighbours = []
+    with open(path) as proc_arp:
+        next(proc_arp)  # header
+        for line in proc_arp:
+            fields = line.split()
+            if len(fields) < 6:
+                continue
+            ip, hw_type, flags, mac, mask, interface = fields[:6]
+            # ATF_COM (0x2) marks completed entries
+            state = NUD_REACHABLE if int(flags, 16) & 0x2 else NUD_INCOMPLETE
+            neighbours.append(Neighbour(ip, mac, interface, state))
+    return neighbours
+
+
+class NeighbourTable:
+    '''Mirror of the kernel neighbour (arp/ndp) cache. Seeded by dump(),
+    kept current by watch() following netlink neighbour events.'''
+
+    def __init__(self):
+        self.entries = {}
+        # callables getting (ip, neighbour or None) on every change
+        self.listeners = []
+
+    def _apply(self, deleted, neighbour):
+        if deleted or not neighbour.valid:
+            if self.entries.pop(neighbour.ip, None) is not None:
+                self._notify(neighbour.ip, None)
+            return
+        known = self.entries.get(neighbour.ip)
+        self.entries[neighbour.ip] = neighbour
+        if known is None or known.mac != neighbour.mac:
+            self._notify(neighbour.ip, neighbour)
+
+    def _notify(self, ip, neighbour):
+        for listener in self.listeners:
+            listener(ip, neighbour)
+
+    def dump(self):
+        '''read the complete table once'''
+        try:
+            messages = netlink.dump(netlink.RTM_GETNEIGH, NDMSG.pack(0, 0, 0, 0, 0))
+            for message_type, payload in messages:
+                parsed = parse_neighbour(message_type, payload)
+                if parsed is not None:
+                    self._apply(*parsed)
+        except OSError:
+            for neighbour in read_proc_arp():
+                self._apply(False, neighbour)
+        return self
+
+    async def watch(self):
+        '''follow neighbour events until cancelled'''
+        sock = netlink.subscribe(netlink.RTMGRP_NEIGH)
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+
+        def on_readable():
+            for message in netlink.receive(sock):
+                queue.put_nowait(message)
+
+        loop.add_reader(sock.fileno(), on_readable)
+        try:
+            while True:
+                message_type, payload = await queue.get()
+                parsed = parse_neighbour(message_type, payload)
+                if parsed is not None:
+                    self._apply(*parsed)
+        finally:
+            loop.remove_reader(sock.fileno())
+            sock.close()
+
+    def get(self, ip):
+        return self.entries.get(ip)
+
+    def reachable(self, ip):
+        '''True if the kernel recently confirmed ip, no probe needed'''
+        neighbour = self.entries.get(ip)
+        return neighbour is not None and neighbour.reachable
+
+    def in_network(self, network):
+        '''Neighbours inside network, one or more, see
+        hostindex.parse_networks'''
+        networks = hostindex.parse_networks(network)
+        for neighbour in list(self.entries.values()):
+            if in_scope(neighbour, networks):
+                yield neighbour
+
+
+def in_scope(neighbour, network):
+    '''True if neighbour belongs to network. Neighbours of an address
+    family not scanned are left out, the probes could not check them.'''
+    address = ipaddress.ip_address(neighbour.ip)
+    return any(
+        address in net for net in hostindex.parse_networks(network)
+        if net.version == address.version
+    )
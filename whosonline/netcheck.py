@@ -21,16 +21,48 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import ipaddress
 import socket
 import subprocess
 import asyncio
 
+import whosonline.arp as arp
+import whosonline.hostindex as hostindex
+import whosonline.icmp as icmp
+import whosonline.metrics as metrics
+import whosonline.notifications as notifications
+import whosonline.process as process
+import whosonline.resolver as resolver
+import whosonline.routes as routes
+import whosonline.scheduler as scheduler
+
 # import os
 
 # some hosts may not have to be checked, e.g. routers
 OMIT_HOSTS = ['fritz', 'Teleball', ]
 
+# shared reverse dns cache, reused across scan cycles
+RESOLVER = resolver.Resolver()
+
+# cached kernel routing table, see routes.RouteTable.watch
+ROUTES = routes.RouteTable()
+
+# liveness probes available for the netcheck loops
+PROBES = ('arp', 'icmp')
+
+# seconds a fallback ping/arping process may overrun its own deadline
+KILL_SLACK = 2
+
+_sync_loop = None
+
+
+def _run_sync(coro):
+    '''drive coro on a private event loop for the blocking api, so probe
+    engines (and their sockets) survive between calls'''
+    global _sync_loop
+    if _sync_loop is None:
+        _sync_loop = asyncio.new_event_loop()
+    return _sync_loop.run_until_complete(coro)
+
 
 def safe_syscall(cmds, raisemode=False):
     '''Send a command and return both the return code and the output.  If
@@ -58,62 +90,139 @@ def safe_syscall(cmds, raisemode=False):
 
 def get_routes():
     '''
-    returns list of dictionaries containing routes on system
+    returns list of dictionaries containing ipv4 routes on system
     '''
+    ROUTES._ensure_loaded()
+    for route in ROUTES.routes:
+        if route.network.version == 4:
+            yield route.as_dict()
+
 
-    # route -n parsed by hand
-    returncode, output = safe_syscall(['route', '-n'])
-    routes_raw = output.decode('utf-8').split('\n')[2:]
-    for line_raw in routes_raw:
-        line = line_raw.split()
-        line = [word for word in line if word]
-        if not line:
-            continue
-        route = {
-            'Destination': line[0],
-            'Gateway': line[1],
-            'Genmask': line[2],
-            'Interface': line[-1]
-        }
-        yield route
+async def async_get_routes():
+    '''ASYNC VERSION of get_routes, the table is read in a worker thread'''
+    await ROUTES.refresh()
+    return list(get_routes())
 
 
 def get_netdevice(network_address):
-    '''get network device which is associated to the given network'''
-    for route in get_routes():
-        if route['Destination'] == network_address:
-            return route['Interface']
+    '''get network device which is associated to the given network or
+    address, using the most specific route covering it. The default route
+    is ignored.'''
+    route = ROUTES.lookup(network_address, min_prefixlen=1)
+    if route is not None:
+        return route.interface
 
 
-def notify(head, message):
-    '''using notify-send shell command to visualize online status nicely. Other
-    methods of notification (e.g. mail) may be implemented here.'''
-    cmd = ['notify-send', head, message]
-    returncode, output = safe_syscall(cmd)
+async def async_get_netdevice(network_address):
+    '''ASYNC VERSION of get_netdevice'''
+    route = await ROUTES.resolve(network_address, min_prefixlen=1)
+    if route is not None:
+        return route.interface
 
 
 def ping(hostname):
-    '''use ping shell command to determine if device behind hostname is online
-    '''
+    '''use icmp echo requests to determine if device behind hostname is
+    online. Falls back to the ping shell command without icmp socket.'''
     # send 5 packets and wait for a maximum of 5 seconds for the response
-    command = "ping -c 5 -w 5 " + hostname
-    returncode, output = safe_syscall(command.split())
-    if returncode == 0:
-        return True
-    else:
-        return False
+    return _run_sync(async_ping(hostname))
+
+
+async def async_ping(hostname, count=5, timeout=5, priority=process.BACKGROUND):
+    '''ASYNC VERSION of ping, hostnames are resolved without blocking'''
+    online, rtt = await async_ping_rtt(hostname, count, timeout, priority)
+    return online
+
+
+async def async_ping_rtt(hostname, count=5, timeout=5, priority=process.BACKGROUND):
+    '''(online, average round trip time in seconds). The rtt is None if
+    the ping command had to be used.'''
+    try:
+        with metrics.timed(metrics.PROBE_LATENCY, probe='icmp'):
+            result = await icmp.ping(
+                hostname, count=count, interval=timeout / count / 2,
+                timeout=timeout / 2
+            )
+        return result.alive, result.rtt
+    except icmp.IcmpUnavailable:
+        pass
+    command = ['ping', '-c', str(count), '-w', str(timeout), hostname]
+    with metrics.timed(metrics.PROBE_LATENCY, probe='ping'):
+        returncode, output = await process.Command(
+            command, timeout + KILL_SLACK, priority=priority
+        ).run()
+    return returncode == 0, None
+
+
+async def ping_many(ip_addresses, count=5, timeout=5):
+    '''ASYNC VERSION of ping for many hosts at once, returns dict mapping
+    ip to online status. All hosts share a single icmp socket.'''
+    try:
+        with metrics.timed(metrics.PROBE_LATENCY, probe='icmp sweep'):
+            results = await icmp.ping_many(
+                ip_addresses, count=count, interval=timeout / count / 2,
+                timeout=timeout / 2
+            )
+        return {ip: result.alive for ip, result in results.items()}
+    except icmp.IcmpUnavailable:
+        pass
+    results = {}
+    for ip in ip_addresses:
+        command = ['ping', '-c', str(count), '-w', str(timeout), ip]
+        with metrics.timed(metrics.PROBE_LATENCY, probe='ping'):
+            returncode, output = await process.Command(command, timeout + KILL_SLACK).run()
+        results[ip] = returncode == 0
+    return results
 
 
 def arping(ip_address, interface):
-    '''use arping shell command to determine if device behind ip-address is
-    online. sends ethernet frames which should not be dropped by firewalls.'''
+    '''use arp requests to determine if device behind ip-address is online.
+    sends ethernet frames which should not be dropped by firewalls. Falls back
+    to the arping shell command if no raw socket can be opened.'''
     # send 5 packets and wait for a maximum of 5 seconds for the response
-    command = "arping -c 5 -w 5 -I " + interface + "  " + ip_address
-    returncode, output = safe_syscall(command.split())
-    if returncode == 0:
-        return True
-    else:
-        return False
+    return _run_sync(async_arping(ip_address, interface))
+
+
+async def async_arping(ip_address, interface, timeout=5, frame_count=5,
+                       priority=process.BACKGROUND):
+    '''ASYNC VERSION of arping'''
+    try:
+        with metrics.timed(metrics.PROBE_LATENCY, probe='arp'):
+            return await arp.arping(ip_address, interface, timeout, frame_count)
+    except arp.ArpUnavailable:
+        pass
+    command = [
+        'arping', '-f', '-c', str(frame_count), '-w', str(timeout),
+        '-I', interface, ip_address
+    ]
+    with metrics.timed(metrics.PROBE_LATENCY, probe='arping'):
+        returncode, output = await process.Command(
+            command, timeout + KILL_SLACK, priority=priority
+        ).run()
+    return returncode == 0
+
+
+async def arping_many(ip_addresses, interface, timeout=5, frame_count=5):
+    '''ASYNC VERSION of arping for many hosts at once, returns dict mapping
+    ip to online status. A single arp sweep is used if possible.'''
+    try:
+        with metrics.timed(metrics.PROBE_LATENCY, probe='arp sweep'):
+            alive = await arp.sweep(
+                ip_addresses, interface,
+                timeout=timeout / frame_count, retries=frame_count - 1
+            )
+        return {ip: ip in alive for ip in ip_addresses}
+    except arp.ArpUnavailable:
+        pass
+    results = {}
+    for ip in ip_addresses:
+        command = [
+            'arping', '-c', str(frame_count), '-w', str(timeout),
+            '-I', interface, ip
+        ]
+        with metrics.timed(metrics.PROBE_LATENCY, probe='arping'):
+            returncode, output = await process.Command(command, timeout + KILL_SLACK).run()
+        results[ip] = returncode == 0
+    return results
 
 
 def get_hostname(ip_address):
@@ -126,29 +235,62 @@ def get_hostname(ip_address):
         raise
 
 
-def get_ips(network_obj):
-    '''Get ip objects from network. Filter useless adresses'''
-    if isinstance(network_obj, str):
-        network_obj = ipaddress.ip_network(network_obj, strict=True)
-    network_adress = network_obj.network_address
-    broadcast_address = network_obj.broadcast_address
-    for address_obj in network_obj:
-        if address_obj == network_adress:
-            continue
-        if address_obj == broadcast_address:
-            continue
-        yield str(address_obj)
+async def async_get_hostname(ip_address):
+    '''ASYNC VERSION of get_hostname, cached and resolved in the
+    resolver's thread pool'''
+    return await RESOLVER.resolve(ip_address)
+
+
+def get_ips(network_obj, shard=0, shards=1):
+    '''Get ip strings from one or more networks, generated lazily. Filter
+    useless adresses. Use shard/shards to only walk a part of the ranges.'''
+    return hostindex.address_space(network_obj).ips(shard, shards)
+
+
+def group_by_interface(ip_addresses, fallback=None):
+    '''dict interface -> list of ips, routes looked up per address'''
+    groups = {}
+    for ip in ip_addresses:
+        interface = get_netdevice(ip) or fallback
+        groups.setdefault(interface, []).append(ip)
+    return groups
+
+
+async def async_group_by_interface(ip_addresses, fallback=None):
+    '''ASYNC VERSION of group_by_interface'''
+    await ROUTES.refresh()
+    return group_by_interface(ip_addresses, fallback)
 
 
-def get_hostnames(network_obj, filter_hosts=True):
+def get_hostnames(network_obj, filter_hosts=True, resolver=None):
+    '''yield (ip, hostname) for all resolvable hosts in network. Lookups run
+    concurrently and are cached, so results may come out of order.'''
+    if not filter_hosts:
+        for ip in get_ips(network_obj):
+            yield ip, ip
+        return
+    resolver = resolver or RESOLVER
     myhost = socket.gethostname()
-    for ip in get_ips(network_obj):
-        host = get_hostname(ip)
-        if filter_hosts:
-            if host and host != myhost:
-                yield ip, host
-        else:
+    for ip, host in resolver.resolve_iter(get_ips(network_obj)):
+        if host and host != myhost:
+            yield ip, host
+
+
+async def async_get_hostnames(network_obj, filter_hosts=True, resolver=None,
+                              progress=None):
+    '''ASYNC VERSION of get_hostnames, never blocks the event loop. If given,
+    progress(ip, hostname) is called for every finished lookup.'''
+    if not filter_hosts:
+        for ip in get_ips(network_obj):
             yield ip, ip
+        return
+    resolver = resolver or RESOLVER
+    myhost = socket.gethostname()
+    async for ip, host in resolver.resolve_many(get_ips(network_obj)):
+        if progress is not None:
+            progress(ip, host)
+        if host and host != myhost:
+            yield ip, host
 
 
 def netcheck_main(network):
@@ -161,12 +303,11 @@ def netcheck_main(network):
     # save results to show notifications if something changes
     results = {}
 
-    # set up network object and build ip strings from it using get_ips filter
-    network_obj = ipaddress.ip_network(network, strict=True)
-    ip_addresses = [str(address_obj) for address_obj in get_ips(network_obj)]
+    # set up address space of all networks, ip strings are built lazily
+    ip_addresses = hostindex.address_space(network)
 
     # get the network device responsible for given network
-    netdevice = get_netdevice(network.split('/')[0])  # cut off cidr netmask
+    netdevice = get_netdevice(ip_addresses.networks[0])
 
     # get local hostname to add to OMIT_HOSTS list
     local_hostname = socket.gethostname()
@@ -176,58 +317,62 @@ def netcheck_main(network):
     assert netdevice, "Unable to find network device belonging to network %s" % network
     print('Device associated to network %s : %s' % (network, netdevice))
 
+    if not notifications.BUS.sinks:
+        notifications.configure()
+
     # main loop
     while True:
+        # changes of a sweep go out together
+        _run_sync(notifications.BUS.deliver_now())
         for ip_str in ip_addresses:
-            hostname = get_hostname(ip_str)
+            hostname = RESOLVER.lookup(ip_str)
             if hostname and hostname not in OMIT_HOSTS:
                 last_result = results.get(hostname)
-                ping_result = arping(ip_str, netdevice)  # or ping(hostname)
-                # notify if status changes --> DEACTIVATED!
+                # or ping(hostname)
+                ping_result = arping(ip_str, get_netdevice(ip_str) or netdevice)
+                # notify if status changes, see notifications.configure
                 if (last_result is not None) and (last_result != ping_result):
-                    notify(hostname, 'Online' if ping_result else 'Offline')
+                    notifications.publish(
+                        notifications.ONLINE if ping_result else notifications.OFFLINE,
+                        ip_str, hostname
+                    )
                 # save new result
                 if hostname not in results:
-                    notify('New host found!', hostname)
+                    notifications.publish(notifications.NEW, ip_str, hostname)
                 results[hostname] = ping_result
                 # LOGGER.info('Host %s online: %s' % (hostname, ping_result))
                 print('Host %s online: %s' % (hostname, ping_result))
 
 
-async def netcheck_loop(network):
+async def netcheck_loop(network, probe='arp', passive=False,
+                        min_interval=scheduler.POLL_MIN_INTERVAL,
+                        max_interval=scheduler.POLL_MAX_INTERVAL):
     '''
-    ASYNC VERSION of netcheck main
-    Main function of netcheck module called from executable
+    ASYNC VERSION of netcheck main, kept for callers of this module: the
+    hosts of network are checked by loops.netcheck_loop, which the shell
+    and the daemon run as well. probe is either 'arp' or 'icmp', the latter
+    works for routed networks. passive skips probing hosts the kernel
+    neighbour table reports reachable.
     '''
+    # loops imports this module
+    import whosonline.loops as loops
 
-    # import logfacility
-    # LOGGER = logfacility.build_logger()
-
-    # save results to show notifications if something changes
-    results = {}
-
-    # set up network object and build ip strings from it using get_ips filter
-    network_obj = ipaddress.ip_network(network, strict=True)
-    ip_addresses = [str(address_obj) for address_obj in get_ips(network_obj)]
-
-    # get the network device responsible for given network
-    netdevice = get_netdevice(network.split('/')[0])  # cut off cidr netmask
-
-    # get local hostname to add to OMIT_HOSTS list
-    local_hostname = socket.gethostname()
-    OMIT_HOSTS.append(local_hostname)
-
-    # abort if not device can be found
-    assert netdevice, "Unable to find network device belonging to network %s" % network
+    ip_addresses = hostindex.address_space(network)
+    netdevice = await async_get_netdevice(ip_addresses.networks[0])
+    # abort if not device can be found, icmp works without
+    assert netdevice or probe == 'icmp', "Unable to find network device belonging to network %s" % network
     print('Device associated to network %s : %s' % (network, netdevice))
 
-    # main loop
-    while True:
-        for ip_str in ip_addresses:
-            hostname = get_hostname(ip_str)
-            if hostname and hostname not in OMIT_HOSTS:
-                last_result = results.get(hostname)
-                ping_result = arping(ip_str, netdevice)  # or ping(hostname)
-                results[hostname] = ping_result
-                print('Host %s online: %s' % (hostname, ping_result))
-                await asyncio.sleep(2)
+    hosts_d = await loops.get_hosts(ip_addresses, False)
+    passive_task = None
+    if passive:
+        passive_task = loops.start_passive_discovery(ip_addresses, hosts_d, False)
+    try:
+        await loops.netcheck_loop(
+            hosts_d, netdevice, probe, min_interval, max_interval
+        )
+    finally:
+        if passive_task is not None:
+            # stops the neighbour watcher and its socket
+            passive_task.cancel()
+            await asyncio.gather(passive_task, return_exceptions=True)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# netlink.py - minimal rtnetlink client, just enough to read kernel tables
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+import struct
+
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+RTM_GETNEIGH = 30
+
+# multicast groups (legacy bitmask form)
+RTMGRP_NEIGH = 0x4
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_ROUTE = 0x400
+
+NLMSGHDR = struct.Struct('=IHHII')
+RTATTR = struct.Struct('=HH')
+
+RECV_SIZE = 65536
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def parse_attributes(data, offset):
+    '''rtattr list starting at offset, returns dict type -> raw value'''
+    attrs = {}
+    while offset + RTATTR.size <= len(data):
+        length, attr_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[attr_type] = data[offset + RTATTR.size:offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def parse_messages(data):
+    '''split a netlink datagram into (type, payload) tuples'''
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        length, message_type, flags, seq, pid = NLMSGHDR.unpack_from(data, offset)
+        if length < NLMSGHDR.size:
+            break
+        yield message_type, data[offset + NLMSGHDR.size:offset + length]
+        offset += _align(length)
+
+
+def open_socket(groups=0):
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    sock.bind((0, groups))
+    return sock
+
+
+def dump(message_type, payload, seq=1):
+    '''send a dump request, returns list of (type, payload) of all answers.
+    Raises OSError if rtnetlink is not available.'''
+    if not hasattr(socket, 'AF_NETLINK'):
+        raise OSError('netlink not supported on this platform')
+    with open_socket() as sock:
+        header = NLMSGHDR.pack(
+            NLMSGHDR.size + len(payload), message_type,
+            NLM_F_REQUEST | NLM_F_DUMP, seq, 0
+        )
+        sock.send(header + payload)
+        messages = []
+        while True:
+            data = sock.recv(RECV_SIZE)
+            for answer_type, answer in parse_messages(data):
+                if answer_type == NLMSG_DONE:
+                    return messages
+                if answer_type == NLMSG_ERROR:
+                    errno = struct.unpack_from('=i', answer)[0]
+                    if errno:
+                        raise OSError(-errno, 'netlink dump failed')
+                    continue
+                messages.append((answer_type, answer))
+
+
+def subscribe(groups):
+    '''non blocking socket receiving events of the given multicast groups'''
+    if not hasattr(socket, 'AF_NETLINK'):
+        raise OSError('netlink not supported on this platform')
+    sock = open_socket(groups)
+    sock.setblocking(False)
+    return sock
+
+
+def receive(sock):
+    '''all messages currently waiting on a non blocking socket'''
+    messages = []
+    while True:
+        try:
+            data = sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return messages
+        messages.extend(parse_messages(data))
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+#
+# nmapxml.py - run nmap against many targets and parse its xml output while
+# it streams in
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import time
+import xml.etree.ElementTree as ET
+
+import whosonline.metrics as metrics
+import whosonline.process as process
+import whosonline.results as results
+
+NMAP = 'nmap'
+
+# number of targets handed to a single nmap process
+BATCH_SIZE = 16
+
+CHUNK_SIZE = 65536
+
+# seconds results of on-demand scans are reused
+SCAN_CACHE_TTL = 600
+
+SCAN_CACHE_LOOKUPS = metrics.Counter(
+    'whosonline_scan_cache_lookups_total',
+    'On-demand scans answered from cache (hit), by a running scan (shared) or by a new one (miss)',
+    labels=('result',)
+)
+
+
+class ScanFailed(OSError):
+    '''nmap did not finish a scan: it failed, timed out or its output
+    broke off'''
+
+
+def offline_result():
+    return results.Host(online=False)
+
+
+def parse_host(host_elem):
+    '''Turn a <host> element into (addresses, result). addresses contains
+    every name nmap knows the host by (ip, user given name), result is a
+    results.Host.'''
+    addresses = []
+    mac = None
+    os = None
+    ports = []
+
+    status = host_elem.find('status')
+    online = status is not None and status.get('state') == 'up'
+
+    for address in host_elem.iter('address'):
+        if address.get('addrtype') == 'mac':
+            mac = address.get('addr')
+            vendor = address.get('vendor')
+            if vendor:
+                mac = '%s (%s)' % (mac, vendor)
+        else:
+            addresses.append(address.get('addr'))
+
+    for hostname in host_elem.iter('hostname'):
+        if hostname.get('type') == 'user':
+            addresses.append(hostname.get('name'))
+
+    for port in host_elem.iter('port'):
+        state = port.find('state')
+        service = port.find('service')
+        version = None
+        if service is not None and service.get('method') == 'probed':
+            words = [service.get('product'), service.get('version')]
+            if service.get('extrainfo'):
+                words.append('(%s)' % service.get('extrainfo'))
+            version = ' '.join(word for word in words if word)
+        ports.append(results.make_port(
+            port.get('portid'), port.get('protocol'),
+            state.get('state') if state is not None else 'unknown',
+            service.get('name') if service is not None else 'unknown',
+            version
+        ))
+
+    osmatch = host_elem.find('os/osmatch')
+    if osmatch is not None:
+        os = osmatch.get('name')
+
+    return addresses, results.Host(online, mac, os, ports)
+
+
+class NmapXMLStream:
+    '''Incremental parser for `nmap -oX -` output. Feed it chunks of bytes,
+    it hands back (addresses, result) for every host completed so far.
+    Finished host elements are dropped, memory stays flat for long runs.'''
+
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._root = None
+        self.broken = False
+
+    def _events(self):
+        parsed = []
+        try:
+            for event, elem in self._parser.read_events():
+                if event == 'start':
+                    if self._root is None:
+                        self._root = elem
+                    continue
+                if elem.tag != 'host':
+                    continue
+                parsed.append(parse_host(elem))
+                elem.clear()
+                if self._root is not None and elem in self._root:
+                    self._root.remove(elem)
+        except ET.ParseError:
+            self.broken = True
+        return parsed
+
+    def feed(self, data):
+        if self.broken:
+            return []
+        try:
+            self._parser.feed(data)
+        except ET.ParseError:
+            self.broken = True
+        return self._events()
+
+    def close(self):
+        if self.broken:
+            return []
+        try:
+            self._parser.close()
+        except ET.ParseError:
+            # nmap died mid-run (e.g. missing privileges for -O)
+            self.broken = True
+        return self._events()
+
+
+def _matched(parsed, remaining):
+    '''(target, result) for parsed hosts we asked for'''
+    for addresses, result in parsed:
+        for address in addresses:
+            if address in remaining:
+                remaining.discard(address)
+                yield address, result
+                break
+
+
+async def nmap_batch(targets, mode='-F', timeout=None,
+                     priority=process.BACKGROUND, ports=None, check=False):
+    '''Async generator running a single nmap process for all targets,
+    yielding (target, result) as soon as nmap finishes each host. Targets
+    nmap does not report on are yielded as offline when the run is over,
+    or when it is killed after timeout seconds. With check, ScanFailed is
+    raised instead if the run did not finish properly. ports limits the
+    scan to the given nmap port list, e.g. '22,80'.'''
+    targets = list(targets)
+    if not targets:
+        return
+    remaining = set(targets)
+    options = [mode]
+    if ports:
+        options += ['-p', ports]
+    command = process.Command(
+        [NMAP, '-oX', '-'] + options + targets, timeout=timeout, priority=priority
+    )
+    stream = NmapXMLStream()
+    async for data in command.chunks(CHUNK_SIZE):
+        for item in _matched(stream.feed(data), remaining):
+            yield item
+    for item in _matched(stream.close(), remaining):
+        yield item
+    if command.runtime is not None:
+        metrics.PROBE_LATENCY.observe(command.runtime, probe='nmap ' + mode)
+
+    if check and remaining:
+        if command.timed_out:
+            raise ScanFailed('nmap %s timed out' % mode)
+        if command.returncode != 0:
+            raise ScanFailed('nmap %s exited with %s' % (mode, command.returncode))
+        if stream.broken:
+            raise ScanFailed('nmap %s output broke off' % mode)
+    for target in targets:
+        if target in remaining:
+            yield target, offline_result()
+
+
+async def nmap_scan(target, mode='-F', timeout=None, priority=process.BACKGROUND,
+                    ports=None, check=False):
+    '''scan a single target, returns a results.Host. With check a failed
+    run raises ScanFailed instead of counting as offline.'''
+    result = offline_result()
+    async for address, result in nmap_batch(
+        [target], mode, timeout, priority, ports, check
+    ):
+        pass
+    return result
+
+
+class ScanCache:
+    '''Results of single host scans by (target, mode), kept `ttl` seconds.
+
+    Scans are single-flight: asking for a key whose scan is still running
+    waits for that scan instead of starting another nmap. A waiter giving
+    up does not cancel the scan for the others. Failed scans raise
+    ScanFailed to every waiter and are not kept.
+    '''
+
+    def __init__(self, ttl=SCAN_CACHE_TTL, maxsize=1024, scan=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.scan_func = scan or nmap_scan
+        # (target, mode) -> (finished, result)
+        self._cache = {}
+        # (target, mode) -> future of the running scan
+        self._running = {}
+
+    def cached(self, target, mode):
+        '''returns (result, age in seconds), (None, None) if not cached'''
+        entry = self._cache.get((target, mode))
+        if entry is None:
+            return None, None
+        finished, result = entry
+        age = time.monotonic() - finished
+        if age > self.ttl:
+            del self._cache[(target, mode)]
+            return None, None
+        return result, age
+
+    def store(self, target, mode, result):
+        if len(self._cache) >= self.maxsize:
+            self.prune()
+        self._cache[(target, mode)] = (time.monotonic(), result)
+
+    def prune(self):
+        '''drop expired entries, or the oldest half if nothing expired'''
+        now = time.monotonic()
+        expired = [
+            key for key, (finished, _) in self._cache.items()
+            if now - finished > self.ttl
+        ]
+        if not expired:
+            expired = list(self._cache)[:len(self._cache) // 2]
+        for key in expired:
+            del self._cache[key]
+
+    def invalidate(self, target=None):
+        if target is None:
+            self._cache.clear()
+            return
+        for key in [key for key in self._cache if key[0] == target]:
+            del self._cache[key]
+
+    def running(self, target, mode):
+        return (target, mode) in self._running
+
+    def _finished(self, key, future):
+        self._running.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            self.store(key[0], key[1], future.result())
+
+    async def scan(self, target, mode, force=False, **kwargs):
+        '''Returns (result, age). age is None if this call started the scan
+        and 0 if it joined a running one. force skips the cached result, a
+        running scan is joined anyway since it is fresh.'''
+        key = (target, mode)
+        if not force:
+            result, age = self.cached(target, mode)
+            if result is not None:
+                SCAN_CACHE_LOOKUPS.inc(result='hit')
+                return result, age
+        future = self._running.get(key)
+        if future is not None:
+            SCAN_CACHE_LOOKUPS.inc(result='shared')
+            return await asyncio.shield(future), 0
+        SCAN_CACHE_LOOKUPS.inc(result='miss')
+        future = asyncio.ensure_future(
+            self.scan_func(target, mode, check=True, **kwargs)
+        )
+        self._running[key] = future
+        future.add_done_callback(lambda future: self._finished(key, future))
+        return await asyncio.shield(future), None
+
+
+def batches(items, size=BATCH_SIZE):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def scan_many(targets, mode='-F', batch_size=BATCH_SIZE, concurrency=1):
+    '''Async generator scanning all targets with up to `concurrency` nmap
+    processes, each handling `batch_size` targets. Results are merged into
+    one stream of (target, result) in order of completion.'''
+    queue = asyncio.Queue()
+    done = object()
+    batch_iter = batches(targets, batch_size)
+
+    async def worker():
+        for batch in batch_iter:
+            async for item in nmap_batch(batch, mode):
+                queue.put_nowait(item)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    for task in workers:
+        task.add_done_callback(lambda task: queue.put_nowait(done))
+    running = len(workers)
+    try:
+        while running:
+            item = await queue.get()
+            if item is done:
+                running -= 1
+                continue
+            yield item
+        # surface exceptions raised inside workers
+        for task in workers:
+            task.result()
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+# on-demand scans of the shell
+SCAN_CACHE = ScanCache()
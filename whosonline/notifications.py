@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+#
+# notifications.py - host events collected on a bus, coalesced into
+# summaries and handed to sinks (desktop, file, webhook, log) which each
+# deliver at their own pace
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+import urllib.parse
+import urllib.request
+
+import whosonline.metrics as metrics
+import whosonline.process as process
+
+ONLINE = 'online'
+OFFLINE = 'offline'
+NEW = 'new'
+
+# seconds without new events before a summary goes out
+DEBOUNCE = 2.0
+# seconds a summary waits at most while events keep coming
+MAX_DELAY = 10.0
+# summaries queued per sink, the oldest are dropped beyond
+QUEUE_SIZE = 100
+# events listed one by one, more are only counted
+MAX_LISTED = 5
+# seconds a single delivery may take
+DELIVERY_TIMEOUT = 10
+# sinks used unless others are configured, like netcheck always did
+DEFAULT_SINKS = ('desktop',)
+
+LOGGER = logging.getLogger('WhosOnline')
+
+NOTIFICATIONS = metrics.Counter(
+    'whosonline_notifications_total',
+    'Summaries handled per sink: sent, failed or dropped from a full queue',
+    labels=('sink', 'result')
+)
+
+
+class Event:
+
+    __slots__ = ('kind', 'ip', 'hostname', 'ts')
+
+    def __init__(self, kind, ip, hostname=None, ts=None):
+        self.kind = kind
+        self.ip = ip
+        self.hostname = hostname or ip
+        self.ts = ts or time.time()
+
+    def __str__(self):
+        if self.kind == NEW:
+            return 'New host %s' % self.hostname
+        return '%s is %s' % (self.hostname, self.kind)
+
+    def as_dict(self):
+        return {'kind': self.kind, 'ip': self.ip, 'host': self.hostname, 'ts': self.ts}
+
+
+class Summary:
+    '''Events of one burst, at most one per host'''
+
+    def __init__(self, events):
+        self.events = events
+        self.counts = collections.Counter(event.kind for event in events)
+
+    @classmethod
+    def merge(cls, summaries):
+        '''one summary of several, the latest event of a host wins'''
+        if len(summaries) == 1:
+            return summaries[0]
+        events = {}
+        for summary in summaries:
+            for event in summary.events:
+                events[event.ip] = event
+        return cls(list(events.values()))
+
+    @property
+    def title(self):
+        if len(self.events) == 1:
+            return 'WhosOnline: %s' % self.events[0]
+        return 'WhosOnline: %s' % ', '.join(
+            '%s %s' % (self.counts[kind], kind)
+            for kind in (NEW, ONLINE, OFFLINE) if self.counts[kind]
+        )
+
+    def lines(self, max_listed=MAX_LISTED):
+        lines = [str(event) for event in self.events[:max_listed]]
+        if len(self.events) > max_listed:
+            lines.append('and %s more' % (len(self.events) - max_listed))
+        return lines
+
+    def as_dict(self):
+        return {
+            'ts': time.time(),
+            'counts': dict(self.counts),
+            'events': [event.as_dict() for event in self.events],
+        }
+
+
+class Sink:
+    '''Delivers summaries from its own bounded queue, at most one per
+    min_interval seconds. Summaries piling up meanwhile are merged into
+    one, so a slow or rate limited sink never holds up the others or the
+    probes.'''
+
+    name = 'sink'
+    min_interval = 0
+
+    def __init__(self, min_interval=None, queue_size=QUEUE_SIZE):
+        if min_interval is not None:
+            self.min_interval = min_interval
+        self.queue = collections.deque(maxlen=queue_size)
+        self._ready = asyncio.Event()
+        self._last = None
+
+    def put(self, summary):
+        if len(self.queue) == self.queue.maxlen:
+            NOTIFICATIONS.inc(sink=self.name, result='dropped')
+        self.queue.append(summary)
+        self._ready.set()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self._ready.wait()
+            if self._last is not None:
+                wait = self._last + self.min_interval - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            self._ready.clear()
+            summaries = list(self.queue)
+            self.queue.clear()
+            if not summaries:
+                continue
+            self._last = loop.time()
+            await self.send(Summary.merge(summaries))
+
+    async def send(self, summary):
+        '''deliver summary and count the result, a failure never ends the
+        sink'''
+        try:
+            sent = await self.deliver(summary)
+        except (OSError, asyncio.TimeoutError) as e:
+            print('Notification to %s failed: %s' % (self.name, e), file=sys.stderr)
+            sent = False
+        except Exception:
+            LOGGER.exception('Notification to %s failed', self.name)
+            sent = False
+        NOTIFICATIONS.inc(sink=self.name, result='sent' if sent else 'failed')
+        return sent
+
+    async def deliver(self, summary):
+        '''send summary, returns True on success'''
+        raise NotImplementedError
+
+
+class DesktopSink(Sink):
+    '''notify-send popups, one per burst'''
+
+    name = 'desktop'
+    min_interval = 10
+    missing = False
+
+    async def deliver(self, summary):
+        if shutil.which('notify-send') is None:
+            # e.g. a server, say it once instead of failing every burst
+            if not self.missing:
+                print('notify-send not found, no desktop notifications', file=sys.stderr)
+                self.missing = True
+            return False
+        command = process.Command(
+            ['notify-send', summary.title, '\n'.join(summary.lines())],
+            timeout=DELIVERY_TIMEOUT
+        )
+        returncode, output = await command.run()
+        return returncode == 0
+
+
+class FileSink(Sink):
+    '''appends every summary as a json line'''
+
+    name = 'file'
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = os.path.expanduser(path)
+
+    def _write(self, line):
+        with open(self.path, 'a') as f:
+            f.write(line + '\n')
+
+    async def deliver(self, summary):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._write, json.dumps(summary.as_dict()))
+        return True
+
+
+class WebhookSink(Sink):
+    '''posts every summary as json to url, meant for a local endpoint'''
+
+    name = 'webhook'
+    min_interval = 1
+
+    def __init__(self, url, **kwargs):
+        super().__init__(**kwargs)
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError('Webhook url %r needs http(s)://host' % url)
+        self.url = url
+
+    def _post(self, body):
+        request = urllib.request.Request(
+            self.url, data=body, headers={'Content-Type': 'application/json'}
+        )
+        with urllib.request.urlopen(request, timeout=DELIVERY_TIMEOUT) as response:
+            return 200 <= response.status < 300
+
+    async def deliver(self, summary):
+        loop = asyncio.get_event_loop()
+        body = json.dumps(summary.as_dict()).encode()
+        return await loop.run_in_executor(None, self._post, body)
+
+
+class LogSink(Sink):
+    '''a line per summary in the WhosOnline logger'''
+
+    name = 'log'
+
+    async def deliver(self, summary):
+        logger = logging.getLogger('WhosOnline')
+        if len(summary.events) == 1:
+            logger.info(summary.title)
+        else:
+            logger.info('%s (%s)', summary.title, '; '.join(summary.lines()))
+        return True
+
+
+def make_sink(spec):
+    '''sink from "desktop", "log", "file:PATH" or "webhook:URL"'''
+    kind, _, argument = spec.partition(':')
+    if kind == 'desktop' and not argument:
+        return DesktopSink()
+    if kind == 'log' and not argument:
+        return LogSink()
+    if kind == 'file' and argument:
+        return FileSink(argument)
+    if kind == 'webhook' and argument:
+        return WebhookSink(argument)
+    raise ValueError('Unknown notification sink %r, use desktop, log, file:PATH or webhook:URL' % spec)
+
+
+class NotificationBus:
+    '''Collects host events and hands summaries to the sinks. A burst of
+    events ends after `debounce` quiet seconds, or `max_delay` seconds after
+    it began. Within a burst a host keeps only its net change, one that
+    went offline and came back is not reported at all.
+
+    publish() only files the event, it never waits for a sink.'''
+
+    def __init__(self, sinks=(), debounce=DEBOUNCE, max_delay=MAX_DELAY):
+        self.sinks = list(sinks)
+        self.debounce = debounce
+        self.max_delay = max_delay
+        # ip -> event of the running burst
+        self._pending = {}
+        self._first = None
+        self._timer = None
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.ensure_future(sink.run()) for sink in self.sinks]
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for task in self._tasks:
+            task.cancel()
+        return asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def publish(self, kind, ip, hostname=None):
+        if not self.sinks:
+            return
+        previous = self._pending.get(ip)
+        if previous is None:
+            self._pending[ip] = Event(kind, ip, hostname)
+        elif previous.kind == NEW:
+            # still new, whatever it does next
+            pass
+        elif previous.kind != kind:
+            # flapped back to where the burst found it
+            del self._pending[ip]
+        self._schedule()
+
+    def _schedule(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # blocking caller, it calls deliver_now()
+            return
+        now = loop.time()
+        if self._first is None:
+            self._first = now
+        due = min(now + self.debounce, self._first + self.max_delay)
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = loop.call_at(due, self.flush)
+
+    def flush(self):
+        '''hand the running burst to the sinks now'''
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._first = None
+        events = list(self._pending.values())
+        self._pending.clear()
+        if not events:
+            return
+        summary = Summary(events)
+        for sink in self.sinks:
+            sink.put(summary)
+
+    async def deliver_now(self):
+        '''send the running burst to every sink and wait for it, for
+        callers which do not run the sink tasks'''
+        events = list(self._pending.values())
+        self._pending.clear()
+        self._first = None
+        if not events:
+            return
+        summary = Summary(events)
+        for sink in self.sinks:
+            await sink.send(summary)
+
+
+# the bus host events go to, configure() adds sinks
+BUS = NotificationBus()
+
+
+def configure(specs=DEFAULT_SINKS, debounce=DEBOUNCE):
+    '''replace BUS by one delivering to the sinks given as specs, see
+    make_sink, "none" stands for no sink. Call start() on it once the loop
+    runs.'''
+    global BUS
+    BUS = NotificationBus(
+        [make_sink(spec) for spec in specs if spec != 'none'], debounce
+    )
+    return BUS
+
+
+def publish(kind, ip, hostname=None):
+    BUS.publish(kind, ip, hostname)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#
+# process.py - streaming subprocesses with timeouts, killed with their
+# whole process group when the awaiting task goes away
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import heapq
+import itertools
+import os
+import signal
+
+import whosonline.metrics as metrics
+
+# seconds between SIGTERM and SIGKILL
+KILL_GRACE = 2
+
+CHUNK_SIZE = 65536
+
+# priority classes, lower runs first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+# child processes allowed to run at once, see configure()
+MAX_PROCESSES = 16
+
+
+class ProcessExecutor:
+    '''Global budget for child processes. Commands wait for a slot before
+    they are spawned, waiting interactive commands get the next free slot
+    before any background one.'''
+
+    def __init__(self, limit=MAX_PROCESSES):
+        self.limit = limit
+        self.running = 0
+        self.started = 0
+        # (priority, sequence, future)
+        self._waiting = []
+        self._sequence = itertools.count()
+
+    def queued(self, priority=None):
+        '''number of commands waiting for a slot'''
+        return sum(
+            1 for prio, _, future in self._waiting
+            if not future.done() and (priority is None or prio == priority)
+        )
+
+    async def acquire(self, priority=BACKGROUND):
+        if self.running < self.limit and not self.queued():
+            self.running += 1
+            self.started += 1
+            return
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._sequence), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # got a slot just before being cancelled, hand it on
+                self.release()
+            raise
+        self.started += 1
+
+    def release(self):
+        self.running -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiting and self.running < self.limit:
+            priority, _, future = heapq.heappop(self._waiting)
+            if future.done():
+                continue
+            self.running += 1
+            future.set_result(None)
+
+    def resize(self, limit):
+        self.limit = max(1, limit)
+        self._wake()
+
+    def stats(self):
+        stats = {
+            'limit': self.limit,
+            'running': self.running,
+            'started': self.started,
+        }
+        for priority, name in PRIORITY_NAMES.items():
+            stats['queued_%s' % name] = self.queued(priority)
+        return stats
+
+    def __str__(self):
+        stats = self.stats()
+        return '%s/%s processes running, queued: %s interactive, %s background' % (
+            stats['running'], stats['limit'],
+            stats['queued_interactive'], stats['queued_background']
+        )
+
+
+EXECUTOR = ProcessExecutor()
+
+PROCESSES = metrics.Gauge(
+    'whosonline_processes',
+    'Child processes running or waiting for a slot',
+    labels=('state',),
+    function=lambda: {
+        ('running',): EXECUTOR.running,
+        ('queued_interactive',): EXECUTOR.queued(INTERACTIVE),
+        ('queued_background',): EXECUTOR.queued(BACKGROUND),
+    }
+)
+PROCESS_WAIT = metrics.Histogram(
+    'whosonline_process_wait_seconds',
+    'Time commands waited for a slot of the process budget',
+    labels=('priority',)
+)
+
+
+def configure(limit):
+    '''set the global number of child processes running at once'''
+    EXECUTOR.resize(limit)
+
+
+async def terminate(process, grace=KILL_GRACE):
+    '''SIGTERM the process group of process, SIGKILL it after grace'''
+    if process.returncode is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        pass
+    try:
+        await asyncio.wait_for(process.wait(), grace)
+        return
+    except asyncio.TimeoutError:
+        pass
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    await process.wait()
+
+
+class Command:
+    '''A child process whose output is consumed while it runs.
+
+    Iterate over it (`async for line in Command(...)`) for decoded lines or
+    use chunks() for raw bytes. The child runs in its own process group,
+    which is terminated if `timeout` seconds pass, the iterating task is
+    cancelled or the iteration is abandoned. After a timeout the iteration
+    ends normally and `timed_out` is set.
+
+    Every command takes a slot of the global EXECUTOR while it runs,
+    `priority` decides who gets a slot first when they are all taken.'''
+
+    def __init__(self, command, timeout=None, stderr=None, priority=BACKGROUND):
+        if isinstance(command, str):
+            command = command.split()
+        self.command = command
+        self.timeout = timeout
+        self.stderr = stderr
+        self.priority = priority
+        self.process = None
+        self.returncode = None
+        self.timed_out = False
+        # seconds the child ran, set when it is gone
+        self.runtime = None
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process else None
+
+    async def _iterate(self, read):
+        name = PRIORITY_NAMES.get(self.priority, str(self.priority))
+        with metrics.timed(PROCESS_WAIT, priority=name):
+            await EXECUTOR.acquire(self.priority)
+        metrics.PROCESSES_STARTED.inc(priority=name)
+        try:
+            async for data in self._run_child(read):
+                yield data
+        finally:
+            EXECUTOR.release()
+
+    async def _run_child(self, read):
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        deadline = None if self.timeout is None else started + self.timeout
+        self.process = await asyncio.create_subprocess_exec(
+            *self.command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=self.stderr,
+            start_new_session=True
+        )
+        try:
+            while True:
+                remaining = None if deadline is None else deadline - loop.time()
+                try:
+                    if remaining is not None and remaining <= 0:
+                        raise asyncio.TimeoutError
+                    data = await asyncio.wait_for(read(self.process.stdout), remaining)
+                except asyncio.TimeoutError:
+                    self.timed_out = True
+                    break
+                if not data:
+                    break
+                yield data
+            if not self.timed_out:
+                remaining = None if deadline is None else max(deadline - loop.time(), 0)
+                try:
+                    await asyncio.wait_for(self.process.wait(), remaining)
+                except asyncio.TimeoutError:
+                    self.timed_out = True
+        finally:
+            await terminate(self.process)
+            self.returncode = self.process.returncode
+            self.runtime = loop.time() - started
+
+    async def chunks(self, size=CHUNK_SIZE):
+        async for data in self._iterate(lambda stdout: stdout.read(size)):
+            yield data
+
+    async def __aiter__(self):
+        async for data in self._iterate(lambda stdout: stdout.readline()):
+            yield data.decode(errors='replace').rstrip('\n')
+
+    async def run(self):
+        '''wait for the command, returns (returncode, output)'''
+        output = []
+        async for data in self.chunks():
+            output.append(data)
+        return self.returncode, b''.join(output).decode(errors='replace').strip()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+# resolver.py - concurrent, cached reverse dns lookups
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import concurrent.futures
+import socket
+import threading
+import time
+
+import whosonline.metrics as metrics
+
+
+def gethostbyaddr(ip_address):
+    '''blocking reverse lookup, returns short hostname or None'''
+    try:
+        host = socket.gethostbyaddr(ip_address)
+    except OSError:
+        # herror (no ptr record) as well as gaierror (resolver trouble)
+        return None
+    return host[0].split('.')[0]  # split of domain
+
+
+class Resolver:
+    '''Reverse dns resolver with bounded concurrency and a ttl cache.
+
+    Failed lookups are cached as well (negative caching), using their own
+    ttl, so hosts without ptr record are not asked for on every cycle.
+    Blocking lookups run in a thread pool of size `concurrency`, which
+    stores their results, so the cache is only touched under its lock.
+    '''
+
+    def __init__(self, concurrency=64, ttl=300, negative_ttl=900,
+                 maxsize=262144, lookup=gethostbyaddr):
+        self.concurrency = concurrency
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.lookup_func = lookup
+        # ip -> (expires, hostname or None)
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.concurrency,
+                thread_name_prefix='whosonline-resolver'
+            )
+        return self._executor
+
+    def cached(self, ip):
+        '''returns tuple (found, hostname) from cache'''
+        with self._lock:
+            entry = self._cache.get(ip)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._cache[ip]
+                entry = None
+        if entry is None:
+            metrics.RESOLVER_LOOKUPS.inc(result='miss')
+            return False, None
+        expires, hostname = entry
+        metrics.RESOLVER_LOOKUPS.inc(result='hit')
+        return True, hostname
+
+    def store(self, ip, hostname):
+        ttl = self.ttl if hostname else self.negative_ttl
+        with self._lock:
+            if len(self._cache) >= self.maxsize:
+                self._prune()
+            self._cache[ip] = (time.monotonic() + ttl, hostname)
+
+    def prune(self):
+        with self._lock:
+            self._prune()
+
+    def _prune(self):
+        '''drop expired entries, or the oldest half if nothing expired'''
+        now = time.monotonic()
+        expired = [ip for ip, (expires, _) in self._cache.items() if expires < now]
+        if not expired:
+            expired = list(self._cache)[:len(self._cache) // 2]
+        for ip in expired:
+            del self._cache[ip]
+
+    def invalidate(self, ip=None):
+        with self._lock:
+            if ip is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(ip, None)
+
+    def _resolve_uncached(self, ip):
+        hostname = self.lookup_func(ip)
+        self.store(ip, hostname)
+        return ip, hostname
+
+    def lookup(self, ip):
+        '''blocking, cached lookup of a single ip'''
+        found, hostname = self.cached(ip)
+        if found:
+            return hostname
+        return self._resolve_uncached(ip)[1]
+
+    def resolve_iter(self, ips):
+        '''Blocking generator yielding (ip, hostname) for all given ips.
+        Uncached ips are resolved concurrently, so results may come out of
+        order. Use this outside of a running event loop.'''
+        pending = set()
+        for ip in ips:
+            found, hostname = self.cached(ip)
+            if found:
+                yield ip, hostname
+                continue
+            pending.add(self.executor.submit(self._resolve_uncached, ip))
+            if len(pending) >= self.concurrency:
+                done, pending = concurrent.futures.wait(
+                    pending,
+                    return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    yield future.result()
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
+
+    async def resolve(self, ip):
+        '''cached lookup of a single ip without blocking the event loop'''
+        found, hostname = self.cached(ip)
+        if found:
+            return hostname
+        loop = asyncio.get_event_loop()
+        ip, hostname = await loop.run_in_executor(
+            self.executor, self._resolve_uncached, ip
+        )
+        return hostname
+
+    async def resolve_many(self, ips):
+        '''Async generator yielding (ip, hostname) as lookups finish, keeping
+        at most `concurrency` lookups in flight.'''
+        loop = asyncio.get_event_loop()
+        pending = set()
+        try:
+            for ip in ips:
+                found, hostname = self.cached(ip)
+                if found:
+                    yield ip, hostname
+                    continue
+                pending.add(loop.run_in_executor(
+                    self.executor, self._resolve_uncached, ip
+                ))
+                if len(pending) >= self.concurrency:
+                    done, pending = await asyncio.wait(
+                        pending,
+                        return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+#
+# results.py - compact scan results. Ports are shared between all hosts,
+# host records are updated in place from cycle to cycle.
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import sys
+import weakref
+
+import whosonline.hostindex as hostindex
+
+# distinct tuples of ports or port names kept for sharing, the least
+# recently used beyond are dropped
+MAX_SHARED = 4096
+
+# every port in use, (number, protocol, state, service, version) -> Port,
+# a port no record holds any more drops out
+_PORTS = weakref.WeakValueDictionary()
+# tuples of ports or port names, most hosts share a few. Tuples can not be
+# weakly referenced, so this one is an lru instead.
+_TUPLES = collections.OrderedDict()
+
+
+def _intern(value):
+    return None if value is None else sys.intern(value)
+
+
+def _shared(items):
+    '''the one instance of tuple items'''
+    shared = _TUPLES.get(items)
+    if shared is None:
+        if len(_TUPLES) >= MAX_SHARED:
+            _TUPLES.popitem(last=False)
+        _TUPLES[items] = shared = items
+    else:
+        _TUPLES.move_to_end(items)
+    return shared
+
+
+class Port:
+    '''A port as nmap reported it. Instances are shared, never change
+    them, get them from make_port().'''
+
+    __slots__ = (
+        'number', 'protocol', 'state', 'service', 'version', 'name',
+        '__weakref__'
+    )
+
+    def __init__(self, number, protocol, state, service, version=None):
+        self.number = number
+        self.protocol = protocol
+        self.state = state
+        self.service = service
+        self.version = version
+        # '22/tcp', like the port key of result dicts
+        self.name = sys.intern('%s/%s' % (number, protocol))
+
+    def __repr__(self):
+        return '<Port %s %s %s>' % (self.name, self.state, self.service)
+
+    def as_dict(self):
+        port_d = {'port': self.name, 'state': self.state, 'service': self.service}
+        if self.version is not None:
+            port_d['version'] = self.version
+        return port_d
+
+
+def make_port(number, protocol, state='unknown', service='unknown', version=None):
+    key = (int(number), protocol, state, service, version)
+    port = _PORTS.get(key)
+    if port is None:
+        port = _PORTS[key] = Port(
+            key[0], _intern(protocol), _intern(state), _intern(service),
+            _intern(version)
+        )
+    return port
+
+
+class Host:
+    '''Result of scanning one host. open_ports holds the names of open
+    ports, it is what changes are detected on.'''
+
+    __slots__ = ('online', 'mac', 'os', 'ports', 'open_ports')
+
+    def __init__(self, online=False, mac=None, os=None, ports=()):
+        self.online = online
+        self.mac = mac
+        self.os = os
+        self.set_ports(ports)
+
+    def __repr__(self):
+        return '<Host %s>' % self.as_dict()
+
+    def set_ports(self, ports):
+        self.ports = _shared(tuple(ports))
+        self.open_ports = _shared(tuple(
+            port.name for port in self.ports if port.state == 'open'
+        ))
+
+    def update(self, other):
+        '''take over the result of another scan, fields which did not change
+        keep their objects. Returns True if anything changed.'''
+        changed = False
+        if self.online != other.online:
+            self.online = other.online
+            changed = True
+        if self.mac != other.mac:
+            self.mac = other.mac
+            changed = True
+        if self.os != other.os:
+            self.os = other.os
+            changed = True
+        # equal but not shared once the tuple dropped out of _TUPLES
+        if self.ports is not other.ports and self.ports != other.ports:
+            self.ports = other.ports
+            self.open_ports = other.open_ports
+            changed = True
+        return changed
+
+    def as_dict(self):
+        '''the nested dict nmap_scan used to return, e.g. for json'''
+        result_d = {
+            'ports': [port.as_dict() for port in self.ports],
+            'online': self.online,
+        }
+        if self.mac is not None:
+            result_d['MAC'] = self.mac
+        if self.os is not None:
+            result_d['OS'] = self.os
+        return result_d
+
+    @classmethod
+    def from_dict(cls, result_d):
+        ports = []
+        for port_d in result_d.get('ports', []):
+            number, _, protocol = port_d['port'].partition('/')
+            ports.append(make_port(
+                number, protocol, port_d.get('state', 'unknown'),
+                port_d.get('service', 'unknown'), port_d.get('version')
+            ))
+        return cls(
+            result_d.get('online', False), result_d.get('MAC'),
+            result_d.get('OS'), ports
+        )
+
+
+class HostTable:
+    '''Host records by integer address. update() copies a new scan result
+    into the existing record, so a host costs the same after a year of
+    cycles as after the first one.'''
+
+    def __init__(self):
+        self.records = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, ip):
+        return hostindex.to_key(ip) in self.records
+
+    def get(self, ip):
+        return self.records.get(hostindex.to_key(ip))
+
+    def update(self, ip, result):
+        '''returns (record, changed), a new record counts as changed'''
+        key = hostindex.to_key(ip)
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = Host()
+            record.update(result)
+            return record, True
+        return record, record.update(result)
+
+    def forget(self, ip):
+        self.records.pop(hostindex.to_key(ip), None)
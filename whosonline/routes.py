@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#
+# routes.py - kernel routing table without shelling out to route(8)
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import ipaddress
+import socket
+import struct
+import time
+
+import whosonline.netlink as netlink
+
+RTMSG = struct.Struct('=BBBBBBBBI')
+
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RTA_TABLE = 15
+
+RT_TABLE_MAIN = 254
+RTN_UNICAST = 1
+
+PROC_ROUTE = '/proc/net/route'
+
+# seconds a table is trusted if no watcher keeps it current
+MAX_AGE = 60
+
+
+class Route:
+
+    def __init__(self, network, interface, gateway=None, metric=0):
+        self.network = network
+        self.interface = interface
+        self.gateway = gateway
+        self.metric = metric
+
+    def as_dict(self):
+        '''layout of the former `route -n` parser'''
+        return {
+            'Destination': str(self.network.network_address),
+            'Gateway': self.gateway or '0.0.0.0',
+            'Genmask': str(self.network.netmask),
+            'Interface': self.interface
+        }
+
+    def __repr__(self):
+        return '<Route %s dev %s via %s metric %s>' % (
+            self.network, self.interface, self.gateway, self.metric
+        )
+
+
+def _interface_name(ifindex):
+    try:
+        return socket.if_indextoname(ifindex)
+    except OSError:
+        return str(ifindex)
+
+
+def parse_route(payload):
+    '''Route for a RTM_NEWROUTE message of the main table, else None'''
+    if len(payload) < RTMSG.size:
+        return None
+    family, dst_len, src_len, tos, table, protocol, scope, rtype, flags = \
+        RTMSG.unpack_from(payload)
+    if family not in (socket.AF_INET, socket.AF_INET6) or rtype != RTN_UNICAST:
+        return None
+    attrs = netlink.parse_attributes(payload, RTMSG.size)
+    if RTA_TABLE in attrs:
+        table = struct.unpack('=I', attrs[RTA_TABLE])[0]
+    if table != RT_TABLE_MAIN or RTA_OIF not in attrs:
+        return None
+    if RTA_DST in attrs:
+        destination = socket.inet_ntop(family, attrs[RTA_DST])
+    else:
+        destination = '0.0.0.0' if family == socket.AF_INET else '::'
+    network = ipaddress.ip_network('%s/%s' % (destination, dst_len), strict=False)
+    gateway = None
+    if RTA_GATEWAY in attrs:
+        gateway = socket.inet_ntop(family, attrs[RTA_GATEWAY])
+    metric = 0
+    if RTA_PRIORITY in attrs:
+        metric = struct.unpack('=I', attrs[RTA_PRIORITY])[0]
+    interface = _interface_name(struct.unpack('=i', attrs[RTA_OIF])[0])
+    return Route(network, interface, gateway, metric)
+
+
+def read_netlink_routes():
+    routes = []
+    for family in (socket.AF_INET, socket.AF_INET6):
+        request = RTMSG.pack(family, 0, 0, 0, 0, 0, 0, 0, 0)
+        for message_type, payload in netlink.dump(netlink.RTM_GETROUTE, request):
+            route = parse_route(payload)
+            if route is not None:
+                routes.append(route)
+    return routes
+
+
+def read_proc_routes(path=PROC_ROUTE):
+    '''fallback without rtnetlink, ipv4 only'''
+    routes = []
+    with open(path) as proc_route:
+        next(proc_route)  # header
+        for line in proc_route:
+            fields = line.split()
+            if len(fields) < 8:
+                continue
+            interface, destination, gateway, flags = fields[:4]
+            metric, mask = fields[6], fields[7]
+
+            def to_ip(value):
+                return socket.inet_ntoa(struct.pack('<I', int(value, 16)))
+
+            network = ipaddress.ip_network(
+                '%s/%s' % (to_ip(destination), to_ip(mask)), strict=False
+            )
+            gateway = to_ip(gateway)
+            routes.append(Route(
+                network, interface,
+                None if gateway == '0.0.0.0' else gateway,
+                int(metric)
+            ))
+    return routes
+
+
+def read_routes():
+    try:
+        return read_netlink_routes()
+    except OSError:
+        return read_proc_routes()
+
+
+class RouteTable:
+    '''Routes indexed by prefix length for longest prefix matching. Loaded
+    lazily, reloaded after MAX_AGE seconds or whenever watch() sees the
+    kernel table change.'''
+
+    def __init__(self, max_age=MAX_AGE, reader=read_routes):
+        self.max_age = max_age
+        self.reader = reader
+        self.routes = []
+        # (version, prefixlen) -> {network int: best route}, longest first
+        self._index = []
+        self.loaded = None
+
+    def load(self, routes=None):
+        '''index routes, read from the kernel if not given'''
+        self.routes = self.reader() if routes is None else routes
+        index = {}
+        for route in sorted(self.routes, key=lambda route: -route.metric):
+            network = route.network
+            key = (network.version, network.prefixlen)
+            # lower metric wins, sorted so it is written last
+            index.setdefault(key, {})[int(network.network_address)] = route
+        self._index = sorted(index.items(), key=lambda item: -item[0][1])
+        self.loaded = time.monotonic()
+        return self
+
+    def invalidate(self):
+        self.loaded = None
+
+    @property
+    def stale(self):
+        return self.loaded is None or time.monotonic() - self.loaded > self.max_age
+
+    def _ensure_loaded(self):
+        if self.stale:
+            self.load()
+
+    async def refresh(self):
+        '''reload a stale table, reading it in a worker thread'''
+        if self.stale:
+            loop = asyncio.get_event_loop()
+            self.load(await loop.run_in_executor(None, self.reader))
+        return self
+
+    def lookup(self, target, min_prefixlen=0):
+        '''Route with the longest prefix covering target (address or
+        network, as string or ipaddress object), None if nothing matches'''
+        self._ensure_loaded()
+        if isinstance(target, str):
+            target = ipaddress.ip_network(target, strict=False)
+        elif not isinstance(target, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+            target = ipaddress.ip_network(target)
+        address = int(target.network_address)
+        bits = target.max_prefixlen
+        for (version, prefixlen), networks in self._index:
+            if version != target.version or prefixlen > target.prefixlen:
+                continue
+            if prefixlen < min_prefixlen:
+                break
+            mask = ((1 << prefixlen) - 1) << (bits - prefixlen)
+            route = networks.get(address & mask)
+            if route is not None:
+                return route
+        return None
+
+    async def resolve(self, target, min_prefixlen=0):
+        '''lookup() without blocking the event loop'''
+        await self.refresh()
+        return self.lookup(target, min_prefixlen)
+
+    async def watch(self):
+        '''invalidate the table on every kernel route change until cancelled'''
+        sock = netlink.subscribe(
+            netlink.RTMGRP_IPV4_ROUTE | netlink.RTMGRP_IPV6_ROUTE
+        )
+        loop = asyncio.get_event_loop()
+        changed = asyncio.Event()
+
+        def on_readable():
+            if netlink.receive(sock):
+                changed.set()
+
+        loop.add_reader(sock.fileno(), on_readable)
+        # the watcher keeps the table current, no need to expire it
+        self.max_age = float('inf')
+        try:
+            while True:
+                await changed.wait()
+                changed.clear()
+                self.invalidate()
+        finally:
+            self.max_age = MAX_AGE
+            loop.remove_reader(sock.fileno())
+            sock.close()
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#
+# scheduler.py - run scans concurrently with an upper bound
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import heapq
+import time
+
+# defaults for the scan loops, may be overwritten from command line
+SCAN_CONCURRENCY = 8
+SCAN_INTERVAL = 3
+
+
+async def _call(func, item):
+    return item, await func(item)
+
+
+async def bounded_map(func, items, concurrency=SCAN_CONCURRENCY):
+    '''Async generator awaiting func(item) for all items, keeping at most
+    `concurrency` calls running at once. Yields (item, result) in order of
+    completion. Pending calls are cancelled if the consumer goes away.'''
+    pending = set()
+    try:
+        for item in items:
+            pending.add(asyncio.ensure_future(_call(func, item)))
+            if len(pending) >= concurrency:
+                done, pending = await asyncio.wait(
+                    pending,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = await asyncio.wait(
+                pending,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class CycleTimer:
+    '''measures one scan cycle, used to report cycle time and hosts/sec'''
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.count = 0
+
+    def tick(self, count=1):
+        self.count += count
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        return self.count / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return '%s hosts in %.2fs (%.1f hosts/sec)' % (
+            self.count, self.elapsed, self.rate
+        )
+
+
+# bounds for the adaptive netcheck polling intervals
+POLL_MIN_INTERVAL = 1
+POLL_MAX_INTERVAL = 300
+POLL_BACKOFF = 2
+
+
+class PollScheduler:
+    '''Heap of per host deadlines. A host whose state changed is checked
+    again after min_interval, every unchanged check multiplies its interval
+    by backoff up to max_interval.'''
+
+    def __init__(self, min_interval=POLL_MIN_INTERVAL,
+                 max_interval=POLL_MAX_INTERVAL, backoff=POLL_BACKOFF):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = backoff
+        # ip -> current interval / deadline, the heap may hold stale
+        # entries which are skipped if they do not match the deadline
+        self.intervals = {}
+        self.deadlines = {}
+        self._heap = []
+        # seconds the most overdue host of the last pop_due() waited
+        self.behind = 0.0
+
+    def __contains__(self, ip):
+        return ip in self.deadlines
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def _push(self, ip, deadline):
+        self.deadlines[ip] = deadline
+        heapq.heappush(self._heap, (deadline, ip))
+
+    def add(self, ip, delay=0, now=None):
+        '''start polling ip, no-op if it is known already'''
+        if ip in self.deadlines:
+            return
+        now = time.monotonic() if now is None else now
+        self.intervals[ip] = self.min_interval
+        self._push(ip, now + delay)
+
+    def remove(self, ip):
+        self.intervals.pop(ip, None)
+        self.deadlines.pop(ip, None)
+
+    def _clean_top(self):
+        while self._heap:
+            deadline, ip = self._heap[0]
+            if self.deadlines.get(ip) == deadline:
+                return self._heap[0]
+            heapq.heappop(self._heap)
+        return None
+
+    def next_deadline(self):
+        top = self._clean_top()
+        return top[0] if top else None
+
+    def pop_due(self, limit=None, now=None):
+        '''ips whose deadline passed, most overdue first. They stay known
+        but are not due again until report() is called for them.'''
+        now = time.monotonic() if now is None else now
+        due = []
+        self.behind = 0.0
+        while limit is None or len(due) < limit:
+            top = self._clean_top()
+            if top is None or top[0] > now:
+                break
+            if not due:
+                self.behind = now - top[0]
+            heapq.heappop(self._heap)
+            ip = top[1]
+            # parked until reported
+            self.deadlines[ip] = float('inf')
+            due.append(ip)
+        return due
+
+    def report(self, ip, changed, now=None):
+        '''reschedule ip after a check, returns the new interval'''
+        if ip not in self.intervals:
+            return None
+        now = time.monotonic() if now is None else now
+        if changed:
+            interval = self.min_interval
+        else:
+            interval = min(self.intervals[ip] * self.backoff, self.max_interval)
+        self.intervals[ip] = interval
+        self._push(ip, now + interval)
+        return interval
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+#
+# store.py - persistent, indexed store of scan and probe results
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import datetime
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+import whosonline.results as results
+
+DEFAULT_PATH = '~/.whosonline.db'
+
+# records written in one transaction at most
+BATCH_SIZE = 500
+# seconds the writer waits to fill a batch
+FLUSH_INTERVAL = 1.0
+# days results are kept, the last one of every host and kind stays
+RETENTION_DAYS = 30
+# seconds between two deletions of old results
+PRUNE_INTERVAL = 3600
+# kinds stored on every call, results of loops are only stored on change
+ON_DEMAND = ('os', 'services', 'probe')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    host TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    online INTEGER,
+    mac TEXT,
+    changed INTEGER NOT NULL DEFAULT 0,
+    data TEXT
+);
+CREATE TABLE IF NOT EXISTS ports (
+    result_id INTEGER NOT NULL REFERENCES results(id),
+    port TEXT NOT NULL,
+    state TEXT,
+    service TEXT,
+    version TEXT
+);
+CREATE INDEX IF NOT EXISTS results_host_ts ON results (host, ts);
+CREATE INDEX IF NOT EXISTS results_host_kind_ts ON results (host, kind, ts);
+CREATE INDEX IF NOT EXISTS results_ts ON results (ts);
+CREATE INDEX IF NOT EXISTS results_changed_ts ON results (ts) WHERE changed;
+CREATE INDEX IF NOT EXISTS ports_port ON ports (port, result_id);
+CREATE INDEX IF NOT EXISTS ports_result ON ports (result_id);
+'''
+
+_STOP = object()
+
+LOGGER = logging.getLogger('WhosOnline')
+
+_RELATIVE = re.compile(r'^(\d+(?:\.\d+)?)\s*([smhdw])$')
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_since(text):
+    '''timestamp from "10m", "2h", "3d", an iso date/datetime or epoch'''
+    text = text.strip()
+    match = _RELATIVE.match(text)
+    if match:
+        return time.time() - float(match.group(1)) * _UNITS[match.group(2)]
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise ValueError('Unknown time "%s", try "2h", "3d" or "2018-01-31 12:00"' % text)
+
+
+def _summary(online, mac, ports):
+    return online, mac, frozenset(ports)
+
+
+# id of the last results row of every host and kind, rows are written by
+# one thread in the order they were recorded, so the highest id is the
+# newest
+LATEST_IDS = 'SELECT MAX(id) FROM results GROUP BY host, kind'
+
+
+class ResultStore:
+    '''SQLite backed result log. record() only puts the result on a queue,
+    a writer thread commits batches, so callers on the event loop never wait
+    for the disk. Results of the loops are only written when they differ
+    from the last one of the host, anything older than `retention_days`
+    except the last result is deleted. Queries use their own connection in
+    a worker thread.'''
+
+    def __init__(self, path=DEFAULT_PATH, retention_days=RETENTION_DAYS):
+        self.path = os.path.expanduser(path)
+        self.retention_days = retention_days
+        self._queue = queue.Queue()
+        # (host, kind) -> summary of the last record, to flag changes. Only
+        # the writer thread uses it.
+        self._last = {}
+        # set once the writer created the schema or failed to
+        self._ready = threading.Event()
+        # why the writer could not open the database
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._writer, name='whosonline-store', daemon=True
+        )
+        self._thread.start()
+        # a bad path fails here, loading the last state is left to the writer
+        self._check()
+
+    def _check(self):
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _load_last(self, connection):
+        open_ports = {}
+        for result_id, port in connection.execute(
+            "SELECT result_id, port FROM ports WHERE state = 'open'"
+            " AND result_id IN (%s)" % LATEST_IDS
+        ):
+            open_ports.setdefault(result_id, []).append(port)
+        for result_id, host, kind, online, mac in connection.execute(
+            'SELECT id, host, kind, online, mac FROM results'
+            ' WHERE id IN (%s)' % LATEST_IDS
+        ):
+            self._last[(host, kind)] = _summary(
+                None if online is None else bool(online), mac,
+                open_ports.get(result_id, ())
+            )
+
+    def _prune(self, connection):
+        if not self.retention_days:
+            return
+        before = time.time() - self.retention_days * 86400
+        with connection:
+            connection.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS expired (id INTEGER PRIMARY KEY)'
+            )
+            connection.execute('DELETE FROM expired')
+            connection.execute(
+                'INSERT INTO expired SELECT id FROM results WHERE ts < ?'
+                ' AND id NOT IN (%s)' % LATEST_IDS, (before,)
+            )
+            connection.execute(
+                'DELETE FROM ports WHERE result_id IN (SELECT id FROM expired)'
+            )
+            connection.execute(
+                'DELETE FROM results WHERE id IN (SELECT id FROM expired)'
+            )
+
+    def record(self, kind, host, result_d=None, online=None):
+        '''queue a result. kind names the producer ('fast', 'os',
+        'services', 'probe', 'arping', 'ping'), result_d is a nmap result,
+        online a plain probe result.'''
+        if self._error is not None:
+            raise self._error
+        if isinstance(result_d, results.Host):
+            # records change in place, the writer thread gets a copy
+            result_d = result_d.as_dict()
+        self._queue.put((time.time(), kind, host, result_d, online))
+
+    def _writer(self):
+        try:
+            connection = self._connect()
+            connection.executescript(SCHEMA)
+        except sqlite3.Error as e:
+            self._error = e
+            return
+        finally:
+            self._ready.set()
+        try:
+            self._load_last(connection)
+        except sqlite3.Error as e:
+            # every result counts as changed then
+            LOGGER.error('Unable to load the last results: %s', e)
+        pruned = None
+        stop = False
+        while not stop:
+            if pruned is None or time.monotonic() - pruned >= PRUNE_INTERVAL:
+                try:
+                    self._prune(connection)
+                except sqlite3.Error as e:
+                    LOGGER.error('Unable to delete old results: %s', e)
+                pruned = time.monotonic()
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(batch) < BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stop = True
+                batch = [item for item in batch if item is not _STOP]
+            try:
+                self._write(connection, batch)
+            except sqlite3.Error as e:
+                LOGGER.error('Unable to store %s results: %s', len(batch), e)
+        connection.close()
+
+    def _write(self, connection, batch):
+        with connection:
+            for ts, kind, host, result_d, online in batch:
+                ports = []
+                mac = None
+                data = None
+                if result_d is not None:
+                    online = result_d.get('online')
+                    mac = result_d.get('MAC')
+                    ports = result_d.get('ports', [])
+                    data = json.dumps(result_d)
+                open_ports = [
+                    port_d['port'] for port_d in ports
+                    if port_d.get('state') == 'open'
+                ]
+                summary = _summary(online, mac, open_ports)
+                changed = self._last.get((host, kind)) != summary
+                if not changed and kind not in ON_DEMAND:
+                    continue
+                self._last[(host, kind)] = summary
+                cursor = connection.execute(
+                    'INSERT INTO results (ts, host, kind, online, mac, changed, data)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (ts, host, kind, online, mac, int(changed), data)
+                )
+                if ports:
+                    connection.executemany(
+                        'INSERT INTO ports (result_id, port, state, service, version)'
+                        ' VALUES (?, ?, ?, ?, ?)',
+                        [(cursor.lastrowid, port_d['port'], port_d.get('state'),
+                          port_d.get('service'), port_d.get('version'))
+                         for port_d in ports]
+                    )
+
+    def close(self):
+        '''flush pending records and stop the writer'''
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    # queries, blocking versions run on a fresh connection
+
+    def _query(self, sql, args=()):
+        self._check()
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            return connection.execute(sql, args).fetchall()
+        finally:
+            connection.close()
+
+    def history_sync(self, host, limit=20):
+        '''newest results for host as (ts, kind, online, mac, changed,
+        data) rows'''
+        return self._query(
+            'SELECT ts, kind, online, mac, changed, data FROM results'
+            ' WHERE host = ? ORDER BY ts DESC LIMIT ?',
+            (host, limit)
+        )
+
+    def changes_since_sync(self, since, limit=200):
+        '''the newest `limit` results differing from the previous one of
+        the same host and kind, oldest first, as (ts, host, kind, online,
+        mac, data) rows'''
+        rows = self._query(
+            'SELECT ts, host, kind, online, mac, data FROM results'
+            ' WHERE changed AND ts >= ? ORDER BY ts DESC LIMIT ?',
+            (since, limit)
+        )
+        rows.reverse()
+        return rows
+
+    def hosts_with_port_sync(self, port, since=0):
+        return self._query(
+            'SELECT DISTINCT r.host FROM ports p JOIN results r'
+            ' ON r.id = p.result_id WHERE p.port = ? AND p.state = ?'
+            ' AND r.ts >= ?',
+            (port, 'open', since)
+        )
+
+    def latest_sync(self, kind='fast'):
+        '''dict host -> last result_d of kind, used for warm starts'''
+        rows = self._query(
+            'SELECT host, data FROM results WHERE id IN'
+            ' (SELECT MAX(id) FROM results WHERE kind = ? GROUP BY host)',
+            (kind,)
+        )
+        return {host: json.loads(data) for host, data in rows if data}
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def history(self, host, limit=20):
+        return await self._run(self.history_sync, host, limit)
+
+    async def changes_since(self, since, limit=200):
+        return await self._run(self.changes_since_sync, since, limit)
+
+    async def latest(self, kind='fast'):
+        return await self._run(self.latest_sync, kind)
+
+
+def format_row(ts, kind, online, mac, data):
+    '''one line description of a stored result'''
+    when = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+    state = {None: 'unknown', 0: 'offline', 1: 'online'}.get(online, online)
+    text = '%s %-8s %s' % (when, kind, state)
+    if mac:
+        text += ' MAC %s' % mac
+    if data:
+        ports = [
+            port_d['port'] for port_d in json.loads(data).get('ports', [])
+            if port_d.get('state') == 'open'
+        ]
+        if ports:
+            text += ' ports %s' % ', '.join(ports)
+    return text
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+# tracker.py - remember scan results per host, report changes and decide
+# which hosts need to be rescanned
+#
+# Copyright (c) 2017 Lars Bergmann
+#
+# GNU GENERAL PUBLIC LICENSE
+#    Version 3, 29 June 2007
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+# seconds between rescans of a host which just changed
+MIN_INTERVAL = 0
+# upper bound for the rescan interval of stable hosts
+MAX_INTERVAL = 600
+# stable hosts get their interval multiplied by this after every scan
+BACKOFF = 2
+
+
+def summarize(result):
+    '''the parts of a results.Host changes are detected on, shared objects
+    of the record so keeping a summary costs nothing'''
+    return result.online, result.mac, result.open_ports
+
+
+def diff(old, new):
+    '''human readable list of differences between two summaries'''
+    if old is None:
+        online, mac, ports = new
+        changes = ['new host, %s' % ('online' if online else 'offline')]
+        if mac:
+            changes.append('MAC %s' % mac)
+        if ports:
+            changes.append('open ports %s' % ', '.join(sorted(ports)))
+        return changes
+    changes = []
+    old_online, old_mac, old_ports = old
+    online, mac, ports = new
+    if old_online != online:
+        changes.append('now %s' % ('online' if online else 'offline'))
+    if mac and old_mac != mac:
+        changes.append('MAC %s -> %s' % (old_mac, mac))
+    if online and ports != old_ports:
+        opened = set(ports).difference(old_ports)
+        closed = set(old_ports).difference(ports)
+        if opened:
+            changes.append('opened %s' % ', '.join(sorted(opened)))
+        if closed:
+            changes.append('closed %s' % ', '.join(sorted(closed)))
+    return changes
+
+
+class HostState:
+
+    def __init__(self, summary, interval, now):
+        self.summary = summary
+        self.interval = interval
+        self.changed = now
+        self.next_scan = now + interval
+
+
+class HostTracker:
+    '''Last known summary per host. Hosts that changed are rescanned right
+    away, stable hosts back off exponentially up to max_interval.'''
+
+    def __init__(self, base_interval=1, min_interval=MIN_INTERVAL,
+                 max_interval=MAX_INTERVAL, backoff=BACKOFF):
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.hosts = {}
+
+    def due(self, ips, now=None):
+        '''the ips that should be scanned now, unknown ones included'''
+        now = time.monotonic() if now is None else now
+        for ip in ips:
+            state = self.hosts.get(ip)
+            if state is None or state.next_scan <= now:
+                yield ip
+
+    def update(self, ip, result, now=None):
+        '''store result, returns list of changes (empty if nothing changed)'''
+        now = time.monotonic() if now is None else now
+        summary = summarize(result)
+        state = self.hosts.get(ip)
+        changes = diff(state.summary if state else None, summary)
+        if state is None:
+            self.hosts[ip] = HostState(summary, self.min_interval, now)
+            return changes
+        if changes:
+            state.summary = summary
+            state.changed = now
+            state.interval = self.min_interval
+        else:
+            state.interval = min(
+                max(state.interval * self.backoff, self.base_interval),
+                self.max_interval
+            )
+        state.next_scan = now + state.interval
+        return changes
+
+    def seed(self, ip, result, now=None):
+        '''known state from earlier runs, treated as stable'''
+        now = time.monotonic() if now is None else now
+        self.hosts[ip] = HostState(summarize(result), self.base_interval, now)
+
+    def forget(self, ip):
+        self.hosts.pop(ip, None)
+
+    def stable_for(self, ip, now=None):
+        now = time.monotonic() if now is None else now
+        state = self.hosts.get(ip)
+        return now - state.changed if state else 0